@@ -0,0 +1,514 @@
+"""
+Benchmarks for scanner.py against recorded API fixtures served by a local stand-in.
+
+    python benchmark.py synth                  # deterministic fixtures -> bench_fixtures/
+    python benchmark.py record                 # record real TWSE / FinMind responses (needs FINMIND_TOKEN)
+    python benchmark.py run --out bench_results.json [--latency-ms 30 --error-rate 0.02]
+    python benchmark.py serve --port 8765      # stand-in only (set FINMIND_URL / TWSE_DAY_ALL_URL)
+    python benchmark.py parse [--repeat 200]   # STOCK_DAY_ALL column parser vs the DataFrame-first path
+
+Each stage reports wall time, stand-in request count, bytes served and peak Python memory
+(tracemalloc). Results are tagged with the git commit and a fixture hash so runs can be
+compared across commits on the same fixtures.
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import hashlib
+import argparse
+import tempfile
+import importlib
+import threading
+import tracemalloc
+import subprocess
+import urllib.parse
+import datetime as dt
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import numpy as np
+
+FIXTURE_DIR = "bench_fixtures"
+BENCH_OUT = "bench_results.json"
+
+TWSE_FIELDS = ["證券代號", "證券名稱", "成交股數", "成交金額", "開盤價",
+               "最高價", "最低價", "收盤價", "漲跌價差", "成交筆數"]
+TPEX_FIELDS = ["代號", "名稱", "收盤 ", "漲跌", "開盤 ", "最高 ", "最低", "均價 ",
+               "成交股數  ", "成交金額(元)", "成交筆數 "]
+NO_DATA = {"stat": "很抱歉，沒有符合條件的資料!"}
+TPEX_NO_DATA = {"stat": "ok", "tables": [{"fields": TPEX_FIELDS, "data": []}]}
+
+
+# =======================
+# Fixtures
+# =======================
+def _write(path: str, obj):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(obj, f, ensure_ascii=False)
+
+
+def fixture_hash(root: str) -> str:
+    h = hashlib.sha256()
+    for dirpath, _, files in sorted(os.walk(root)):
+        for fn in sorted(files):
+            with open(os.path.join(dirpath, fn), "rb") as f:
+                h.update(fn.encode())
+                h.update(f.read())
+    return h.hexdigest()[:12]
+
+
+def synth_fixtures(root: str = FIXTURE_DIR, n_codes: int = 1000, n_days: int = 620,
+                   n_breakouts: int = 30, n_decoys: int = 30, lookback: int = 10, seed: int = 7,
+                   n_tpex: int = 800):
+    """
+    Deterministic stand-in for a recorded session, ending on the last weekday <= today.
+    n_codes TWSE codes plus n_tpex TPEx codes (3101...), both exchanges with breakouts.
+    n_breakouts codes consolidate then break out on the last day; n_decoys have the same
+    long red candle without the consolidation. FinMind history is kept for 0050, the
+    breakout/decoy codes and a sample of others (what a daily run actually asks for).
+    """
+    rng = np.random.default_rng(seed)
+    end = dt.date.today()
+    while end.weekday() >= 5:
+        end -= dt.timedelta(days=1)
+    days = []
+    d = end
+    while len(days) < n_days:
+        if d.weekday() < 5:
+            days.append(d)
+        d -= dt.timedelta(days=1)
+    days = days[::-1]
+    codes = ["0050"] + [f"{1101 + i}" for i in range(n_codes - 1)] + [f"{3101 + i}" for i in range(n_tpex)]
+    T, N = len(days), len(codes)
+
+    close = np.empty((T, N))
+    close[0] = rng.uniform(15, 600, N)
+    for t in range(1, T):
+        close[t] = close[t - 1] * (1 + rng.normal(0.0004, 0.015, N))
+    close[-90:, 0] = close[-91, 0] * np.cumprod(1 + rng.normal(0.002, 0.004, 90))   # 0050 above MA60
+    opn = close * (1 + rng.normal(0, 0.006, (T, N)))
+    vol = rng.integers(300_000, 3_000_000, (T, N)).astype(np.int64)
+
+    # every third breakout / decoy is a TPEx code when there are any
+    pick = [n_codes + i if n_tpex and i % 3 == 2 else 1 + i for i in range(n_breakouts + n_decoys)]
+    brk, dec = pick[:n_breakouts], pick[n_breakouts:]
+    for j in brk:
+        base = close[-40, j]
+        close[-25:-1, j] = base * (1 + rng.uniform(-0.025, 0.025, 24))
+        opn[-25:-1, j] = close[-25:-1, j] * (1 + rng.normal(0, 0.004, 24))
+        close[-1, j] = close[-25:-1, j].max() * rng.uniform(1.04, 1.08)
+    for j in brk + dec:
+        if j in dec:
+            close[-1, j] = close[-2, j] * rng.uniform(1.05, 1.09)
+        opn[-1, j] = close[-1, j] / rng.uniform(1.045, 1.06)
+        vol[-1, j] = vol[-6:-1, j].mean() * rng.uniform(2.5, 5)
+    high = np.maximum(opn, close) * (1 + rng.uniform(0, 0.004, (T, N)))
+    low = np.minimum(opn, close) * (1 - rng.uniform(0, 0.004, (T, N)))
+    high[-1, brk + dec] = close[-1, brk + dec]
+
+    if os.path.isdir(root):
+        shutil.rmtree(root)
+
+    def snapshot(t: int) -> dict:
+        rows = [[codes[j], f"S{codes[j]}", f"{vol[t, j]:,}", f"{int(vol[t, j] * close[t, j]):,}",
+                 f"{opn[t, j]:,.2f}", f"{high[t, j]:,.2f}", f"{low[t, j]:,.2f}", f"{close[t, j]:,.2f}",
+                 "0.00", f"{int(vol[t, j] // 1000):,}"] for j in range(n_codes)]
+        rows.append(["00937B", "ETF", "0", "0", "--", "--", "--", "--", "0.00", "0"])
+        return {"stat": "OK", "date": days[t].strftime("%Y%m%d"), "fields": TWSE_FIELDS, "data": rows}
+
+    def tpex_snapshot(t: int) -> dict:
+        rows = [[codes[j], f"S{codes[j]}", f"{close[t, j]:,.2f}", "0.00", f"{opn[t, j]:,.2f}",
+                 f"{high[t, j]:,.2f}", f"{low[t, j]:,.2f}", f"{close[t, j]:,.2f}", f"{vol[t, j]:,}",
+                 f"{int(vol[t, j] * close[t, j]):,}", f"{int(vol[t, j] // 1000):,}"] for j in range(n_codes, N)]
+        rows.append(["006201", "ETF", "---", "0.00", "---", "---", "---", "---", "0", "0", "0"])
+        return {"stat": "ok", "date": days[t].strftime("%Y%m%d"),
+                "tables": [{"title": "上櫃股票行情", "fields": TPEX_FIELDS, "data": rows}]}
+
+    _write(os.path.join(root, "twse", "latest.json"), snapshot(T - 1))
+    for t in range(T - lookback, T):
+        _write(os.path.join(root, "twse", days[t].strftime("%Y%m%d") + ".json"), snapshot(t))
+    if n_tpex:
+        _write(os.path.join(root, "tpex", "latest.json"), tpex_snapshot(T - 1))
+        for t in range(T - lookback, T):
+            _write(os.path.join(root, "tpex", days[t].strftime("%Y%m%d") + ".json"), tpex_snapshot(t))
+
+    sectors = [f"Sector{i:02d}" for i in range(30)]
+    info = [{"industry_category": sectors[j % len(sectors)], "stock_id": c, "stock_name": f"S{c}",
+             "type": "twse" if j < n_codes else "tpex", "date": "2020-01-01"} for j, c in enumerate(codes)]
+    _write(os.path.join(root, "finmind", "TaiwanStockInfo", "all.json"), {"status": 200, "data": info})
+
+    sample = sorted(set([0] + brk + dec + list(rng.choice(range(N), 40, replace=False))))
+    for j in sample:
+        data = [{"date": days[t].isoformat(), "stock_id": codes[j], "Trading_Volume": int(vol[t, j]),
+                 "open": round(float(opn[t, j]), 2), "max": round(float(high[t, j]), 2),
+                 "min": round(float(low[t, j]), 2), "close": round(float(close[t, j]), 2)}
+                for t in range(T)]
+        _write(os.path.join(root, "finmind", "TaiwanStockPrice", f"{codes[j]}.json"),
+               {"status": 200, "data": data})
+
+    _write(os.path.join(root, "manifest.json"),
+           {"source": "synthetic", "seed": seed, "end": end.isoformat(), "codes": N, "tpex": n_tpex, "days": T})
+    print(f"[BENCH] synthetic fixtures: {N} codes x {T} days -> {root} ({fixture_hash(root)})")
+
+
+def record_fixtures(root: str = FIXTURE_DIR, lookback: int = 10):
+    """Record today's real TWSE / FinMind responses the way a daily run would request them."""
+    import scanner
+
+    if os.path.isdir(root):
+        shutil.rmtree(root)
+
+    def get_twse(date: str | None) -> dict | None:
+        params = {"response": "json"}
+        if date:
+            params["date"] = date
+        r = scanner.http_request("twse", "GET", scanner.TWSE_DAY_ALL, params=params)
+        return r.json() if r.status_code == 200 else None
+
+    latest = get_twse(None)
+    if not latest:
+        raise SystemExit("TWSE latest snapshot unavailable")
+    _write(os.path.join(root, "twse", "latest.json"), latest)
+
+    tpex = scanner._tpex_payload(None, 3)
+    if tpex:
+        _write(os.path.join(root, "tpex", "latest.json"), tpex)
+
+    d = dt.date.today()
+    for _ in range(lookback * 2):
+        j = get_twse(d.strftime("%Y%m%d"))
+        if j is not None:
+            _write(os.path.join(root, "twse", d.strftime("%Y%m%d") + ".json"), j)
+        j = scanner._tpex_payload(d.strftime("%Y%m%d"), 3)
+        if j is not None:
+            _write(os.path.join(root, "tpex", d.strftime("%Y%m%d") + ".json"), j)
+        d -= dt.timedelta(days=1)
+
+    start = (dt.date.today() - dt.timedelta(days=900)).isoformat()
+    end = dt.date.today().isoformat()
+    info = scanner._finmind_json("TaiwanStockInfo", "all", "2000-01-01", end)
+    _write(os.path.join(root, "finmind", "TaiwanStockInfo", "all.json"), info)
+
+    cand = scanner.load_today_candidates(scanner.pd.concat(
+        [scanner.parse_stock_day_all(latest), scanner.parse_tpex_daily(tpex or {})], ignore_index=True))
+    for code in [scanner.MARKET_PROXY] + cand["Code"].astype(str).tolist():
+        j = scanner._finmind_json("TaiwanStockPrice", code, start, end)
+        _write(os.path.join(root, "finmind", "TaiwanStockPrice", f"{code}.json"), j)
+
+    _write(os.path.join(root, "manifest.json"),
+           {"source": "recorded", "end": dt.date.today().isoformat(), "candidates": len(cand)})
+    print(f"[BENCH] recorded fixtures -> {root} ({fixture_hash(root)})")
+
+
+# =======================
+# Stand-in server (TWSE STOCK_DAY_ALL, TPEx daily quotes, FinMind v4 data, Telegram sendMessage)
+# =======================
+class StandIn:
+    """Serves fixtures with optional latency / 503 injection and counts traffic."""
+
+    def __init__(self, root: str = FIXTURE_DIR, latency_ms: float = 0.0, error_rate: float = 0.0,
+                 seed: int = 0, port: int = 0):
+        self.root = os.path.abspath(root)
+        self.latency = latency_ms / 1000.0
+        self.error_rate = error_rate
+        self.rng = np.random.default_rng(seed)
+        self.lock = threading.Lock()
+        self.cache: dict = {}
+        self.reset()
+        self.server = ThreadingHTTPServer(("127.0.0.1", port), self._handler())
+        self.server.daemon_threads = True
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}"
+
+    def reset(self):
+        with self.lock:
+            self.stats = {"requests": 0, "errors_injected": 0, "bytes": 0}
+
+    def start(self) -> "StandIn":
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def env(self) -> dict:
+        return {
+            "FINMIND_URL": self.url + "/api/v4/data",
+            "TWSE_DAY_ALL_URL": self.url + "/exchangeReport/STOCK_DAY_ALL",
+            "TPEX_DAILY_URL": self.url + "/www/zh-tw/afterTrading/dailyQuotes",
+            "TELEGRAM_API": self.url,
+        }
+
+    def _load(self, *parts) -> dict | None:
+        path = os.path.join(self.root, *parts)
+        if path not in self.cache:
+            try:
+                with open(path, "r", encoding="utf-8") as f:
+                    self.cache[path] = json.load(f)
+            except OSError:
+                self.cache[path] = None
+        return self.cache[path]
+
+    def respond(self, method: str, path: str, query: dict) -> tuple[int, dict]:
+        if method == "POST" and path.endswith("/sendMessage"):
+            return 200, {"ok": True}
+        if path.endswith("/STOCK_DAY_ALL"):
+            j = self._load("twse", (query.get("date") or "latest") + ".json")
+            return 200, j if j is not None else NO_DATA
+        if path.endswith("/dailyQuotes"):
+            j = self._load("tpex", (query.get("date") or "latest").replace("/", "") + ".json")
+            return 200, j if j is not None else TPEX_NO_DATA
+        if path.endswith("/data"):
+            ds, data_id = query.get("dataset", ""), query.get("data_id", "")
+            j = self._load("finmind", ds, f"{data_id}.json")
+            if j is None:
+                return 200, {"status": 200, "msg": "success", "data": []}
+            s, e = query.get("start_date", ""), query.get("end_date", "9999")
+            data = [x for x in j.get("data", []) if s <= str(x.get("date", s)) <= e] \
+                if ds == "TaiwanStockPrice" else j.get("data", [])
+            return 200, {"status": j.get("status", 200), "msg": "success", "data": data}
+        return 404, {"error": "unknown path"}
+
+    def _handler(self):
+        standin = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def _serve(self, method: str):
+                u = urllib.parse.urlparse(self.path)
+                query = dict(urllib.parse.parse_qsl(u.query))
+                n = int(self.headers.get("Content-Length") or 0)
+                if n:
+                    query.update(urllib.parse.parse_qsl(self.rfile.read(n).decode()))
+                if standin.latency:
+                    time.sleep(standin.latency)
+                with standin.lock:
+                    inject = standin.error_rate > 0 and standin.rng.random() < standin.error_rate
+                if inject:
+                    code, body = 503, {"error": "injected"}
+                else:
+                    code, body = standin.respond(method, u.path, query)
+                raw = json.dumps(body, ensure_ascii=False).encode("utf-8")
+                with standin.lock:
+                    standin.stats["requests"] += 1
+                    standin.stats["bytes"] += len(raw)
+                    standin.stats["errors_injected"] += int(inject)
+                self.send_response(code)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(raw)))
+                self.end_headers()
+                self.wfile.write(raw)
+
+            def do_GET(self):
+                self._serve("GET")
+
+            def do_POST(self):
+                self._serve("POST")
+
+        return Handler
+
+
+# =======================
+# Stages
+# =======================
+def _git_commit() -> str:
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], text=True,
+                                       cwd=os.path.dirname(os.path.abspath(__file__))).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def _fresh_scanner(data_dir: str, standin: StandIn):
+    """(Re)import scanner against the stand-in with an empty data dir and cold caches."""
+    os.environ.update(standin.env())
+    os.environ.update({"SCANNER_DATA_DIR": data_dir, "FINMIND_TOKEN": "bench",
+                       "TELEGRAM_BOT_TOKEN": "bench", "TELEGRAM_CHAT_ID": "bench"})
+    import scanner
+    return importlib.reload(scanner)
+
+
+def _measure(name: str, standin: StandIn, fn, repeat: int = 1, trace: bool = False) -> dict:
+    """One stage: wall time and HTTP counts, or (trace=True) tracemalloc peak only.
+    tracemalloc slows Python-heavy code several-fold, so the two never share a pass."""
+    standin.reset()
+    if trace:
+        tracemalloc.start()
+    t0 = time.perf_counter()
+    for _ in range(repeat):
+        fn()
+    wall = (time.perf_counter() - t0) / repeat
+    if trace:
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        return {"stage": name, "peak_mb": round(peak / 2 ** 20, 2)}
+    st = dict(standin.stats)
+    return {"stage": name, "wall_s": round(wall, 4), "requests": st["requests"] // repeat,
+            "bytes": st["bytes"] // repeat, "errors_injected": st["errors_injected"]}
+
+
+def _bench_pass(root: str, work: str, standin: StandIn, repeat: int, trace: bool) -> list:
+    # stage setup mirrors run(): latest snapshot + 0050 history give the store its calendar
+    sc = _fresh_scanner(os.path.join(work, "stages"), standin)
+    with open(os.path.join(root, "twse", "latest.json"), "r", encoding="utf-8") as f:
+        payload = json.load(f)
+    latest = sc.sync_latest_snapshot()
+    sc.market_above_ma60(dt.date.today())
+    sector_map = sc.load_sector_map()
+    cand = sc.load_today_candidates(latest)
+    if trace:
+        repeat = 1
+
+    def fetch_cold(fetch):
+        sc._twse_memo.clear()
+        shutil.rmtree(sc.TWSE_CACHE_DIR, ignore_errors=True)
+        fetch()
+
+    rows = [
+        _measure("parse_stock_day_all", standin, lambda: sc.parse_stock_day_all(payload), repeat, trace),
+        _measure("twse_fetch_day (cold)", standin,
+                 lambda: fetch_cold(lambda: sc.twse_fetch_day(None, max_retries=5)), 1, trace),
+        # every exchange, concurrently: should cost about the single-exchange fetch
+        _measure(f"fetch_day (cold, {'+'.join(sc.EXCHANGES)})", standin,
+                 lambda: fetch_cold(sc.fetch_day), 1, trace),
+        _measure("sector_score_for_day", standin,
+                 lambda: sc.sector_score_for_day(latest, sector_map), repeat, trace),
+        _measure("load_today_candidates", standin, lambda: sc.load_today_candidates(latest), repeat, trace),
+        _measure(f"check_one_stock x{len(cand)} (cold)", standin,
+                 lambda: [sc.check_one_stock(str(r["Code"]), r) for _, r in cand.iterrows()], 1, trace),
+        _measure("check_candidates (warm)", standin, lambda: sc.check_candidates(cand), repeat, trace),
+    ]
+    sc = _fresh_scanner(os.path.join(work, "run"), standin)
+
+    def run_delivered(force=True):
+        # run() only enqueues Telegram messages; flush so every stage counts its own requests.
+        # force: warm = warm caches, not the checkpoints of the previous pass
+        sc.run(force=force)
+        sc.telegram_flush()
+
+    rows.append(_measure("run() cold", standin, run_delivered, 1, trace))
+    rows.append(_measure("run() warm", standin, run_delivered, 1, trace))
+    rows.append(_measure("run() resumed", standin, lambda: run_delivered(force=False), 1, trace))
+    return rows
+
+
+def run_bench(root: str = FIXTURE_DIR, latency_ms: float = 0.0, error_rate: float = 0.0,
+              repeat: int = 5, out: str = BENCH_OUT) -> dict:
+    if not os.path.exists(os.path.join(root, "manifest.json")):
+        synth_fixtures(root)
+    with open(os.path.join(root, "manifest.json"), "r", encoding="utf-8") as f:
+        manifest = json.load(f)
+
+    root = os.path.abspath(root)
+    standin = StandIn(root, latency_ms=latency_ms, error_rate=error_rate).start()
+    work = tempfile.mkdtemp(prefix="scanner-bench-")
+    cwd = os.getcwd()
+    os.chdir(work)   # run() writes scanner_result.json into cwd
+    print(f"[BENCH] commit {_git_commit()} fixtures {manifest.get('source')} "
+          f"latency {latency_ms}ms errors {error_rate:.0%}")
+    try:
+        rows = _bench_pass(root, os.path.join(work, "time"), standin, repeat, trace=False)
+        peaks = _bench_pass(root, os.path.join(work, "mem"), standin, repeat, trace=True)
+        for row, mem in zip(rows, peaks):
+            row["peak_mb"] = mem["peak_mb"]
+            print(f"  {row['stage']:<28} {row['wall_s']:>9.4f}s {row['requests']:>6} req "
+                  f"{row['bytes'] / 2 ** 20:>8.2f} MB {row['peak_mb']:>8.2f} MB peak")
+    finally:
+        os.chdir(cwd)
+        standin.stop()
+        shutil.rmtree(work, ignore_errors=True)
+
+    result = {
+        "commit": _git_commit(),
+        "timestamp": dt.datetime.now().isoformat(timespec="seconds"),
+        "python": sys.version.split()[0],
+        "fixtures": {"hash": fixture_hash(root), **manifest},
+        "params": {"latency_ms": latency_ms, "error_rate": error_rate, "repeat": repeat},
+        "stages": rows,
+    }
+    with open(os.path.join(cwd, out), "w", encoding="utf-8") as f:
+        json.dump(result, f, ensure_ascii=False, indent=2)
+    print(f"[BENCH] results -> {out}")
+    return result
+
+
+# =======================
+# Micro-benchmarks
+# =======================
+def bench_parse(root: str = FIXTURE_DIR, repeat: int = 200) -> dict:
+    """
+    parse_stock_day_all (column parser) vs parse_stock_day_all_frame on the fixture snapshots:
+    best-of-repeat time per payload, and a check that both give the same frame.
+    """
+    import pandas as pd
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import scanner
+
+    twse = os.path.join(root, "twse")
+    if not os.path.isdir(twse):
+        synth_fixtures(root)
+    payloads = []
+    for fn in sorted(os.listdir(twse)):
+        with open(os.path.join(twse, fn), "r", encoding="utf-8") as f:
+            payloads.append(json.load(f))
+
+    def best(fn, j) -> float:
+        t = []
+        for _ in range(repeat):
+            t0 = time.perf_counter()
+            fn(j)
+            t.append(time.perf_counter() - t0)
+        return min(t)
+
+    new = [best(scanner.parse_stock_day_all, j) for j in payloads]
+    old = [best(scanner.parse_stock_day_all_frame, j) for j in payloads]
+    for j in payloads:
+        pd.testing.assert_frame_equal(scanner.parse_stock_day_all(j), scanner.parse_stock_day_all_frame(j),
+                                      check_dtype=False)
+
+    rows = int(np.mean([len(j.get("data", [])) for j in payloads]))
+    res = {"payloads": len(payloads), "rows": rows, "column_parser_ms": round(1e3 * float(np.median(new)), 3),
+           "frame_parser_ms": round(1e3 * float(np.median(old)), 3)}
+    res["speedup"] = round(res["frame_parser_ms"] / res["column_parser_ms"], 2)
+    print(f"[BENCH] parse {res['payloads']} payloads x ~{rows} rows: column parser {res['column_parser_ms']}ms, "
+          f"frame parser {res['frame_parser_ms']}ms ({res['speedup']}x), frames equal")
+    return res
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description="scanner.py benchmarks on recorded fixtures")
+    ap.add_argument("--fixtures", default=FIXTURE_DIR)
+    sub = ap.add_subparsers(dest="cmd", required=True)
+    sub.add_parser("synth", help="write deterministic synthetic fixtures")
+    sub.add_parser("record", help="record real API responses as fixtures")
+    p_run = sub.add_parser("run", help="run the benchmark stages")
+    p_run.add_argument("--latency-ms", type=float, default=0.0)
+    p_run.add_argument("--error-rate", type=float, default=0.0)
+    p_run.add_argument("--repeat", type=int, default=5)
+    p_run.add_argument("--out", default=BENCH_OUT)
+    p_serve = sub.add_parser("serve", help="run the stand-in server in the foreground")
+    p_serve.add_argument("--port", type=int, default=8765)
+    p_serve.add_argument("--latency-ms", type=float, default=0.0)
+    p_serve.add_argument("--error-rate", type=float, default=0.0)
+    p_parse = sub.add_parser("parse", help="micro-benchmark the STOCK_DAY_ALL parsers")
+    p_parse.add_argument("--repeat", type=int, default=200)
+    args = ap.parse_args()
+
+    if args.cmd == "synth":
+        synth_fixtures(args.fixtures)
+    elif args.cmd == "record":
+        record_fixtures(args.fixtures)
+    elif args.cmd == "parse":
+        bench_parse(args.fixtures, args.repeat)
+    elif args.cmd == "run":
+        run_bench(args.fixtures, args.latency_ms, args.error_rate, args.repeat, args.out)
+    else:
+        s = StandIn(args.fixtures, args.latency_ms, args.error_rate, port=args.port)
+        print("[BENCH] stand-in at", s.url, json.dumps(s.env()))
+        s.server.serve_forever()
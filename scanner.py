@@ -1,10 +1,21 @@
 print("=== SCANNER VERSION: 2025-12-31 v1 ===")
 
 import os
+import json
 import datetime as dt
 import requests
+import numpy as np
 import pandas as pd
 import time
+import threading
+import queue
+import atexit
+import bisect
+import contextlib
+import sqlite3
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
 
 
 # =======================
@@ -13,15 +24,23 @@ import time
 BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN", "")
 CHAT_ID = os.getenv("TELEGRAM_CHAT_ID", "")
 FINMIND_TOKEN = os.getenv("FINMIND_TOKEN", "")
+DATA_DIR = os.getenv("SCANNER_DATA_DIR", "data")   # local store (cached between Actions runs)
 
-FINMIND_URL = "https://api.finmindtrade.com/api/v4/data"
-TWSE_DAY_ALL = "https://www.twse.com.tw/exchangeReport/STOCK_DAY_ALL"
+# overridable so benchmarks / tests can point at a local stand-in server
+FINMIND_URL = os.getenv("FINMIND_URL", "https://api.finmindtrade.com/api/v4/data")
+TWSE_DAY_ALL = os.getenv("TWSE_DAY_ALL_URL", "https://www.twse.com.tw/exchangeReport/STOCK_DAY_ALL")
+TPEX_DAILY_URL = os.getenv("TPEX_DAILY_URL", "https://www.tpex.org.tw/www/zh-tw/afterTrading/dailyQuotes")
+TELEGRAM_API = os.getenv("TELEGRAM_API", "https://api.telegram.org")
+
+HTTP_MAX_WORKERS = int(os.getenv("HTTP_MAX_WORKERS", "8"))            # parallel history fetches
+FINMIND_RATE_PER_HOUR = float(os.getenv("FINMIND_RATE_PER_HOUR", "600"))  # FinMind quota (with token)
 
 # =======================
 # STRATEGY PARAMS
 # =======================
 MARKET_PROXY = "0050"
 MA60_WINDOW = 60
+MARKET_HISTORY_DAYS = 800   # calendar days of 0050 history for the MA60 check
 
 # Layer 2: 爆量長紅 (daily shape)  ✅ updated: 4% -> 3.5%
 MIN_CHG_PCT = 3.5
@@ -47,21 +66,423 @@ SECTOR_SCORE_UP_WEIGHT = 2.0
 SECTOR_MAIN_MIN_APPEAR = 3  # 5天內至少3天進Top5 => 主流族群
 
 
+# =======================
+# Metrics: stage spans, HTTP counters, row / funnel counts -> scanner_metrics.json
+# =======================
+METRICS_PATH = os.getenv("SCANNER_METRICS_PATH", "scanner_metrics.json")   # next to scanner_result.json
+SCANNER_PROFILE = os.getenv("SCANNER_PROFILE", "")   # "cprofile", "tracemalloc" or "cprofile,tracemalloc"
+PROFILE_PATH = "scanner_profile.prof"
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)   # sec, upper bounds (+ overflow)
+
+METRICS: dict = {}
+_metrics_lock = threading.Lock()
+
+
+def metrics_reset():
+    with _metrics_lock:
+        METRICS.clear()
+        METRICS.update(started=time.time(), t0=time.perf_counter(), stages=[], http={}, counts={},
+                       critical_path=[])
+
+
+metrics_reset()
+
+
+@contextlib.contextmanager
+def span(name: str):
+    """Time one stage of a run; recorded even when the stage raises."""
+    t = time.perf_counter()
+    ok = False
+    try:
+        yield
+        ok = True
+    finally:
+        end = time.perf_counter()
+        with _metrics_lock:
+            METRICS["stages"].append({"name": name, "start_s": round(t - METRICS["t0"], 4),
+                                      "wall_s": round(end - t, 4), "ok": ok})
+
+
+def metric_count(name: str, n: int = 1):
+    with _metrics_lock:
+        METRICS["counts"][name] = METRICS["counts"].get(name, 0) + int(n)
+
+
+def funnel_step(funnel: dict | None, name: str, ok) -> None:
+    """Add the rows still passing after one filter to an optional funnel dict."""
+    if funnel is not None:
+        funnel[name] = funnel.get(name, 0) + int(np.count_nonzero(ok))
+
+
+def http_observe(service: str, seconds: float | None, status: int | None, nbytes: int, retried: bool):
+    """One HTTP attempt (status None = connection error)."""
+    with _metrics_lock:
+        st = METRICS["http"].setdefault(service, {
+            "attempts": 0, "retries": 0, "errors": 0, "bytes": 0, "latency_s": 0.0,
+            "status": {}, "latency_hist": [0] * (len(LATENCY_BUCKETS) + 1),
+        })
+        st["attempts"] += 1
+        st["retries"] += int(retried)
+        st["bytes"] += nbytes
+        if status is None:
+            st["errors"] += 1
+        else:
+            st["status"][str(status)] = st["status"].get(str(status), 0) + 1
+        if seconds is not None:
+            st["latency_s"] += seconds
+            st["latency_hist"][bisect.bisect_left(LATENCY_BUCKETS, seconds)] += 1
+
+
+_profiler = None
+
+
+def profile_start():
+    """Start the captures named in SCANNER_PROFILE (no-op when unset)."""
+    global _profiler
+    modes = {x.strip().lower() for x in SCANNER_PROFILE.split(",") if x.strip()}
+    if "tracemalloc" in modes:
+        import tracemalloc
+        tracemalloc.start()
+    if "cprofile" in modes:
+        import cProfile
+        _profiler = cProfile.Profile()
+        _profiler.enable()
+
+
+def profile_stop() -> dict:
+    """Stop captures; cProfile stats go to PROFILE_PATH, summaries into the metrics file."""
+    global _profiler
+    out = {}
+    if _profiler is not None:
+        import io
+        import pstats
+        _profiler.disable()
+        _profiler.dump_stats(PROFILE_PATH)
+        buf = io.StringIO()
+        pstats.Stats(_profiler, stream=buf).sort_stats("cumulative").print_stats(25)
+        out["cprofile"] = {"path": PROFILE_PATH, "top_cumulative": buf.getvalue().splitlines()}
+        _profiler = None
+    import tracemalloc
+    if tracemalloc.is_tracing():
+        _, peak = tracemalloc.get_traced_memory()
+        top = tracemalloc.take_snapshot().statistics("lineno")[:15]
+        tracemalloc.stop()
+        out["tracemalloc"] = {"peak_mb": round(peak / 2 ** 20, 2), "top": [str(x) for x in top]}
+    return out
+
+
+def metrics_write(path: str = METRICS_PATH, **extra):
+    """Dump spans / counters (+ TWSE cache stats and anything in extra) as JSON; never raises."""
+    with _metrics_lock:
+        data = {
+            "started": dt.datetime.fromtimestamp(METRICS["started"]).isoformat(timespec="seconds"),
+            "total_s": round(time.perf_counter() - METRICS["t0"], 4),
+            "stages": list(METRICS["stages"]),
+            "critical_path": list(METRICS["critical_path"]),
+            "http": json.loads(json.dumps(METRICS["http"])),
+            "latency_buckets_s": list(LATENCY_BUCKETS),
+            "counts": dict(METRICS["counts"]),
+            "twse_cache": dict(TWSE_CACHE_STATS),
+        }
+    data.update(extra)
+    try:
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(data, f, ensure_ascii=False, indent=2)
+        print("[METRICS] written:", path)
+    except OSError as e:
+        print("[METRICS] write failed:", path, repr(e))
+
+
+# =======================
+# HTTP layer: pooled session, per-service retry/backoff, FinMind rate limit
+# =======================
+class TokenBucket:
+    """
+    Thread-safe token bucket: refills `rate` tokens/sec, banks at most `capacity`.
+    With `path`, the balance is saved at exit and restored (plus the refill since) on the
+    next run, so calls spent by one run still count against the next one's quota.
+    """
+
+    def __init__(self, rate: float, capacity: float, path: str | None = None):
+        self.rate = rate
+        self.capacity = max(capacity, 1.0)    # < 1 would never admit a call
+        self.tokens = self.capacity
+        self.t = time.monotonic()
+        self.lock = threading.Lock()
+        self.path = path
+        if path:
+            try:
+                with open(path, "r", encoding="utf-8") as f:
+                    j = json.load(f)
+                idle = max(time.time() - float(j["t"]), 0.0)
+                self.tokens = min(self.capacity, float(j["tokens"]) + idle * rate)
+            except (OSError, ValueError, KeyError, TypeError):
+                pass
+            atexit.register(self.save)
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.t) * self.rate)
+                self.t = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+    def save(self):
+        with self.lock:
+            tokens = min(self.capacity, self.tokens + (time.monotonic() - self.t) * self.rate)
+        _save_json(self.path, {"tokens": tokens, "t": time.time()})
+
+
+# service -> attempts / backoff base (sec, doubled per attempt) / optional rate limiter
+# FinMind: the whole hourly quota may go out at once (the worker fan-out); the bucket only
+# throttles once it runs low, across runs via DATA_DIR.
+HTTP_POLICY = {
+    "finmind": {"retries": 3, "backoff": 1.0,
+                "bucket": TokenBucket(FINMIND_RATE_PER_HOUR / 3600.0, FINMIND_RATE_PER_HOUR,
+                                      os.path.join(DATA_DIR, "finmind_quota.json"))},
+    "twse": {"retries": 3, "backoff": 0.8, "bucket": None},
+    "tpex": {"retries": 3, "backoff": 0.8, "bucket": None},
+    # one attempt: a retried POST may deliver twice; _telegram_post handles 429 retry_after itself
+    "telegram": {"retries": 1, "backoff": 1.0, "bucket": None},
+}
+
+_session = None
+_session_lock = threading.Lock()
+
+
+def http_session() -> requests.Session:
+    """One keep-alive session shared by every thread (pool sized for HTTP_MAX_WORKERS)."""
+    global _session
+    with _session_lock:
+        if _session is None:
+            s = requests.Session()
+            adapter = HTTPAdapter(pool_connections=4, pool_maxsize=max(HTTP_MAX_WORKERS, 4))
+            s.mount("https://", adapter)
+            s.mount("http://", adapter)
+            _session = s
+    return _session
+
+
+# run() stages (see Stages) hand their cancel event to every thread working for them;
+# http_request checks it before each attempt, so cancelled work stops at its next call.
+_stage_ctx = threading.local()
+
+
+class StageCancelled(BaseException):
+    """
+    Raised inside a cancelled stage. A BaseException (like KeyboardInterrupt) so the
+    `except Exception` fallbacks, e.g. TWSE "no data", don't turn it into a result.
+    """
+
+
+def _stage_sleep(seconds: float):
+    """time.sleep that a cancelled stage wakes from (raising StageCancelled)."""
+    ev = getattr(_stage_ctx, "cancelled", None)
+    if ev is None:
+        time.sleep(seconds)
+    elif ev.is_set() or ev.wait(seconds):
+        raise StageCancelled()
+
+
+def http_request(service: str, method: str, url: str, retries: int | None = None, **kwargs) -> requests.Response:
+    """
+    Send through the shared session under the service's policy.
+    Connection errors, 429 and 5xx are retried with exponential backoff (Retry-After wins);
+    any other response is returned as-is. After the last attempt the final response is
+    returned, or the final exception raised.
+    """
+    policy = HTTP_POLICY[service]
+    attempts = retries if retries is not None else policy["retries"]
+    kwargs.setdefault("timeout", 30)
+
+    for attempt in range(1, attempts + 1):
+        _stage_sleep(0)                     # cancelled stage: stop before the next attempt
+        if policy["bucket"] is not None:
+            policy["bucket"].acquire()
+
+        delay = policy["backoff"] * (2 ** (attempt - 1))
+        t = time.perf_counter()
+        try:
+            r = http_session().request(method, url, **kwargs)
+        except requests.RequestException as e:
+            http_observe(service, None, None, 0, attempt > 1)
+            if attempt == attempts:
+                raise
+            print(f"[HTTP] {service} error, retry {attempt}/{attempts - 1}:", repr(e))
+            _stage_sleep(delay)
+            continue
+
+        http_observe(service, time.perf_counter() - t, r.status_code, len(r.content), attempt > 1)
+        if r.status_code != 429 and r.status_code < 500:
+            return r
+        if attempt == attempts:
+            return r
+
+        ra = r.headers.get("Retry-After", "")
+        if ra.isdigit():
+            delay = min(float(ra), 60.0)
+        print(f"[HTTP] {service} status {r.status_code}, retry {attempt}/{attempts - 1} in {delay:.1f}s")
+        _stage_sleep(delay)
+
+    raise RuntimeError("unreachable")
+
+
+def parallel_map(fn, items, max_workers: int = HTTP_MAX_WORKERS) -> list:
+    """map() over a bounded thread pool (I/O bound work); keeps input order."""
+    items = list(items)
+    if len(items) <= 1 or max_workers <= 1:
+        return [fn(x) for x in items]
+    cancelled = getattr(_stage_ctx, "cancelled", None)
+
+    def call(x):
+        _stage_ctx.cancelled = cancelled      # workers stop with the stage that started them
+        return fn(x)
+
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(items))) as ex:
+        return list(ex.map(call, items))
+
+
 # =======================
 # Utils
 # =======================
+def _save_json(path: str, obj):
+    """Atomic JSON write under DATA_DIR; failures are logged, never raised."""
+    try:
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with open(path + ".tmp", "w", encoding="utf-8") as f:
+            json.dump(obj, f, ensure_ascii=False)
+        os.replace(path + ".tmp", path)
+    except OSError as e:
+        print("[DATA] write failed:", path, repr(e))
+
+
+# Telegram goes through a background dispatcher: send_telegram only enqueues, so the scan
+# never waits on a round-trip. Queued messages are packed into as few sendMessage calls
+# as fit the size limit and flushed at exit.
+TELEGRAM_MAX_CHARS = 4000     # Bot API limit is 4096 (UTF-16 units); keep some headroom
+TELEGRAM_LINGER = 0.2         # sec to let back-to-back messages join one batch
+TELEGRAM_MAX_429 = 5          # extra tries on 429 (waits parameters.retry_after)
+
+_tg_queue: queue.Queue = queue.Queue()
+_tg_thread = None
+_tg_lock = threading.Lock()
+
+
 def send_telegram(text: str):
     if not BOT_TOKEN or not CHAT_ID:
         print("Telegram env missing; skip sending.")
         return
-    url = f"https://api.telegram.org/bot{BOT_TOKEN}/sendMessage"
-    r = requests.post(url, data={"chat_id": CHAT_ID, "text": text}, timeout=30)
-    print("Telegram status:", r.status_code)
+    with _tg_lock:
+        global _tg_thread
+        if _tg_thread is None:
+            _tg_thread = threading.Thread(target=_telegram_worker, name="telegram", daemon=True)
+            _tg_thread.start()
+    _tg_queue.put(text)
+
+
+def telegram_flush(timeout: float = 120.0):
+    """Deliver everything queued and stop the dispatcher (no-op if idle; restarts on next send)."""
+    global _tg_thread
+    with _tg_lock:
+        t, _tg_thread = _tg_thread, None
+    if t is None:
+        return
+    _tg_queue.put(None)
+    t.join(timeout)
+    if t.is_alive():
+        print("[Telegram] flush timed out; unsent messages dropped")
+
+
+atexit.register(telegram_flush)
+
+
+def _tg_len(s: str) -> int:
+    return len(s.encode("utf-16-le")) // 2
+
+
+def _tg_split(text: str, limit: int) -> list[str]:
+    """One message -> parts <= limit, cut on line breaks (over-long lines cut hard)."""
+    if _tg_len(text) <= limit:
+        return [text]
+    parts, cur = [], ""
+    for line in text.split("\n"):
+        while _tg_len(line) > limit:
+            if cur:
+                parts.append(cur)
+                cur = ""
+            parts.append(line[:limit // 2])
+            line = line[limit // 2:]
+        joined = f"{cur}\n{line}" if cur else line
+        if _tg_len(joined) <= limit:
+            cur = joined
+        else:
+            parts.append(cur)
+            cur = line
+    if cur:
+        parts.append(cur)
+    return parts
+
+
+def telegram_batches(texts: list[str], limit: int = TELEGRAM_MAX_CHARS) -> list[str]:
+    """Queued messages, in order, packed into as few <= limit chunks as possible."""
+    out, cur = [], ""
+    for text in texts:
+        for part in _tg_split(text, limit):
+            joined = f"{cur}\n\n{part}" if cur else part
+            if _tg_len(joined) <= limit:
+                cur = joined
+            else:
+                out.append(cur)
+                cur = part
+    if cur:
+        out.append(cur)
+    return out
+
+
+def _telegram_worker():
+    while True:
+        batch = [_tg_queue.get()]
+        if batch[0] is not None:
+            time.sleep(TELEGRAM_LINGER)
+        while True:
+            try:
+                batch.append(_tg_queue.get_nowait())
+            except queue.Empty:
+                break
+        for chunk in telegram_batches([x for x in batch if x is not None]):
+            _telegram_post(chunk)
+        if None in batch:
+            return
+
+
+def _telegram_post(text: str):
+    """sendMessage on the pooled session; 429 waits retry_after. Never raises (runs off-thread)."""
+    url = f"{TELEGRAM_API}/bot{BOT_TOKEN}/sendMessage"
+    for attempt in range(TELEGRAM_MAX_429 + 1):
+        try:
+            r = http_request("telegram", "POST", url, data={"chat_id": CHAT_ID, "text": text}, timeout=30)
+        except requests.RequestException as e:
+            print("[Telegram] send failed:", repr(e))
+            return
+        print("Telegram status:", r.status_code)
+        if r.status_code != 429 or attempt == TELEGRAM_MAX_429:
+            break
+        try:
+            wait = float(r.json().get("parameters", {}).get("retry_after", 1))
+        except (ValueError, AttributeError):
+            wait = 1.0
+        print(f"[Telegram] rate limited, retry in {wait:.0f}s")
+        time.sleep(min(wait, 60.0))
     if r.status_code != 200:
         print("Telegram response:", r.text)
 
 
-def finmind_get(dataset: str, data_id: str, start_date: str, end_date: str) -> pd.DataFrame:
+def _finmind_json(dataset: str, data_id: str, start_date: str, end_date: str) -> dict:
     if not FINMIND_TOKEN:
         raise RuntimeError("Missing FINMIND_TOKEN")
     headers = {"Authorization": f"Bearer {FINMIND_TOKEN}"}
@@ -71,33 +492,81 @@ def finmind_get(dataset: str, data_id: str, start_date: str, end_date: str) -> p
         "start_date": start_date,
         "end_date": end_date,
     }
-    r = requests.get(FINMIND_URL, headers=headers, params=params, timeout=30)
+    r = http_request("finmind", "GET", FINMIND_URL, headers=headers, params=params, timeout=30)
     j = r.json()
     print(f"FinMind status: {j.get('status')} dataset: {dataset} data_id: {data_id}")
-    if j.get("status") != 200:
-        return pd.DataFrame()
-    return pd.DataFrame(j.get("data", []))
+    return j
 
 
-def get_price_history(stock_id: str, start: dt.date, end: dt.date) -> pd.DataFrame:
-    df = finmind_get("TaiwanStockPrice", stock_id, start.strftime("%Y-%m-%d"), end.strftime("%Y-%m-%d"))
+def _finmind_price(stock_id: str, start: dt.date, end: dt.date) -> pd.DataFrame | None:
+    """
+    FinMind TaiwanStockPrice for [start, end], typed and sorted.
+    Returns None on API failure (so the store does not mark the range as synced).
+    """
+    try:
+        j = _finmind_json("TaiwanStockPrice", stock_id, start.strftime("%Y-%m-%d"), end.strftime("%Y-%m-%d"))
+    except (requests.RequestException, ValueError) as e:
+        print("[FinMind] price fetch failed:", repr(e), "data_id:", stock_id)
+        return None
+    if j.get("status") != 200:
+        return None
+    df = pd.DataFrame(j.get("data", []))
     if df.empty:
         return df
     df["date"] = pd.to_datetime(df["date"])
-    for c in ["open", "max", "min", "close", "Trading_Volume"]:
+    for c in PRICE_COLS:
         df[c] = pd.to_numeric(df[c], errors="coerce")
-    df = df.dropna(subset=["date", "open", "max", "min", "close", "Trading_Volume"]).sort_values("date")
+    df = df.dropna(subset=["date"] + PRICE_COLS).sort_values("date")
     return df
 
 
+def get_price_history(stock_id: str, start: dt.date, end: dt.date) -> pd.DataFrame:
+    """
+    Daily bars for [start, end], read from the local store first.
+    Only the missing head / tail is fetched from FinMind and appended to the store.
+    """
+    hist, synced_from, synced_through = store_load(stock_id)
+
+    new_from = synced_from
+    new_through = synced_through
+    fetched = []
+
+    # head: never fetched, or asked for earlier dates than we hold
+    if synced_from is None or start < synced_from:
+        head_end = end if synced_from is None else synced_from - dt.timedelta(days=1)
+        df = _finmind_price(stock_id, start, head_end)
+        if df is not None:
+            fetched.append(df)
+            new_from = start
+            if synced_through is None:
+                new_through = _synced_upto(df, head_end)
+
+    # tail: everything after the last synced day
+    if new_through is not None and end > new_through:
+        df = _finmind_price(stock_id, new_through + dt.timedelta(days=1), end)
+        if df is not None:
+            fetched.append(df)
+            new_through = max(new_through, _synced_upto(df, end))
+
+    if fetched:
+        hist = store_write(stock_id, pd.concat(fetched, ignore_index=True), new_from, new_through)
+
+    if hist.empty:
+        return pd.DataFrame()
+    ts_start, ts_end = pd.Timestamp(start), pd.Timestamp(end)
+    out = hist[(hist["date"] >= ts_start) & (hist["date"] <= ts_end)].copy()
+    out["stock_id"] = stock_id
+    return out.reset_index(drop=True)
+
+
 def market_above_ma60(asof: dt.date) -> tuple[bool, str]:
     """Use 0050 close > MA60 on/asof date."""
-    start = asof - dt.timedelta(days=800)
-    df = get_price_history(MARKET_PROXY, start, asof)
-    if df.empty or len(df) < (MA60_WINDOW + 1):
+    start = asof - dt.timedelta(days=MARKET_HISTORY_DAYS)
+    ind = indicators_asof([MARKET_PROXY], asof, start, include_asof=True)
+    if ind["n_bars"][0] < (MA60_WINDOW + 1):
         return False, "Not enough 0050 history for MA60"
-    ma60 = df["close"].rolling(MA60_WINDOW).mean().iloc[-1]
-    close = float(df["close"].iloc[-1])
+    ma60 = ind[f"ma{MA60_WINDOW}"][0]
+    close = float(ind["last_close"][0])
     if pd.isna(ma60):
         return False, "MA60 is NaN"
     ok = close > float(ma60)
@@ -108,360 +577,1847 @@ def market_above_ma60(asof: dt.date) -> tuple[bool, str]:
 # =======================
 # TWSE fetch (daily snapshot)
 # =======================
+TWSE_CACHE_DIR = os.path.join(DATA_DIR, "twse")
+TWSE_LATEST_TTL = int(os.getenv("TWSE_LATEST_TTL", "600"))   # sec; "latest" / today's snapshot
+
+_twse_memo: dict[str, tuple[float, pd.DataFrame, bool]] = {}    # key -> (fetched at, frame, final)
+_twse_failed: set = set()      # keys whose last fetch failed (network / HTTP), this process
+_twse_lock = threading.Lock()
+TWSE_CACHE_STATS = {"memo_hit": 0, "disk_hit": 0, "miss": 0}
+
+
 def twse_fetch_day(date_yyyymmdd: str | None = None, max_retries: int = 3) -> pd.DataFrame:
     """
     Fetch TWSE STOCK_DAY_ALL.
     - If date_yyyymmdd is None: latest available
     - If date_yyyymmdd provided (YYYYMMDD): request that date
 
+    Caching:
+    - In-process memo of the parsed frame + raw payload and its fetch time on disk (DATA_DIR/twse/<key>.json)
+    - A past date's snapshot is final (never refetched) once it answers for that date or was
+      fetched after it; "latest" and anything else expire after TWSE_LATEST_TTL
+
     Robustness:
-    - Retry on 5xx / transient network errors
-    - Never raise; on failure returns empty DataFrame
+    - Retry on 5xx / 429 / transient network errors (shared http_request policy)
+    - Never raise; on failure returns empty DataFrame (failures and no-data answers are not cached on disk)
+    """
+    return _snapshot_cached(date_yyyymmdd or "latest", date_yyyymmdd,
+                            lambda: _twse_payload(date_yyyymmdd, max_retries),
+                            lambda j: parse_stock_day_all(j, date_yyyymmdd))
+
+
+def _snapshot_final(date_yyyymmdd: str | None, df: pd.DataFrame, fetched: float) -> bool:
+    """
+    A dated answer no longer changes once it is that day's own snapshot, or was fetched
+    after that day (a holiday answered with the session before). An answer fetched on the
+    day itself may be another session's, from before publication.
+    """
+    if not date_yyyymmdd or df.empty:
+        return False
+    d = dt.datetime.strptime(date_yyyymmdd, "%Y%m%d").date()
+    return _snapshot_date(df) == d or dt.date.fromtimestamp(fetched) > d
+
+
+def _snapshot_cached(key: str, date_yyyymmdd: str | None, payload, parse) -> pd.DataFrame:
     """
+    Memo + disk cache shared by the exchange snapshot sources (key = file name under
+    TWSE_CACHE_DIR): payload() -> raw JSON or None on failure, parse(raw) -> frame.
+    """
+    with _twse_lock:
+        hit = _twse_memo.get(key)
+        if hit is not None and (hit[2] or time.time() - hit[0] < TWSE_LATEST_TTL):
+            TWSE_CACHE_STATS["memo_hit"] += 1
+            return hit[1].copy()
+
+    cached = _twse_disk_get(key)
+    if cached is not None:
+        fetched, j = cached
+        df = parse(j)
+        final = _snapshot_final(date_yyyymmdd, df, fetched)
+        if not final and time.time() - fetched >= TWSE_LATEST_TTL:
+            cached = None
+    if cached is not None:
+        with _twse_lock:
+            TWSE_CACHE_STATS["disk_hit"] += 1
+    else:
+        with _twse_lock:
+            TWSE_CACHE_STATS["miss"] += 1
+        j = payload()
+        with _twse_lock:
+            if j is None:
+                _twse_failed.add(key)
+            else:
+                _twse_failed.discard(key)
+        if j is None:
+            return pd.DataFrame()
+        fetched = time.time()
+        df = parse(j)
+        final = _snapshot_final(date_yyyymmdd, df, fetched)
+        if not df.empty:
+            _twse_disk_put(key, j, fetched)
+
+    with _twse_lock:
+        _twse_memo[key] = (fetched, df, final)
+    return df.copy()
+
+
+def _twse_disk_get(key: str) -> tuple[float, dict] | None:
+    """(fetch time, raw payload); payloads cached without one count as fetched at their mtime."""
+    path = os.path.join(TWSE_CACHE_DIR, f"{key}.json")
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            j = json.load(f)
+        if isinstance(j, dict) and set(j) == {"fetched", "payload"}:
+            return float(j["fetched"]), j["payload"]
+        return os.path.getmtime(path), j
+    except (OSError, ValueError, TypeError):
+        return None
+
+
+def _twse_disk_put(key: str, j: dict, fetched: float):
+    _save_json(os.path.join(TWSE_CACHE_DIR, f"{key}.json"), {"fetched": fetched, "payload": j})
+
+
+def twse_cache_report() -> str:
+    st = TWSE_CACHE_STATS
+    total = st["memo_hit"] + st["disk_hit"] + st["miss"]
+    return (f"[TWSE cache] requests={total} memo_hit={st['memo_hit']} "
+            f"disk_hit={st['disk_hit']} miss={st['miss']}")
+
+
+def _twse_payload(date_yyyymmdd: str | None, max_retries: int) -> dict | None:
+    """Raw STOCK_DAY_ALL JSON, or None on network / HTTP failure."""
     params = {"response": "json"}
     if date_yyyymmdd:
         params["date"] = date_yyyymmdd
 
-    last_err = None
-    for attempt in range(1, max_retries + 1):
-        try:
-            r = requests.get(TWSE_DAY_ALL, params=params, timeout=30)
-            print("TWSE status:", r.status_code, "date:", date_yyyymmdd or "latest", "attempt:", attempt)
-
-            # 2xx OK
-            if 200 <= r.status_code < 300:
-                j = r.json()
-
-                # 有時候 TWSE 回傳 stat != OK 或缺 data
-                if isinstance(j, dict) and j.get("stat") not in (None, "OK"):
-                    print("[TWSE] stat not OK:", j.get("stat"), "date:", date_yyyymmdd or "latest")
-                    return pd.DataFrame()
-
-                if "data" not in j:
-                    return pd.DataFrame()
-
-                if "fields" in j:
-                    cols = j["fields"]
-                    df = pd.DataFrame(j["data"], columns=cols)
-                else:
-                    df = pd.DataFrame(j["data"])
-
-                rename_map = {
-                    "日期": "Date",
-                    "證券代號": "Code",
-                    "證券名稱": "Name",
-                    "成交股數": "TradeVolume",
-                    "成交金額": "TradeValue",
-                    "開盤價": "OpeningPrice",
-                    "最高價": "HighestPrice",
-                    "最低價": "LowestPrice",
-                    "收盤價": "ClosingPrice",
-                    "漲跌價差": "Change",
-                    "成交筆數": "Transaction",
-                }
-                df = df.rename(columns=rename_map)
-
-                keep = [c for c in ["Date", "Code", "Name", "TradeVolume", "TradeValue",
-                                    "OpeningPrice", "HighestPrice", "LowestPrice", "ClosingPrice",
-                                    "Change", "Transaction"] if c in df.columns]
-                df = df[keep].copy()
-
-                for c in ["TradeVolume", "TradeValue", "OpeningPrice", "HighestPrice", "LowestPrice", "ClosingPrice"]:
-                    if c in df.columns:
-                        df[c] = (
-                            df[c].astype(str)
-                            .str.replace(",", "", regex=False)
-                            .replace("--", None)
-                        )
-                        df[c] = pd.to_numeric(df[c], errors="coerce")
-
-                if "Code" in df.columns:
-                    df["Code"] = df["Code"].astype(str).str.strip()
-                    df = df[df["Code"].str.match(r"^\d{4}$", na=False)]
-
-                # 沒資料就回空
-                if df.empty:
-                    return pd.DataFrame()
-
-                # 過濾有效列
-                need_cols = ["OpeningPrice", "HighestPrice", "LowestPrice", "ClosingPrice", "TradeVolume"]
-                existing_need = [c for c in need_cols if c in df.columns]
-                if existing_need:
-                    df = df.dropna(subset=existing_need)
-
-                return df
-
-            # 4xx（通常是參數/日期問題）直接放棄，不重試
-            if 400 <= r.status_code < 500:
-                print("[TWSE] client error, skip:", r.status_code, "date:", date_yyyymmdd or "latest")
-                return pd.DataFrame()
-
-            # 5xx：重試
-            last_err = RuntimeError(f"TWSE {r.status_code}")
-
-        except Exception as e:
-            last_err = e
-
-        # 簡單 backoff
-        time.sleep(0.8 * attempt)
-
-    print("[TWSE] failed after retries:", repr(last_err), "date:", date_yyyymmdd or "latest")
-    return pd.DataFrame()
+    try:
+        r = http_request("twse", "GET", TWSE_DAY_ALL, retries=max_retries, params=params, timeout=30)
+        print("TWSE status:", r.status_code, "date:", date_yyyymmdd or "latest")
+
+        # 4xx（通常是參數/日期問題）直接放棄（http_request 不重試）
+        if 400 <= r.status_code < 500:
+            print("[TWSE] client error, skip:", r.status_code, "date:", date_yyyymmdd or "latest")
+            return None
+
+        # 5xx：http_request 已重試完
+        if not (200 <= r.status_code < 300):
+            raise RuntimeError(f"TWSE {r.status_code}")
+
+        return r.json()
+    except Exception as e:
+        print("[TWSE] failed after retries:", repr(e), "date:", date_yyyymmdd or "latest")
+        return None
+
+
+TWSE_FIELDS = {
+    "日期": "Date",
+    "證券代號": "Code",
+    "證券名稱": "Name",
+    "成交股數": "TradeVolume",
+    "成交金額": "TradeValue",
+    "開盤價": "OpeningPrice",
+    "最高價": "HighestPrice",
+    "最低價": "LowestPrice",
+    "收盤價": "ClosingPrice",
+    "漲跌價差": "Change",
+    "成交筆數": "Transaction",
+}
+TWSE_COLS = ["Date", "Code", "Name", "TradeVolume", "TradeValue",
+             "OpeningPrice", "HighestPrice", "LowestPrice", "ClosingPrice", "Change", "Transaction"]
+TWSE_NUMERIC = ["TradeVolume", "TradeValue", "OpeningPrice", "HighestPrice", "LowestPrice", "ClosingPrice"]
+TWSE_INT_COLS = ("TradeVolume", "TradeValue")
+TWSE_NEED = ["OpeningPrice", "HighestPrice", "LowestPrice", "ClosingPrice", "TradeVolume"]
+
+
+def parse_stock_day_all(j: dict, date_yyyymmdd: str | None = None) -> pd.DataFrame:
+    """
+    STOCK_DAY_ALL payload -> typed frame (Code/Name/prices/volume), 4-digit codes only.
+    fields + list rows (the normal payload) are converted column by column straight into
+    NumPy arrays; anything else falls back to parse_stock_day_all_frame.
+    """
+    # 有時候 TWSE 回傳 stat != OK 或缺 data
+    if isinstance(j, dict) and j.get("stat") not in (None, "OK"):
+        print("[TWSE] stat not OK:", j.get("stat"), "date:", date_yyyymmdd or "latest")
+        return pd.DataFrame()
+
+    if "data" not in j:
+        return pd.DataFrame()
+
+    fields = [TWSE_FIELDS.get(f, f) for f in j.get("fields") or []]
+    if "Code" in fields and all(isinstance(r, (list, tuple)) and len(r) == len(fields) for r in j["data"]):
+        df = _parse_stock_day_all_columns(j, fields)
+    else:
+        df = parse_stock_day_all_frame(j)
+
+    metric_count("twse.rows_raw", len(j["data"]))
+    metric_count("twse.rows_parsed", len(df))
+    return df
+
+
+def _twse_float(x) -> float:
+    try:
+        return float(x.replace(",", "") if isinstance(x, str) else x)
+    except (TypeError, ValueError):         # "--", "", None
+        return float("nan")
+
+
+def _twse_floats(col) -> np.ndarray:
+    """One payload column -> float64 (thousands separators stripped, "--" -> NaN)."""
+    try:
+        return np.array([np.nan if x == "--" else float(x.replace(",", "")) for x in col], dtype=np.float64)
+    except (AttributeError, TypeError, ValueError):
+        return np.array([_twse_float(x) for x in col], dtype=np.float64)
+
+
+def _parse_stock_day_all_columns(j: dict, fields: list[str]) -> pd.DataFrame:
+    """
+    Payload rows -> typed columns without a frame of strings: transpose once, convert each
+    column in one comprehension, then keep 4-digit codes with complete prices / volume.
+    Volume / value come out int64 (value stays float64 if a kept row lacks it).
+    """
+    pos = {c: i for i, c in enumerate(fields)}
+    if not j["data"]:
+        return pd.DataFrame()
+    cols = list(zip(*j["data"]))
+
+    codes = np.array([str(x).strip() for x in cols[pos["Code"]]], dtype=object)
+    ok = np.array([len(x) == 4 and x.isdecimal() for x in codes], dtype=bool)
+    # 沒資料就回空
+    if not ok.any():
+        return pd.DataFrame()
+
+    num = {c: _twse_floats(cols[pos[c]]) for c in TWSE_NUMERIC if c in pos}
+    for c in TWSE_NEED:
+        if c in num:
+            ok &= ~np.isnan(num[c])
+    idx = np.flatnonzero(ok)
+
+    out = {}
+    for c in TWSE_COLS:
+        if c == "Code":
+            out[c] = codes[idx]
+        elif c in num:
+            a = num[c][idx]
+            out[c] = a.astype(np.int64) if c in TWSE_INT_COLS and not np.isnan(a).any() else a
+        elif c in pos:
+            out[c] = np.array(cols[pos[c]], dtype=object)[idx]
+        elif c == "Date" and j.get("date"):
+            out[c] = np.full(len(idx), str(j["date"]), dtype=object)
+    return pd.DataFrame(out, index=pd.Index(idx, dtype=np.int64))
+
+
+def parse_stock_day_all_frame(j: dict) -> pd.DataFrame:
+    """DataFrame-first parse (dict rows / missing fields); reference for the row parser."""
+    if "fields" in j:
+        cols = j["fields"]
+        df = pd.DataFrame(j["data"], columns=cols)
+    else:
+        df = pd.DataFrame(j["data"])
+
+    df = df.rename(columns=TWSE_FIELDS)
+    if "Date" not in df.columns and j.get("date"):
+        df["Date"] = str(j["date"])
+
+    keep = [c for c in TWSE_COLS if c in df.columns]
+    df = df[keep].copy()
+
+    for c in TWSE_NUMERIC:
+        if c in df.columns:
+            df[c] = (
+                df[c].astype(str)
+                .str.replace(",", "", regex=False)
+                .replace("--", None)
+            )
+            df[c] = pd.to_numeric(df[c], errors="coerce")
+
+    if "Code" in df.columns:
+        df["Code"] = df["Code"].astype(str).str.strip()
+        df = df[df["Code"].str.match(r"^\d{4}$", na=False)]
+
+    # 沒資料就回空
+    if df.empty:
+        return pd.DataFrame()
+
+    # 過濾有效列
+    existing_need = [c for c in TWSE_NEED if c in df.columns]
+    if existing_need:
+        df = df.dropna(subset=existing_need)
+
+    return df
+
 
 def find_recent_trade_days(n: int, max_lookback_days: int = 30) -> list[str]:
     """
-    Find recent TWSE trade dates (YYYYMMDD) by probing backwards.
-    Returns list of date strings (most recent first).
+    Recent TWSE trade dates (YYYYMMDD), most recent first.
+    Served by the trading calendar; only days after its known range are probed
+    (normally just today). Falls back to probing backwards when there is no calendar.
+    A probed day counts only if TWSE answers with that day's own snapshot: holidays and
+    unpublished days may get another session's.
     """
+    today = dt.date.today()
+    kt = calendar_known_through()
+    if kt is not None and len(trade_calendar_dates()) >= n and (today - kt).days <= max_lookback_days:
+        d = kt + dt.timedelta(days=1)
+        while d <= today:
+            if _snapshot_date(twse_fetch_day(d.strftime("%Y%m%d"))) == d:
+                calendar_extend([d])
+            d += dt.timedelta(days=1)
+        calendar_extend([], known_through=today - dt.timedelta(days=1))
+        return [x.strftime("%Y%m%d") for x in last_trade_days(n, today)]
+
     out: list[str] = []
-    d = dt.date.today()
+    d = today
     tries = 0
 
     while len(out) < n and tries < max_lookback_days:
         yyyymmdd = d.strftime("%Y%m%d")
 
         df = twse_fetch_day(yyyymmdd)
-        if df is not None and not df.empty:
+        if df is not None and _snapshot_date(df) == d:
             out.append(yyyymmdd)
 
         d -= dt.timedelta(days=1)
         tries += 1
 
+    found = [dt.datetime.strptime(x, "%Y%m%d").date() for x in out]
+    if kt is None and found:
+        calendar_extend(found, known_through=today - dt.timedelta(days=1))
+    else:
+        calendar_extend(found)
     return out
 
 
 # =======================
-# Sector mapping & 5-day main sectors
+# TPEx fetch (daily snapshot of OTC stocks)
 # =======================
-def load_sector_map() -> dict:
-    info = finmind_get("TaiwanStockInfo", "all", "2000-01-01", dt.date.today().strftime("%Y-%m-%d"))
-    if info.empty:
-        return {}
-
-    candidates = ["industry_category", "industry", "category", "type"]
-    pick = None
-    for c in candidates:
-        if c in info.columns:
-            pick = c
-            break
+TPEX_FIELDS = {
+    "代號": "Code",
+    "名稱": "Name",
+    "收盤": "ClosingPrice",
+    "漲跌": "Change",
+    "開盤": "OpeningPrice",
+    "最高": "HighestPrice",
+    "最低": "LowestPrice",
+    "成交股數": "TradeVolume",
+    "成交金額(元)": "TradeValue",
+    "成交筆數": "Transaction",
+}
+
+
+def tpex_fetch_day(date_yyyymmdd: str | None = None, max_retries: int = 3) -> pd.DataFrame:
+    """TPEx daily quotes in the same columns as twse_fetch_day (same caching, never raises)."""
+    return _snapshot_cached("tpex-" + (date_yyyymmdd or "latest"), date_yyyymmdd,
+                            lambda: _tpex_payload(date_yyyymmdd, max_retries),
+                            lambda j: parse_tpex_daily(j, date_yyyymmdd))
+
+
+def _tpex_payload(date_yyyymmdd: str | None, max_retries: int) -> dict | None:
+    """Raw daily quotes JSON, or None on network / HTTP failure."""
+    params = {"response": "json"}
+    if date_yyyymmdd:
+        params["date"] = f"{date_yyyymmdd[:4]}/{date_yyyymmdd[4:6]}/{date_yyyymmdd[6:]}"
+    try:
+        r = http_request("tpex", "GET", TPEX_DAILY_URL, retries=max_retries, params=params, timeout=30)
+        print("TPEx status:", r.status_code, "date:", date_yyyymmdd or "latest")
+        if 400 <= r.status_code < 500:
+            print("[TPEx] client error, skip:", r.status_code, "date:", date_yyyymmdd or "latest")
+            return None
+        if not (200 <= r.status_code < 300):
+            raise RuntimeError(f"TPEx {r.status_code}")
+        return r.json()
+    except Exception as e:
+        print("[TPEx] failed after retries:", repr(e), "date:", date_yyyymmdd or "latest")
+        return None
 
-    if not pick:
-        non = [c for c in info.columns if c not in ["stock_id", "date"]]
-        pick = non[0] if non else None
 
-    sector_map = {}
-    if pick and "stock_id" in info.columns:
-        for _, r in info.iterrows():
-            sid = str(r["stock_id"]).strip()
-            sec = str(r.get(pick, "Unknown")).strip()
-            if sid and sid.isdigit():
-                sector_map[sid] = sec if sec else "Unknown"
-    return sector_map
+def _yyyymmdd(x) -> str | None:
+    """20260105 / 2026/01/05 / ROC 115/01/05 -> "20260105"."""
+    s = "".join(ch for ch in str(x or "") if ch.isdigit())
+    if len(s) == 8:
+        return s
+    if len(s) == 7:
+        return f"{int(s[:3]) + 1911}{s[3:]}"
+    return None
 
 
-def sector_score_for_day(df_day: pd.DataFrame, sector_map: dict) -> pd.DataFrame:
+def parse_tpex_daily(j: dict, date_yyyymmdd: str | None = None) -> pd.DataFrame:
     """
-    Compute sector score for a single day using TWSE day snapshot.
-    score = avg_return + 2 * up_ratio(>=2%)
+    TPEx daily quotes payload -> typed frame like parse_stock_day_all (4-digit codes).
+    {"stat": "ok", "date": ..., "tables": [{"fields": [...], "data": [[...], ...]}, ...]};
+    the quotes table is the one with a 代號 field (names may carry padding spaces).
     """
-    d = df_day.copy()
-    d["ret"] = (d["ClosingPrice"] - d["OpeningPrice"]) / d["OpeningPrice"] * 100.0
-    d["Sector"] = d["Code"].map(lambda x: sector_map.get(str(x), "Unknown"))
+    if not isinstance(j, dict) or str(j.get("stat", "ok")).lower() != "ok":
+        print("[TPEx] stat not OK:", j.get("stat") if isinstance(j, dict) else None,
+              "date:", date_yyyymmdd or "latest")
+        return pd.DataFrame()
+    table = next((t for t in j.get("tables") or [] if isinstance(t, dict)
+                  and "Code" in [TPEX_FIELDS.get(str(f).strip()) for f in t.get("fields") or []]), None)
+    if table is None or not table.get("data"):
+        return pd.DataFrame()
+
+    fields = [TPEX_FIELDS.get(str(f).strip(), str(f).strip()) for f in table["fields"]]
+    rows = [r for r in table["data"] if isinstance(r, (list, tuple)) and len(r) == len(fields)]
+    day = _yyyymmdd(j.get("date") or table.get("date")) or date_yyyymmdd
+    df = _parse_stock_day_all_columns({"data": rows, "date": day}, fields)
+    metric_count("tpex.rows_raw", len(table["data"]))
+    metric_count("tpex.rows_parsed", len(df))
+    return df
 
-    g = d.groupby("Sector", dropna=False)
-    out = []
-    for sec, sub in g:
-        if sec in [None, "", "nan"]:
-            sec = "Unknown"
-        sub = sub.dropna(subset=["ret"])
-        if len(sub) < SECTOR_MIN_COUNT:
-            continue
-        avg_ret = float(sub["ret"].mean())
-        up_ratio = float((sub["ret"] >= SECTOR_UP_PCT).mean())
-        score = avg_ret + SECTOR_SCORE_UP_WEIGHT * up_ratio
-        out.append((sec, score, avg_ret, up_ratio, len(sub)))
 
-    res = pd.DataFrame(out, columns=["Sector", "Score", "AvgRet", "UpRatio", "Count"])
-    res = res.sort_values("Score", ascending=False)
-    return res
+# =======================
+# Exchange sources (one universe from every exchange's daily snapshot)
+# =======================
+# exchange -> (snapshot fetcher: YYYYMMDD or None = latest -> TWSE_COLS frame, its cache key prefix)
+EXCHANGE_SOURCES = {
+    "twse": (twse_fetch_day, ""),
+    "tpex": (tpex_fetch_day, "tpex-"),
+}
+EXCHANGES = [x.strip() for x in os.getenv("SCANNER_EXCHANGES", "twse,tpex").split(",")
+             if x.strip() in EXCHANGE_SOURCES]     # first one sets the trade date
 
 
-def compute_5day_main_sectors(sector_map: dict) -> tuple[set, list[str]]:
+def fetch_day(date_yyyymmdd: str | None = None) -> pd.DataFrame:
     """
-    Main sectors = appear in daily TopN at least MIN_APPEAR times within last 5 trading days.
-    Returns (main_sectors_set, trade_days_list_most_recent_first)
+    Snapshot of every exchange in EXCHANGES for one day, fetched concurrently, as one frame
+    (TWSE_COLS + Market). A source whose snapshot is for another date than the first one
+    (e.g. not published yet) is left out; empty when the first one is.
     """
-    trade_days = find_recent_trade_days(SECTOR_LOOKBACK_DAYS)
-    appear = {}
-
-    for yyyymmdd in trade_days:
-        df_day = twse_fetch_day(yyyymmdd)
-        if df_day.empty:
+    frames = parallel_map(lambda x: EXCHANGE_SOURCES[x][0](date_yyyymmdd), EXCHANGES,
+                          max_workers=len(EXCHANGES))
+    if not frames or frames[0].empty:
+        return pd.DataFrame()
+    d = _snapshot_date(frames[0])
+    keep = []
+    for name, f in zip(EXCHANGES, frames):
+        if f.empty:
+            continue
+        if _snapshot_date(f) != d:
+            print(f"[{name.upper()}] snapshot {_snapshot_date(f)} is not {d}, left out")
             continue
-        score_df = sector_score_for_day(df_day, sector_map)
-        top = score_df.head(SECTOR_TOP_N)["Sector"].tolist()
-        for sec in top:
-            appear[sec] = appear.get(sec, 0) + 1
+        keep.append(f.assign(Market=name))
+    df = pd.concat(keep, ignore_index=True)
+    metric_count("universe.rows", len(df))
+    return df.drop_duplicates("Code", keep="first").reset_index(drop=True)
 
-    main = {sec for sec, cnt in appear.items() if cnt >= SECTOR_MAIN_MIN_APPEAR}
-    return main, trade_days
+
+def snapshot_failed(date_yyyymmdd: str) -> list[str]:
+    """Exchanges whose last fetch for the date failed (network / HTTP; a no-data answer is not a failure)."""
+    with _twse_lock:
+        return [x for x in EXCHANGES if EXCHANGE_SOURCES[x][1] + date_yyyymmdd in _twse_failed]
 
 
 # =======================
-# Main scan logic
+# Local OHLCV store (one columnar .npz per stock)
 # =======================
-def load_today_candidates() -> pd.DataFrame:
-    df = twse_fetch_day(None)  # latest
-    if df.empty:
-        return df
+STORE_DIR = os.path.join(DATA_DIR, "ohlcv")
+PRICE_COLS = ["open", "max", "min", "close", "Trading_Volume"]   # FinMind naming
+NAMES_PATH = os.path.join(STORE_DIR, "_names.json")            # code -> name, from TWSE snapshots
 
-    df["chg_pct"] = (df["ClosingPrice"] - df["OpeningPrice"]) / df["OpeningPrice"] * 100.0
-    df["range"] = df["HighestPrice"] - df["LowestPrice"]
-    df["body_ratio"] = (df["ClosingPrice"] - df["OpeningPrice"]) / df["range"]
-    df["lots"] = df["TradeVolume"] / 1000.0  # TWSE TradeVolume is shares
-
-    cond = (
-        (df["chg_pct"] >= MIN_CHG_PCT) &
-        (df["ClosingPrice"] > df["OpeningPrice"]) &
-        (df["body_ratio"] >= MIN_BODY_RATIO) &
-        (df["lots"] >= MIN_LOTS) &
-        (df["range"] > 0)
-    )
-    out = df.loc[cond, ["Code", "Name", "OpeningPrice", "HighestPrice", "LowestPrice",
-                        "ClosingPrice", "TradeVolume", "chg_pct"]].copy()
-    return out
 
+def _store_path(stock_id: str) -> str:
+    return os.path.join(STORE_DIR, f"{stock_id}.npz")
 
-def check_one_stock(stock_id: str, today_row: pd.Series) -> dict | None:
-    """
-    Use FinMind history to validate:
-    - vol_mult > VOL_MULT x MA5 (exclude today)
-    - consolidation breakout on prev CONSOL_DAYS
-    - pct change 기준: (close - prev_close) / prev_close  (收-昨收)
-    - (NEW) return MA20/MA60 context for A/B tagging
-    """
 
-    # -------------------------
-    # 1) 用 today_row 的交易日當 asof，避免休市/假日 dt.date.today() 對不上
-    # -------------------------
-    asof = dt.date.today()
-    try:
-        if "Date" in today_row:
-            ds = str(today_row["Date"]).strip()
-            # 可能是 "20260105" 或 "2026-01-05"
-            if ds.isdigit() and len(ds) == 8:
-                asof = dt.datetime.strptime(ds, "%Y%m%d").date()
-            else:
-                asof = dt.datetime.strptime(ds, "%Y-%m-%d").date()
-    except Exception:
-        pass
+def _empty_bars() -> pd.DataFrame:
+    return pd.DataFrame({"date": np.array([], dtype="datetime64[ns]"),
+                         **{c: np.array([], dtype="int64" if c == "Trading_Volume" else "float64")
+                            for c in PRICE_COLS}})
 
-    end = asof
-    start = end - dt.timedelta(days=500)
 
-    hist = get_price_history(stock_id, start, end)
-    if hist.empty:
+def _to_date(x) -> dt.date | None:
+    if x is None:
         return None
+    x = np.datetime64(x, "D")
+    return None if np.isnat(x) else x.item()
 
-    c = float(today_row["ClosingPrice"])       # today close (TWSE)
-    v_today = float(today_row["TradeVolume"])  # shares (TWSE)
 
-    # -------------------------
-    # 2) 依日期排除 today（不要用 iloc[:-1]，避免交易日錯位）
-    # -------------------------
-    if "date" not in hist.columns:
+def _synced_upto(df: pd.DataFrame, end: dt.date) -> dt.date:
+    """
+    Last day of a fetch up to `end` whose bars are final.
+    Past days are; today only once its bar has been published.
+    """
+    today = dt.date.today()
+    if end < today:
+        return end
+    if not df.empty and pd.Timestamp(df["date"].max()).date() >= today:
+        return today
+    return today - dt.timedelta(days=1)
+
+
+def _store_read(stock_id: str) -> dict | None:
+    """Raw stored arrays (date, PRICE_COLS, synced_from, synced_through) or None."""
+    path = _store_path(stock_id)
+    if not os.path.exists(path):
+        return None
+    try:
+        with np.load(path) as z:
+            return {k: z[k] for k in z.files}
+    except Exception as e:
+        print("[STORE] unreadable, ignore:", path, repr(e))
         return None
 
-    hist = hist.copy()
-    hist["date"] = pd.to_datetime(hist["date"]).dt.date
-    hist = hist.sort_values("date")
 
-    base = hist[hist["date"] < asof].copy()  # ✅ 不含今日
-    if len(base) < (CONSOL_DAYS + 6):
-        return None
+def _store_save(stock_id: str, arrays: dict, synced_from: dt.date | None, synced_through: dt.date | None):
+    os.makedirs(STORE_DIR, exist_ok=True)
+    path = _store_path(stock_id)
+    tmp = f"{path}.{threading.get_ident()}.tmp"
+    with open(tmp, "wb") as f:
+        np.savez(
+            f,
+            date=arrays["date"].astype("datetime64[D]"),
+            **{c: arrays[c] for c in PRICE_COLS},
+            synced_from=np.datetime64(synced_from, "D") if synced_from else np.datetime64("NaT", "D"),
+            synced_through=np.datetime64(synced_through, "D") if synced_through else np.datetime64("NaT", "D"),
+        )
+    os.replace(tmp, path)
 
-    # -------------------------
-    # 3) 漲跌幅：收 - 昨收（用 base 最後一天 close 當昨收）
-    # -------------------------
-    prev_close = float(base["close"].iloc[-1])
-    if prev_close <= 0:
-        return None
-    chg_pct = (c - prev_close) / prev_close
+    # 0050 trades every session: its bars are the trading calendar
+    if stock_id == MARKET_PROXY:
+        calendar_extend(arrays["date"].astype("datetime64[D]").tolist(), known_through=synced_through)
 
-    # ✅ 你要的門檻（如果你用全域常數就留著；否則這裡直接用 0.03）
-    if chg_pct < 0.03:
-        return None
 
-    # -------------------------
-    # 4) Volume check：MA5 不含今日
-    # -------------------------
-    ma5 = float(base["Trading_Volume"].iloc[-5:].mean())
-    vol_mult = (v_today / ma5) if ma5 > 0 else 0.0
-    if not (ma5 > 0 and v_today > VOL_MULT * ma5):
-        return None
+def store_load(stock_id: str) -> tuple[pd.DataFrame, dt.date | None, dt.date | None]:
+    """
+    Read one stock from the local store.
+    Returns (bars, synced_from, synced_through); [synced_from, synced_through] is the
+    date range already fetched completely, bars use FinMind column names.
+    """
+    z = _store_read(stock_id)
+    if z is None:
+        return _empty_bars(), None, None
+    df = pd.DataFrame({"date": z["date"].astype("datetime64[ns]"), **{c: z[c] for c in PRICE_COLS}})
+    return df, _to_date(z["synced_from"]), _to_date(z["synced_through"])
 
-    # -------------------------
-    # 5) Consolidation breakout：看「前 CONSOL_DAYS」(也不含今日)
-    # -------------------------
-    prev20 = base.iloc[-CONSOL_DAYS:]
-    high20 = float(prev20["max"].max())
-    low20 = float(prev20["min"].min())
-    width = (high20 - low20) / low20 if low20 > 0 else 999.0
-    if width > MAX_RANGE_PCT:
-        return None
 
-    if not (c >= high20 * (1.0 + BREAKOUT_PCT)):
+def store_write(stock_id: str, bars: pd.DataFrame,
+                synced_from: dt.date | None = None, synced_through: dt.date | None = None) -> pd.DataFrame:
+    """
+    Merge new bars into the stored series (new rows win on the same date) and save.
+    synced_from / synced_through = None keeps the stored value.
+    Returns the merged series.
+    """
+    old, old_from, old_through = store_load(stock_id)
+    synced_from = synced_from if synced_from is not None else old_from
+    synced_through = synced_through if synced_through is not None else old_through
+
+    new = bars[["date"] + PRICE_COLS].copy() if not bars.empty else _empty_bars()
+    new["date"] = pd.to_datetime(new["date"]).dt.normalize()
+
+    df = pd.concat([old, new], ignore_index=True) if not old.empty else new
+    df = df.drop_duplicates(subset="date", keep="last").sort_values("date").reset_index(drop=True)
+    df["Trading_Volume"] = df["Trading_Volume"].astype("int64")
+
+    _store_save(stock_id, {"date": df["date"].values, **{c: df[c].to_numpy() for c in PRICE_COLS}},
+                synced_from, synced_through)
+    return df
+
+
+def _snapshot_date(df_day: pd.DataFrame) -> dt.date | None:
+    """Trade date of a TWSE snapshot: YYYYMMDD, YYYY-MM-DD or ROC (1150105)."""
+    if df_day.empty or "Date" not in df_day.columns:
         return None
+    return _parse_trade_date(df_day["Date"].iloc[0])
 
-    if BREAKOUT_VOL_GT_MA5 and not (v_today > ma5):
+
+def _parse_trade_date(x) -> dt.date | None:
+    """Quote Date field: YYYYMMDD, YYYY-MM-DD or ROC (1150105); None if unparseable."""
+    ds = str(x).strip()
+    try:
+        if ds.isdigit() and len(ds) == 8:
+            return dt.datetime.strptime(ds, "%Y%m%d").date()
+        if ds.isdigit() and len(ds) == 7:
+            return dt.date(int(ds[:3]) + 1911, int(ds[3:5]), int(ds[5:7]))
+        return dt.datetime.strptime(ds, "%Y-%m-%d").date()
+    except ValueError:
         return None
 
-    break_pct = (c / high20 - 1.0) if high20 > 0 else 0.0
 
-        # =========================
-    # NEW: MA20 / MA60 / MA120 (use FinMind close, EXCLUDE today)
-    # =========================
-    ma20 = None
-    ma60 = None
-    ma120 = None
+def _is_next_session(synced_through: dt.date | None, d: dt.date) -> bool:
+    """
+    True if d is the first session after synced_through.
+    Uses the trading calendar; without one, only weekends may lie in between.
+    """
+    if synced_through is None or synced_through >= d:
+        return False
+    prev = prev_trade_day(d)
+    if prev is not None:
+        return synced_through >= prev
+    x = synced_through + dt.timedelta(days=1)
+    while x < d:
+        if x.weekday() < 5:
+            return False
+        x += dt.timedelta(days=1)
+    return True
 
-    s_close = base["close"].astype(float)
 
-    if len(base) >= 20:
-        ma20 = float(s_close.rolling(20).mean().iloc[-1])
-    if len(base) >= 60:
-        ma60 = float(s_close.rolling(60).mean().iloc[-1])
-    if len(base) >= 120:
-        ma120 = float(s_close.rolling(120).mean().iloc[-1])
+# snapshot column -> store column (FinMind naming)
+SNAPSHOT_PRICE_COLS = {"OpeningPrice": "open", "HighestPrice": "max", "LowestPrice": "min",
+                       "ClosingPrice": "close", "TradeVolume": "Trading_Volume"}
 
-    return {
-        "Code": stock_id,
-        "Name": str(today_row["Name"]),
-        "chg": float(today_row["chg_pct"]),
-        "vol_mult": float(vol_mult),
-        "lots": float(v_today / LOTS_UNIT),
-        "range20_pct": float(width),
-        "break_pct": float(break_pct),
-
-        # MA context
-        "close": float(c),
-        "ma20": ma20,
-        "ma60": ma60,
-        "ma120": ma120,
-    }
 
+def snapshot_bars(df_day: pd.DataFrame) -> dict:
+    """Snapshot rows as store columns (PRICE_COLS arrays; volume int64), row-aligned with df_day."""
+    cols = {c: df_day[k].to_numpy(dtype=float) for k, c in SNAPSHOT_PRICE_COLS.items()}
+    cols["Trading_Volume"] = cols["Trading_Volume"].astype("int64")
+    return cols
 
 
-def run():
-    print("Starting scanner")
+def store_ingest_snapshot(df_day: pd.DataFrame) -> int:
+    """
+    Append one TWSE daily snapshot to every stock in the store.
+    A stock's synced_through only advances when the new day directly follows it,
+    otherwise the gap is filled by FinMind the next time the stock is read.
+    Returns number of stocks written.
+    """
+    d = _snapshot_date(df_day)
+    if d is None:
+        return 0
+
+    meta_path = os.path.join(STORE_DIR, "_snapshots.json")
+    ingested = set()
+    if os.path.exists(meta_path):
+        with open(meta_path, "r", encoding="utf-8") as f:
+            ingested = set(json.load(f))
+    if d.isoformat() in ingested:
+        return 0
+
+    calendar_extend([d])
+    day = np.datetime64(d, "D")
+    cols = snapshot_bars(df_day)
+
+    # one bar per stock: plain array insert, no DataFrame round-trip per file
+    n = 0
+    for i, code in enumerate(df_day["Code"].astype(str)):
+        z = _store_read(code)
+        if z is None:
+            synced_from = synced_through = d
+            arrays = {"date": np.array([day]), **{c: cols[c][i:i + 1] for c in PRICE_COLS}}
+        else:
+            synced_from, synced_through = _to_date(z["synced_from"]), _to_date(z["synced_through"])
+            if _is_next_session(synced_through, d):
+                synced_through = d
+            dates = z["date"].astype("datetime64[D]")
+            k = int(np.searchsorted(dates, day))
+            same = k < len(dates) and dates[k] == day
+            arrays = {"date": np.insert(dates, k, day) if not same else dates}
+            for c in PRICE_COLS:
+                arrays[c] = np.insert(z[c], k, cols[c][i]) if not same else z[c].copy()
+                if same:
+                    arrays[c][k] = cols[c][i]
+        _store_save(code, arrays, synced_from, synced_through)
+        n += 1
+
+    if "Name" in df_day.columns:
+        names = _load_names()
+        names.update(zip(df_day["Code"].astype(str), df_day["Name"].astype(str).str.strip()))
+        _save_json(NAMES_PATH, names)
+
+    ingested.add(d.isoformat())
+    _save_json(meta_path, sorted(ingested))
+    print(f"[STORE] ingested TWSE snapshot {d} into {n} stocks")
+    return n
+
+
+def _load_names() -> dict:
+    try:
+        with open(NAMES_PATH, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
 
-    # -------------------------
-    # Helper: always export json
-    # -------------------------
-    def export_scanner_result(stocks: list[str], signal_date: str, stocks_a: list[str] | None = None, stocks_b: list[str] | None = None):
-        import json
-        data = {
-            "signal_date": signal_date,
+
+def sync_latest_snapshot() -> pd.DataFrame:
+    """
+    Fetch the latest snapshot (every exchange) and fold it into the store and the calendar.
+    The latest snapshot also tells us every day after it (up to yesterday) was not a session.
+    """
+    latest = fetch_day(None)
+    d = _snapshot_date(latest)
+    if d is not None:
+        store_ingest_snapshot(latest)
+        calendar_extend([d], known_through=max(d, dt.date.today() - dt.timedelta(days=1)))
+    return latest
+
+
+# =======================
+# Trading calendar (0050 bars + ingested snapshots, DATA_DIR/calendar.json)
+# =======================
+CALENDAR_PATH = os.path.join(DATA_DIR, "calendar.json")
+
+# dates: sorted trade days; index: date -> position; known_through: every day up to it is classified
+_cal: dict = {"dates": [], "index": {}, "known_through": None, "loaded": False}
+_cal_lock = threading.Lock()
+
+
+def _calendar_load():
+    """Load the persisted calendar, or build it once from the store (caller holds _cal_lock)."""
+    if _cal["loaded"]:
+        return
+    _cal["loaded"] = True
+    dates: set = set()
+    kt = None
+    if os.path.exists(CALENDAR_PATH):
+        try:
+            with open(CALENDAR_PATH, "r", encoding="utf-8") as f:
+                j = json.load(f)
+            dates = {dt.date.fromisoformat(x) for x in j.get("dates", [])}
+            kt = dt.date.fromisoformat(j["known_through"]) if j.get("known_through") else None
+        except (OSError, ValueError, KeyError) as e:
+            print("[CALENDAR] unreadable, rebuild:", repr(e))
+            dates, kt = set(), None
+    if not dates:
+        proxy, _, kt = store_load(MARKET_PROXY)
+        dates = {x.date() for x in proxy["date"]}
+        snap_path = os.path.join(STORE_DIR, "_snapshots.json")
+        if os.path.exists(snap_path):
+            with open(snap_path, "r", encoding="utf-8") as f:
+                dates |= {dt.date.fromisoformat(x) for x in json.load(f)}
+        if dates:
+            print(f"[CALENDAR] built from store: {len(dates)} days")
+    _calendar_set(dates, kt)
+
+
+def _calendar_set(dates, known_through):
+    ds = sorted(dates)
+    _cal["dates"] = ds
+    _cal["index"] = {d: i for i, d in enumerate(ds)}
+    _cal["known_through"] = known_through
+
+
+def calendar_extend(dates, known_through: dt.date | None = None):
+    """Add trade days (and optionally move known_through forward); persisted on change."""
+    with _cal_lock:
+        _calendar_load()
+        new = [d for d in dates if d not in _cal["index"]]
+        kt = _cal["known_through"]
+        if known_through is not None and (kt is None or known_through > kt):
+            kt = known_through
+        if not new and kt == _cal["known_through"]:
+            return
+        _calendar_set(set(_cal["dates"]) | set(new), kt)
+        _save_json(CALENDAR_PATH, {"dates": [d.isoformat() for d in _cal["dates"]],
+                                   "known_through": kt.isoformat() if kt else None})
+
+
+def trade_calendar_dates() -> list[dt.date]:
+    with _cal_lock:
+        _calendar_load()
+        return _cal["dates"]
+
+
+def calendar_known_through() -> dt.date | None:
+    with _cal_lock:
+        _calendar_load()
+        return _cal["known_through"]
+
+
+def _calendar_pos(d: dt.date) -> int:
+    """Number of calendar days <= d (index lookup for trade days, bisect otherwise)."""
+    i = _cal["index"].get(d)
+    if i is not None:
+        return i + 1
+    return int(np.searchsorted(np.array(_cal["dates"], dtype="datetime64[D]"), np.datetime64(d, "D"), side="right"))
+
+
+def last_trade_days(n: int, asof: dt.date) -> list[dt.date]:
+    """Last n trade days <= asof, most recent first (no network)."""
+    with _cal_lock:
+        _calendar_load()
+        k = _calendar_pos(asof)
+        return _cal["dates"][max(0, k - n):k][::-1]
+
+
+def last_trade_day(asof: dt.date) -> dt.date | None:
+    """Latest trade day <= asof, or None if the calendar does not cover asof."""
+    with _cal_lock:
+        _calendar_load()
+        kt = _cal["known_through"]
+        k = _calendar_pos(asof)
+        if k == 0:
+            return None
+        d = _cal["dates"][k - 1]
+        if d == asof or (kt is not None and kt >= asof - dt.timedelta(days=1)):
+            return d
+        return None
+
+
+def prev_trade_day(d: dt.date) -> dt.date | None:
+    """Trade day before d, or None if the calendar does not cover the days before d."""
+    with _cal_lock:
+        _calendar_load()
+        kt = _cal["known_through"]
+        if kt is None or kt < d - dt.timedelta(days=1):
+            return None
+        k = _calendar_pos(d - dt.timedelta(days=1))
+        return _cal["dates"][k - 1] if k > 0 else None
+
+
+def is_trade_day(d: dt.date) -> bool | None:
+    """Whether d was a session, or None if the calendar does not cover d."""
+    with _cal_lock:
+        _calendar_load()
+        kt = _cal["known_through"]
+        if not _cal["dates"] or d < _cal["dates"][0] or kt is None or d > kt:
+            return None
+        return d in _cal["index"]
+
+
+# =======================
+# Bulk history backfill (whole-market snapshots by date -> per-stock store)
+# =======================
+BACKFILL_PATH = os.path.join(DATA_DIR, "backfill.json")       # weekdays already folded into the store
+BACKFILL_WORKERS = int(os.getenv("BACKFILL_WORKERS", "3"))    # days in flight, one request per exchange each
+BACKFILL_CHUNK = 20      # weekdays fetched, transposed and written per step
+
+
+def _backfill_done() -> set:
+    try:
+        with open(BACKFILL_PATH, "r", encoding="utf-8") as f:
+            return set(json.load(f).get("done", []))
+    except (OSError, ValueError, AttributeError):
+        return set()
+
+
+def _store_merge(code: str, days: np.ndarray, cols: dict, d_from: dt.date | None, d_through: dt.date | None):
+    """
+    Merge bars into one stored stock (new rows win on the same date) and count
+    [d_from, d_through] as synced when it overlaps or adjoins the stored range
+    (d_from None: bars only, the synced range is left as it is).
+    """
+    z = _store_read(code)
+    if z is None:
+        _store_save(code, {"date": days, **cols}, d_from, d_through)
+        return
+    dates = np.concatenate([days, z["date"].astype("datetime64[D]")])
+    _, idx = np.unique(dates, return_index=True)     # first occurrence = the new bar
+    arrays = {"date": dates[idx], **{c: np.concatenate([cols[c], z[c].astype(cols[c].dtype)])[idx]
+                                     for c in PRICE_COLS}}
+    synced_from, synced_through = _to_date(z["synced_from"]), _to_date(z["synced_through"])
+    one = dt.timedelta(days=1)
+    if d_from is None:
+        pass
+    elif synced_from is None or synced_through is None:
+        synced_from, synced_through = d_from, d_through
+    elif d_from <= synced_from <= d_through + one:
+        synced_from, synced_through = d_from, max(synced_through, d_through)
+    elif d_from - one <= synced_through <= d_through:
+        synced_through = d_through
+    _store_save(code, arrays, synced_from, synced_through)
+
+
+def backfill(start: dt.date, end: dt.date | None = None, workers: int = BACKFILL_WORKERS) -> int:
+    """
+    Build the store's history for [start, end] from whole-market daily snapshots (fetch_day):
+    one request per weekday and exchange instead of one FinMind request per stock. Newest days first,
+    BACKFILL_CHUNK weekdays at a time: fetched with `workers` in flight, transposed into
+    per-stock arrays and merged into the store, whose synced range then covers the chunk
+    (so indicator_state / check_one_stock read it without FinMind).
+    A weekday answered with another session's snapshot counts only if the trading calendar
+    (0050's bars, one FinMind request) says it was a holiday; otherwise it may be a session
+    not published yet: it is not marked done and the synced range stops short of it.
+    Resumable: finished weekdays are kept in BACKFILL_PATH and payloads in the snapshot disk
+    cache; a chunk with failed days stops the run, and the next run retries from there.
+    Returns the number of sessions written.
+    """
+    end = end or dt.date.today() - dt.timedelta(days=1)
+    days = [d for d in (end - dt.timedelta(days=i) for i in range((end - start).days + 1)) if d.weekday() < 5]
+    done = _backfill_done()
+    todo = [d for d in days if d.isoformat() not in done]
+    print(f"[BACKFILL] {start} .. {end}: {len(days)} weekdays, {len(days) - len(todo)} already done")
+    if todo:
+        try:
+            get_price_history(MARKET_PROXY, start, end)      # stored 0050 bars extend the calendar
+        except RuntimeError as e:
+            print("[BACKFILL] no 0050 history, holidays stay unknown:", repr(e))
+
+    t0 = time.time()
+    one = dt.timedelta(days=1)
+    sessions = 0
+    for k in range(0, len(todo), BACKFILL_CHUNK):
+        chunk = todo[k:k + BACKFILL_CHUNK]          # most recent first
+        keys = [d.strftime("%Y%m%d") for d in chunk]
+        frames = parallel_map(fetch_day, keys, max_workers=workers)
+        failed = [key for key in keys if snapshot_failed(key)]
+        # a day answered with another session's snapshot (holiday, not published yet) has no
+        # session of its own: storing those bars under it would duplicate them. It is accounted
+        # for only as a known holiday; a no-data answer is, unless the calendar has a session.
+        dates = [_snapshot_date(f) for f in frames]
+        known = [is_trade_day(d) for d in chunk]
+        got = [(d, f) for d, f, s in zip(chunk, frames, dates) if s == d]
+        ok = [s == d or t is False or (s is None and t is None) for d, s, t in zip(chunk, dates, known)]
+        missing = [(d, s) for d, s, a in zip(chunk, dates, ok) if not a]
+        if missing:
+            print(f"[BACKFILL] {len(missing)} session(s) without their own snapshot, left for a later run: "
+                  + ", ".join(f"{d} -> {s}" for d, s in missing[:5]))
+
+        # calendar days this chunk accounts for: back to the weekday before its oldest day,
+        # synced only over the run of accounted days from the newest one down
+        i = days.index(chunk[-1])
+        d_through = end if chunk[0] == days[0] else chunk[0]
+        top = ok.index(True) if True in ok else len(chunk)
+        bottom = ok.index(False, top) if False in ok[top:] else len(chunk)
+        if top == len(chunk):
+            d_from = d_through = None
+        else:
+            if top > 0:
+                d_through = chunk[top - 1] - one
+            if bottom < len(chunk):
+                d_from = chunk[bottom] + one
+            else:       # and on down over older weekdays an earlier run already folded in
+                j = i + 1
+                while j < len(days) and days[j].isoformat() in done:
+                    j += 1
+                d_from = days[j] + one if j < len(days) else start
+        if got and not failed:
+            df = pd.concat([f.assign(_day=np.datetime64(d, "D")) for d, f in got], ignore_index=True)
+            codes = df["Code"].astype(str).to_numpy()
+            order = np.argsort(codes, kind="stable")
+            uniq, first = np.unique(codes[order], return_index=True)
+            day = df["_day"].to_numpy().astype("datetime64[D]")
+            cols = snapshot_bars(df)
+            for code, a, b in zip(uniq, first, list(first[1:]) + [len(order)]):
+                sel = order[a:b]
+                _store_merge(code, day[sel], {c: v[sel] for c, v in cols.items()}, d_from, d_through)
+            calendar_extend([d for d, _ in got])
+            if "Name" in df.columns:   # names seen later (already stored) win
+                _save_json(NAMES_PATH, {**dict(zip(codes, df["Name"].astype(str).str.strip())), **_load_names()})
+            sessions += len(got)
+            metric_count("backfill.sessions", len(got))
+            metric_count("backfill.bars", len(df))
+        if failed:
+            print(f"[BACKFILL] {len(failed)} day(s) failed ({', '.join(failed[:5])}); "
+                  "stopping here, rerun to resume")
+            break
+        done.update(d.isoformat() for d, a in zip(chunk, ok) if a)
+        _save_json(BACKFILL_PATH, {"done": sorted(done)})
+        print(f"[BACKFILL] {chunk[-1]} .. {chunk[0]}: {len(got)} sessions "
+              f"({k + len(chunk)}/{len(todo)} weekdays, {time.time() - t0:.1f}s)")
+    return sessions
+
+
+# =======================
+# Sector mapping & 5-day main sectors
+# =======================
+SECTOR_MAP_PATH = os.path.join(DATA_DIR, "sector_map.json")
+SECTOR_MAP_TTL = int(os.getenv("SECTOR_MAP_TTL", str(7 * 86400)))    # sec a saved map is used without asking FinMind
+SECTOR_MAP_FULL_DAYS = int(os.getenv("SECTOR_MAP_FULL_DAYS", "90"))  # full download (drops delistings) every N days
+
+
+class SectorMap(dict):
+    """
+    code -> sector as saved in SECTOR_MAP_PATH, plus its version stamp (hash of the
+    assignments), fetch times, newest TaiwanStockInfo date held, and a vectorized lookup.
+    Treat as read-only: lookup() indexes the entries once.
+    """
+
+    def __init__(self, data=(), stamp: str = "", fetched_at: dt.datetime | None = None,
+                 full_at: dt.datetime | None = None, through: str = ""):
+        super().__init__(data)
+        self.stamp, self.fetched_at, self.full_at, self.through = stamp, fetched_at, full_at, through
+        self._index = None
+
+    def lookup(self, codes) -> np.ndarray:
+        """Sector of each code (object array); "Unknown" when unmapped or blank."""
+        if self._index is None:
+            sec = [("Unknown" if x in ("", "nan") else x) for x in self.values()]
+            self._index = (pd.Index(list(self.keys())), np.array(sec + ["Unknown"], dtype=object))
+        keys, sec = self._index
+        return sec[keys.get_indexer(pd.Index(codes).astype(str))]     # -1 (unmapped) -> trailing "Unknown"
+
+
+def sector_lookup(sector_map: dict, codes) -> np.ndarray:
+    """Vectorized code -> sector for a SectorMap or a plain dict."""
+    m = sector_map if isinstance(sector_map, SectorMap) else SectorMap(sector_map)
+    return m.lookup(codes)
+
+
+def sector_map_stamp(m: dict) -> str:
+    import hashlib
+
+    return hashlib.sha1(json.dumps(sorted(m.items()), ensure_ascii=False).encode()).hexdigest()[:12]
+
+
+def _sector_rows(info: pd.DataFrame) -> tuple[dict, str]:
+    """TaiwanStockInfo rows -> (code -> sector, later rows win; newest row date)."""
+    if info.empty:
+        return {}, ""
+
+    candidates = ["industry_category", "industry", "category", "type"]
+    pick = None
+    for c in candidates:
+        if c in info.columns:
+            pick = c
+            break
+
+    if not pick:
+        non = [c for c in info.columns if c not in ["stock_id", "date"]]
+        pick = non[0] if non else None
+
+    sector_map = {}
+    if pick and "stock_id" in info.columns:
+        sid = info["stock_id"].astype(str).str.strip()
+        sec = info[pick].astype(str).str.strip().replace({"": "Unknown", "nan": "Unknown", "None": "Unknown"})
+        ok = sid.str.isdigit()
+        sector_map = dict(zip(sid[ok], sec[ok]))   # later rows win, as before
+    through = str(info["date"].astype(str).max()) if "date" in info.columns else ""
+    return sector_map, through
+
+
+def load_sector_map() -> SectorMap:
+    """
+    Sector map for a run. The saved copy is used while younger than SECTOR_MAP_TTL;
+    after that only TaiwanStockInfo rows dated on/after the newest one held are fetched
+    and merged (a full download every SECTOR_MAP_FULL_DAYS or without a usable copy).
+    If FinMind fails, the saved copy is used whatever its age.
+    """
+    saved = load_sector_map_offline(quiet=True)
+    now = dt.datetime.now().replace(microsecond=0)
+    if saved and saved.fetched_at and (now - saved.fetched_at).total_seconds() < SECTOR_MAP_TTL:
+        print(f"[SECTOR] saved map {saved.stamp}: {len(saved)} codes, fetched {saved.fetched_at}")
+        return saved
+
+    full = not saved or not saved.through or saved.full_at is None or (now - saved.full_at).days >= SECTOR_MAP_FULL_DAYS
+    try:
+        j = _finmind_json("TaiwanStockInfo", "all", "2000-01-01" if full else saved.through, now.date().isoformat())
+    except (requests.RequestException, RuntimeError, ValueError) as e:
+        j = {"status": type(e).__name__}
+    rows, through = _sector_rows(pd.DataFrame(j.get("data", [])))
+    if j.get("status") != 200 or (full and not rows):
+        print(f"[SECTOR] TaiwanStockInfo unavailable ({j.get('status')}); "
+              f"using saved map {saved.stamp or '-'} ({len(saved)} codes)")
+        return saved
+
+    merged = rows if full else {**saved, **rows}
+    changed = sum(1 for c, x in rows.items() if saved.get(c) != x)
+    m = SectorMap(merged, sector_map_stamp(merged), fetched_at=now,
+                  full_at=now if full else saved.full_at, through=max(through, "" if full else saved.through))
+    print(f"[SECTOR] {'full' if full else 'delta'} refresh: {len(rows)} rows, {changed} codes new/changed, "
+          f"map {m.stamp} ({len(m)} codes)")
+    if m:
+        _save_json(SECTOR_MAP_PATH, {
+            "stamp": m.stamp, "through": m.through,
+            "fetched_at": m.fetched_at.isoformat(), "full_at": m.full_at.isoformat() if m.full_at else None,
+            "map": dict(m),
+        })
+    return m
+
+
+def load_sector_map_offline(quiet: bool = False) -> SectorMap:
+    """Last sector map saved by load_sector_map (replay / research; no network)."""
+    try:
+        with open(SECTOR_MAP_PATH, "r", encoding="utf-8") as f:
+            j = json.load(f)
+    except (OSError, ValueError):
+        if not quiet:
+            print("[SECTOR] no saved sector map; sectors will be Unknown")
+        return SectorMap()
+    if "map" not in j:         # plain code -> sector file from before stamps / TTL
+        return SectorMap(j, sector_map_stamp(j))
+
+    def when(x):
+        return dt.datetime.fromisoformat(x) if x else None
+
+    return SectorMap(j["map"], j.get("stamp") or sector_map_stamp(j["map"]), when(j.get("fetched_at")),
+                     when(j.get("full_at")), j.get("through") or "")
+
+
+SCORE_COLS = ["Sector", "Score", "AvgRet", "UpRatio", "Count"]
+
+
+def sector_scores(days: list[tuple[str, pd.DataFrame]], sector_map: dict) -> pd.DataFrame:
+    """
+    Sector scores for several TWSE day snapshots in one grouped aggregation.
+    score = avg_return + 2 * up_ratio(>=2%), sectors with < SECTOR_MIN_COUNT stocks dropped.
+    Returns Day + SCORE_COLS, sorted by Day then Score (desc).
+    """
+    frames = [df[["Code", "OpeningPrice", "ClosingPrice"]].assign(Day=day)
+              for day, df in days if not df.empty]
+    if not frames:
+        return pd.DataFrame(columns=["Day"] + SCORE_COLS)
+    return sector_scores_long(pd.concat(frames, ignore_index=True), sector_map)
+
+
+def sector_scores_long(d: pd.DataFrame, sector_map: dict) -> pd.DataFrame:
+    """sector_scores on one long frame of Day / Code / OpeningPrice / ClosingPrice rows."""
+    return rank_sector_stats(sector_day_stats(d, sector_map))
+
+
+def _param(params: dict | None, name: str):
+    """Strategy constant `name`, unless params overrides it (sweep)."""
+    return params[name] if params and name in params else globals()[name]
+
+
+def sector_day_stats(d: pd.DataFrame, sector_map: dict, params: dict | None = None) -> pd.DataFrame:
+    """Per Day / Sector AvgRet, UpRatio (ret >= SECTOR_UP_PCT) and Count, before any filtering."""
+    d = d[["Day", "Code", "OpeningPrice", "ClosingPrice"]].copy()
+    d["ret"] = (d["ClosingPrice"] - d["OpeningPrice"]) / d["OpeningPrice"] * 100.0
+    d = d.dropna(subset=["ret"])
+
+    # map each distinct code once (long replay / sweep frames repeat every code per day)
+    ids, uniq = pd.factorize(d["Code"], use_na_sentinel=False)
+    sec = pd.Categorical(sector_lookup(sector_map, np.asarray(uniq)))
+    d["Sector"] = pd.Categorical.from_codes(sec.codes[ids], categories=sec.categories)
+    d["up"] = d["ret"] >= _param(params, "SECTOR_UP_PCT")
+
+    return (
+        d.groupby(["Day", "Sector"], observed=True, sort=True)
+        .agg(AvgRet=("ret", "mean"), UpRatio=("up", "mean"), Count=("ret", "size"))
+        .reset_index()
+    )
+
+
+def rank_sector_stats(res: pd.DataFrame, params: dict | None = None) -> pd.DataFrame:
+    """sector_day_stats -> Day + SCORE_COLS: drop small sectors, score, sort by Day then Score (desc)."""
+    res = res[res["Count"] >= _param(params, "SECTOR_MIN_COUNT")].copy()
+    res["Sector"] = res["Sector"].astype(str)
+    res["Score"] = res["AvgRet"] + _param(params, "SECTOR_SCORE_UP_WEIGHT") * res["UpRatio"]
+    res = res.sort_values(["Day", "Score"], ascending=[True, False], kind="mergesort")
+    return res[["Day"] + SCORE_COLS].reset_index(drop=True)
+
+
+def sector_score_for_day(df_day: pd.DataFrame, sector_map: dict) -> pd.DataFrame:
+    """
+    Compute sector score for a single day using TWSE day snapshot.
+    score = avg_return + 2 * up_ratio(>=2%)
+    """
+    return sector_scores([("", df_day)], sector_map)[SCORE_COLS]
+
+
+def main_sectors_from_scores(scores: pd.DataFrame) -> tuple[set, pd.Series]:
+    """
+    Daily TopN from sector_scores -> (main sectors, TopN appearance count per sector).
+    Main = appears at least SECTOR_MAIN_MIN_APPEAR times.
+    """
+    top = scores.groupby("Day", sort=False).head(SECTOR_TOP_N)
+    appear = top["Sector"].value_counts()
+    main = set(appear[appear >= SECTOR_MAIN_MIN_APPEAR].index)
+    return main, appear
+
+
+def sector_lookback_days() -> tuple[list[str], list[tuple[str, pd.DataFrame]]]:
+    """Last SECTOR_LOOKBACK_DAYS trade days (most recent first) and their snapshots (every exchange)."""
+    trade_days = find_recent_trade_days(SECTOR_LOOKBACK_DAYS)
+    return trade_days, list(zip(trade_days, parallel_map(fetch_day, trade_days)))
+
+
+def compute_5day_main_sectors(sector_map: dict, lookback: tuple | None = None) -> tuple[set, list[str]]:
+    """
+    Main sectors = appear in daily TopN at least MIN_APPEAR times within last 5 trading days.
+    lookback: sector_lookback_days() result, if already fetched.
+    Returns (main_sectors_set, trade_days_list_most_recent_first)
+    """
+    trade_days, days = lookback or sector_lookback_days()
+    main, _ = main_sectors_from_scores(sector_scores(days, sector_map))
+    return main, trade_days
+
+
+# =======================
+# Main scan logic
+# =======================
+def load_today_candidates(df_latest: pd.DataFrame | None = None) -> pd.DataFrame:
+    df = fetch_day(None) if df_latest is None else df_latest.copy()  # latest, every exchange
+    if df.empty:
+        return df
+
+    df["chg_pct"] = (df["ClosingPrice"] - df["OpeningPrice"]) / df["OpeningPrice"] * 100.0
+    funnel = {"input": len(df)}
+    cond = candidate_mask(df["OpeningPrice"], df["HighestPrice"], df["LowestPrice"],
+                          df["ClosingPrice"], df["TradeVolume"], funnel)
+    for k, n in funnel.items():
+        metric_count(f"candidates.{k}", n)
+    out = df.loc[cond, ["Code", "Name", "OpeningPrice", "HighestPrice", "LowestPrice",
+                        "ClosingPrice", "TradeVolume", "chg_pct"] + (["Market"] if "Market" in df.columns else [])].copy()
+    return out
+
+
+def candidate_mask(o, h, l, c, v, funnel: dict | None = None):
+    """
+    爆量長紅 daily-shape filter on one bar per row (TWSE volume in shares).
+    funnel (optional) receives the rows surviving each test, in order.
+    """
+    chg_pct = (c - o) / o * 100.0
+    rng = h - l
+    body_ratio = (c - o) / rng
+    lots = v / 1000.0  # TWSE TradeVolume is shares
+
+    ok = chg_pct >= MIN_CHG_PCT
+    funnel_step(funnel, "chg_pct", ok)
+    ok = ok & (c > o)
+    funnel_step(funnel, "up_bar", ok)
+    ok = ok & (body_ratio >= MIN_BODY_RATIO)
+    funnel_step(funnel, "body_ratio", ok)
+    ok = ok & (lots >= MIN_LOTS)
+    funnel_step(funnel, "lots", ok)
+    ok = ok & (rng > 0)
+    funnel_step(funnel, "range", ok)
+    return ok
+
+
+# =======================
+# Incremental indicator state (persisted per stock, O(1) per new bar)
+# =======================
+INDICATOR_PATH = os.path.join(DATA_DIR, "indicators.json")
+MA_WINDOWS = (20, MA60_WINDOW, 120)
+IND_RING = max(MA_WINDOWS)    # bars of close / date kept per stock
+IND_RESUM_EVERY = 250         # re-add the windows from the ring every N bars (no float drift)
+
+_ind: dict | None = None
+_ind_lock = threading.Lock()
+
+
+def _ind_load() -> dict:
+    global _ind
+    with _ind_lock:
+        if _ind is None:
+            try:
+                with open(INDICATOR_PATH, "r", encoding="utf-8") as f:
+                    _ind = json.load(f)
+            except (OSError, ValueError):
+                _ind = {}
+        return _ind
+
+
+def _ind_new(first: str) -> dict:
+    return {"first": first, "through": None, "n": 0, "dates": [], "close": [], "vol": [],
+            "sum": {str(k): 0.0 for k in MA_WINDOWS}, "vsum": 0, "hi": [], "lo": []}
+
+
+def indicator_push(st: dict, d: str, high: float, low: float, close: float, vol: int):
+    """
+    Fold one bar into a state: rolling close sums (MA20/60/120), volume sum (MA5)
+    and monotonic [index, value] queues for the CONSOL_DAYS high / low.
+    """
+    i = st["n"]
+    for k in MA_WINDOWS:
+        st["sum"][str(k)] += close
+        if len(st["close"]) >= k:
+            st["sum"][str(k)] -= st["close"][-k]
+    st["vsum"] += vol
+    if len(st["vol"]) >= 5:
+        st["vsum"] -= st["vol"][-5]
+
+    st["dates"].append(d)
+    st["close"].append(close)
+    st["vol"].append(vol)
+    del st["dates"][:-IND_RING], st["close"][:-IND_RING], st["vol"][:-5]
+
+    hi, lo = st["hi"], st["lo"]
+    while hi and hi[-1][1] <= high:
+        hi.pop()
+    hi.append([i, high])
+    while lo and lo[-1][1] >= low:
+        lo.pop()
+    lo.append([i, low])
+    for q in (hi, lo):
+        if q[0][0] <= i - CONSOL_DAYS:
+            q.pop(0)
+
+    st["n"] = i + 1
+    st["through"] = d
+    if st["n"] % IND_RESUM_EVERY == 0:
+        for k in MA_WINDOWS:
+            st["sum"][str(k)] = float(sum(st["close"][-k:]))
+
+
+def indicator_values(st: dict, start: dt.date) -> dict:
+    """
+    Indicators of the bars folded so far. n_bars only counts bars on/after start
+    (capped at IND_RING), so windows are checked against the same history as before.
+    """
+    s = start.isoformat()
+    n = len(st["dates"]) - int(np.searchsorted(st["dates"], s)) if st["dates"] else 0
+    nan = float("nan")
+    out = {
+        "n_bars": n,
+        "last_close": st["close"][-1] if st["close"] else nan,
+        "ma5": st["vsum"] / 5.0 if len(st["vol"]) >= 5 else nan,
+        "high20": st["hi"][0][1] if st["n"] >= CONSOL_DAYS else nan,
+        "low20": st["lo"][0][1] if st["n"] >= CONSOL_DAYS else nan,
+    }
+    for k in MA_WINDOWS:
+        out[f"ma{k}"] = st["sum"][str(k)] / k if n >= k else nan
+    return out
+
+
+def _ind_valid(st: dict | None, z: dict, cut: int) -> bool:
+    """Can st be advanced over the stored bars [.., cut)? (same start, last folded bar unchanged)"""
+    dates = z["date"]
+    if st is None or not len(dates) or st["first"] != str(dates[0]):
+        return False
+    if st["through"] is None:
+        return True
+    k = int(np.searchsorted(dates, np.datetime64(st["through"], "D")))
+    return k < cut and str(dates[k]) == st["through"] and float(z["close"][k]) == st["close"][-1]
+
+
+def _store_covers(z: dict | None, start: dt.date, end: dt.date) -> bool:
+    if z is None:
+        return False
+    synced_from, synced_through = _to_date(z["synced_from"]), _to_date(z["synced_through"])
+    return synced_from is not None and synced_from <= start and synced_through >= end
+
+
+def indicator_state(stock_id: str, start: dt.date, asof: dt.date, include_asof: bool = False) -> dict:
+    """
+    Indicators over the stock's bars in [start, asof) (or [start, asof]).
+    Missing history is fetched into the store first (through the session before asof, or
+    asof itself with include_asof); the
+    persisted state is then advanced over the new bars only, or rebuilt from the store
+    when it ran past asof or the stored bars changed underneath it.
+    "complete" says whether the store covered the whole window (False: the fetch failed).
+    """
+    # bars before asof only need the store complete through the previous session
+    need = asof if include_asof else (prev_trade_day(asof) or asof - dt.timedelta(days=1))
+    z = _store_read(stock_id)
+    if not _store_covers(z, start, need):
+        get_price_history(stock_id, start, need)
+        z = _store_read(stock_id)
+    complete = _store_covers(z, start, need)
+    if z is None or not len(z["date"]):
+        return dict(indicator_values(_ind_new(""), start), complete=complete)
+
+    z["date"] = z["date"].astype("datetime64[D]")
+    cut = int(np.searchsorted(z["date"], np.datetime64(asof, "D"), side="right" if include_asof else "left"))
+
+    states = _ind_load()
+    with _ind_lock:
+        st = states.get(stock_id)
+    if _ind_valid(st, z, cut):
+        lo = int(np.searchsorted(z["date"], np.datetime64(st["through"], "D"), side="right")) \
+            if st["through"] else 0
+    else:
+        st, lo = _ind_new(str(z["date"][0])), 0
+
+    for i in range(lo, cut):
+        indicator_push(st, str(z["date"][i]), float(z["max"][i]), float(z["min"][i]),
+                       float(z["close"][i]), int(z["Trading_Volume"][i]))
+    with _ind_lock:
+        states[stock_id] = st
+    return dict(indicator_values(st, start), complete=complete)
+
+
+def indicators_asof(codes: list[str], asof: dt.date, start: dt.date | None = None,
+                    include_asof: bool = False, done: dict | None = None, on_done=None) -> dict:
+    """
+    indicator_state for many codes (fanned out over the HTTP pool for missing history),
+    as arrays aligned to codes. start defaults to HISTORY_DAYS before asof. Saves the states.
+    done: code -> values from an earlier, interrupted run (not recomputed);
+    on_done(code, values) is called from the workers as each remaining code finishes.
+    """
+    start = start or asof - dt.timedelta(days=HISTORY_DAYS)
+    done = done or {}
+    uniq = [c for c in dict.fromkeys(codes) if c not in done]
+
+    def one(c):
+        v = indicator_state(c, start, asof, include_asof)
+        if on_done is not None:
+            on_done(c, v)
+        return v
+
+    by_code = dict(done, **dict(zip(uniq, parallel_map(one, uniq))))
+    _ind_save()
+    return indicator_arrays([by_code[c] for c in codes])
+
+
+def indicator_arrays(values: list[dict]) -> dict:
+    """indicator_values dicts -> one array per indicator (n_bars int64, the rest float)."""
+    keys = ["n_bars", "last_close", "ma5", "high20", "low20"] + [f"ma{k}" for k in MA_WINDOWS]
+    out = {k: np.array([v[k] for v in values], dtype=float) for k in keys}
+    out["n_bars"] = out["n_bars"].astype(np.int64)
+    return out
+
+
+def _ind_save():
+    with _ind_lock:
+        if _ind is not None:
+            _save_json(INDICATOR_PATH, _ind)
+
+
+# =======================
+# Pre-screen (stored bars before any FinMind history)
+# =======================
+PRESCREEN_PATH = os.path.join(DATA_DIR, "prescreen.json")
+PRESCREEN_DECAY = 0.9    # weight of earlier runs in the pass-rate / cost estimates
+
+
+def _prescreen_stats() -> dict:
+    try:
+        with open(PRESCREEN_PATH, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def prescreen_order(stats: dict) -> list[str]:
+    """
+    BREAKOUT_PREDICATES names, best first: lowest observed cost per row / reject rate
+    (a predicate not seen yet counts as free and rejecting half its rows).
+    """
+    def rank(name):
+        st = stats.get(name) or {}
+        seen = st.get("seen", 0.0)
+        if seen <= 0:
+            return 0.0
+        reject = 1.0 - st["passed"] / seen
+        return (st["sec"] / seen) / max(reject, 1e-6)
+
+    return sorted(BREAKOUT_PREDICATES, key=rank)
+
+
+def prescreen_windows(codes: list[str], asof: dt.date) -> tuple[dict, np.ndarray]:
+    """
+    Window stats (prev_close, ma5, high20, low20) of each code from the bars already stored,
+    plus depth: how many of the latest sessions before asof (per the calendar) the store holds
+    without a gap. A stat is NaN unless depth covers its window, i.e. unless it equals what the
+    full history would give. depth is 0 when the calendar does not reach asof.
+    """
+    n = len(codes)
+    w = {k: np.full(n, np.nan) for k in ("prev_close", "ma5", "high20", "low20")}
+    depth = np.zeros(n, dtype=np.int64)
+    if prev_trade_day(asof) is None:
+        return w, depth
+    sessions = np.array([d for d in last_trade_days(CONSOL_DAYS + 1, asof) if d < asof][:CONSOL_DAYS][::-1],
+                        dtype="datetime64[D]")
+    day = np.datetime64(asof, "D")
+    for i, code in enumerate(codes):
+        z = _store_read(code)
+        if z is None:
+            continue
+        k = int(np.searchsorted(z["date"].astype("datetime64[D]"), day))
+        dates = z["date"][max(0, k - len(sessions)):k].astype("datetime64[D]")
+        m = min(len(dates), len(sessions))
+        bad = np.flatnonzero(dates[len(dates) - m:] != sessions[len(sessions) - m:])
+        d = depth[i] = m - 1 - int(bad[-1]) if len(bad) else m     # trailing sessions all stored
+        if d >= 1:
+            w["prev_close"][i] = float(z["close"][k - 1])
+        if d >= 5:
+            w["ma5"][i] = int(z["Trading_Volume"][k - 5:k].sum()) / 5.0
+        if d >= CONSOL_DAYS:
+            w["high20"][i] = float(z["max"][k - CONSOL_DAYS:k].max())
+            w["low20"][i] = float(z["min"][k - CONSOL_DAYS:k].min())
+    return w, depth
+
+
+def prescreen(sub: pd.DataFrame, asof: dt.date, learn: bool = True) -> np.ndarray:
+    """
+    Mask of the candidate rows (all for asof) that can still pass breakout_tests, judged
+    from stored bars only, so history is fetched for survivors alone. A predicate only
+    rejects rows whose stored window is complete (prescreen_windows), so it rejects exactly
+    the rows the full check would. Predicates run in prescreen_order over the rows still
+    alive; pass rates and cost feed PRESCREEN_PATH for the next run (learn=False: rows
+    already counted, e.g. a resumed run, leave the stats as they are).
+    """
+    alive = np.ones(len(sub), dtype=bool)
+    if sub.empty:
+        return alive
+    w, depth = prescreen_windows([str(x) for x in sub["Code"]], asof)
+    c = sub["ClosingPrice"].to_numpy(dtype=float)
+    v = sub["TradeVolume"].to_numpy(dtype=float)
+
+    stats = _prescreen_stats()
+    log = []
+    for name in prescreen_order(stats):
+        need, test = BREAKOUT_PREDICATES[name]
+        rows = np.flatnonzero(alive & (depth >= need))
+        t = time.perf_counter()
+        with np.errstate(invalid="ignore", divide="ignore"):
+            ok = np.broadcast_to(test(c[rows], v[rows], {k: a[rows] for k, a in w.items()}), rows.shape)
+        sec = time.perf_counter() - t
+        alive[rows[~ok]] = False
+
+        if learn:
+            st = stats.setdefault(name, {"seen": 0.0, "passed": 0.0, "sec": 0.0})
+            for key, x in (("seen", len(rows)), ("passed", int(ok.sum())), ("sec", sec)):
+                st[key] = st[key] * PRESCREEN_DECAY + x
+        metric_count(f"prescreen.{name}.seen", len(rows))
+        metric_count(f"prescreen.{name}.passed", int(ok.sum()))
+        log.append(f"{name} {int(ok.sum())}/{len(rows)}")
+    if learn:
+        _save_json(PRESCREEN_PATH, stats)
+
+    print(f"[PRESCREEN] {asof} " + " -> ".join(log) +
+          f" | {int(alive.sum())}/{len(sub)} go on to the history check")
+    return alive
+
+
+# =======================
+# Breakout engine (vectorized over candidates)
+# =======================
+HISTORY_DAYS = 500                          # calendar days of history behind each check
+
+
+def _resolve_asof(today_row: pd.Series) -> dt.date:
+    """
+    用 today_row 的交易日當 asof，避免休市/假日 dt.date.today() 對不上
+    Date 可能是 "20260105"、"2026-01-05" 或民國 "1150105"; missing -> latest trade day from the calendar (or today).
+    """
+    if "Date" in today_row:
+        d = _parse_trade_date(today_row["Date"])
+        if d is not None:
+            return d
+        print("[CHECK] unparseable Date, using the latest trade day:", repr(today_row["Date"]))
+    today = dt.date.today()
+    return last_trade_day(today) or today
+
+
+def _range_width(high20, low20):
+    return np.where(low20 > 0, (high20 - low20) / low20, 999.0)
+
+
+# check_one_stock's rejection tests: name -> (bars before today the test reads,
+# pass mask from today's close c / volume v and the window stats w of those bars)
+BREAKOUT_PREDICATES = {
+    # 漲跌幅：收 - 昨收（用 base 最後一天 close 當昨收）
+    "chg_vs_prev": (1, lambda c, v, w: (w["prev_close"] > 0) &
+                    ~((c - w["prev_close"]) / w["prev_close"] < 0.03)),
+    # Volume：MA5 不含今日
+    "vol_mult": (5, lambda c, v, w: (w["ma5"] > 0) & (v > VOL_MULT * w["ma5"])),
+    # 盤整突破：前 CONSOL_DAYS（不含今日）
+    "consolidation": (CONSOL_DAYS, lambda c, v, w: ~(_range_width(w["high20"], w["low20"]) > MAX_RANGE_PCT)),
+    "breakout": (CONSOL_DAYS, lambda c, v, w: (c >= w["high20"] * (1.0 + BREAKOUT_PCT)) &
+                 ((v > w["ma5"]) if BREAKOUT_VOL_GT_MA5 else True)),
+}
+
+
+def breakout_tests(c, v, n_bars, prev_close, ma5, high20, low20, funnel: dict | None = None) -> dict:
+    """
+    check_one_stock's rejection tests on arrays of per-stock window stats
+    (today's close / volume vs. the bars before today). Returns derived values plus "ok".
+    funnel (optional) receives the rows surviving each test, in order.
+    """
+    w = {"prev_close": prev_close, "ma5": ma5, "high20": high20, "low20": low20}
+    with np.errstate(invalid="ignore", divide="ignore"):
+        chg_pct = (c - prev_close) / prev_close
+        vol_mult = np.where(ma5 > 0, v / ma5, 0.0)
+        width = _range_width(high20, low20)
+        break_pct = np.where(high20 > 0, c / high20 - 1.0, 0.0)
+
+        ok = n_bars >= (CONSOL_DAYS + 6)
+        funnel_step(funnel, "history", ok)
+        for name, (_, test) in BREAKOUT_PREDICATES.items():
+            ok = ok & test(c, v, w)
+            funnel_step(funnel, name, ok)
+
+    return {
+        "ok": ok,
+        "chg_pct": chg_pct,
+        "vol_mult": vol_mult,
+        "range20_pct": width,
+        "break_pct": break_pct,
+    }
+
+
+def check_candidates(cand: pd.DataFrame, ckpt: str | None = None) -> list[dict]:
+    """
+    Vectorized check_one_stock over every candidate row (same output, same order).
+    Uses FinMind / store history to validate:
+    - vol_mult > VOL_MULT x MA5 (exclude today)
+    - consolidation breakout on prev CONSOL_DAYS
+    - pct change: (close - prev_close) / prev_close  (收-昨收)
+    - MA20/MA60/MA120 context for A/B tagging
+    ckpt: run checkpoint key. Each stock's indicators are checkpointed once its history
+    is complete, and a rerun only recomputes the stocks that hadn't finished.
+    """
+    if cand.empty:
+        return []
+
+    cand = cand.reset_index(drop=True)
+    asofs = [_resolve_asof(r) for _, r in cand.iterrows()] if "Date" in cand.columns \
+        else [_resolve_asof(pd.Series(dtype=object))] * len(cand)
+
+    done = {(r["asof"], r["code"]): r["ind"] for r in ckpt_records(ckpt, "checks")}
+    if done:
+        print(f"[CKPT] {ckpt} checks: {len(done)} stocks resumed")
+        metric_count("checkpoint.checks_resumed", len(done))
+    # dates whose pre-screen already fed PRESCREEN_PATH: a resumed run must not count them twice
+    screened = {r["asof"] for r in ckpt_records(ckpt, "prescreen")}
+
+    hits: dict[int, dict] = {}
+    funnel = {"input": len(cand)}
+    for asof in sorted(set(asofs)):
+        idx = [i for i, a in enumerate(asofs) if a == asof]
+        day = asof.isoformat()
+        keep = prescreen(cand.iloc[idx], asof, learn=day not in screened)
+        if ckpt and day not in screened:
+            ckpt_append(ckpt, "prescreen", {"asof": day})
+        funnel_step(funnel, "prescreen", keep)
+        idx = [i for i, k in zip(idx, keep) if k]
+        if not idx:
+            continue
+        sub = cand.iloc[idx]
+        codes = [str(x) for x in sub["Code"]]
+
+        def save(code, values, day=day):
+            if values["complete"]:
+                ckpt_append(ckpt, "checks", {"asof": day, "code": code, "ind": values})
+
+        ind = indicators_asof(codes, asof, done={c: done[(day, c)] for c in codes if (day, c) in done},
+                              on_done=save if ckpt else None)
+        for j, hit in breakout_hits(sub, ind, funnel).items():
+            hits[idx[j]] = hit
+
+    for k, n in funnel.items():
+        metric_count(f"breakout.{k}", n)
+    return [hits[i] for i in sorted(hits)]
+
+
+def breakout_hits(sub: pd.DataFrame, ind: dict, funnel: dict | None = None) -> dict[int, dict]:
+    """
+    breakout_tests on candidate rows against their prior-day indicators (indicator_arrays,
+    aligned to sub). Returns {row position: hit record} for the rows that pass.
+    """
+    f = breakout_tests(sub["ClosingPrice"].to_numpy(dtype=float), sub["TradeVolume"].to_numpy(dtype=float),
+                       ind["n_bars"], ind["last_close"], ind["ma5"], ind["high20"], ind["low20"], funnel)
+    f.update(ind)
+
+    hits = {}
+    for j in np.flatnonzero(f["ok"]):
+        r = sub.iloc[j]
+        hits[int(j)] = {
+            "Code": str(r["Code"]),
+            "Name": str(r["Name"]),
+            "Market": str(r.get("Market", "twse")),
+            "chg": float(r["chg_pct"]),
+            "vol_mult": float(f["vol_mult"][j]),
+            "lots": float(float(r["TradeVolume"]) / LOTS_UNIT),
+            "range20_pct": float(f["range20_pct"][j]),
+            "break_pct": float(f["break_pct"][j]),
+
+            # MA context (FinMind close, EXCLUDE today)
+            "close": float(r["ClosingPrice"]),
+            "ma20": None if np.isnan(f["ma20"][j]) else float(f["ma20"][j]),
+            "ma60": None if np.isnan(f["ma60"][j]) else float(f["ma60"][j]),
+            "ma120": None if np.isnan(f["ma120"][j]) else float(f["ma120"][j]),
+        }
+    return hits
+
+
+def check_one_stock(stock_id: str, today_row: pd.Series) -> dict | None:
+    """Single-stock form of check_candidates (kept for ad-hoc checks)."""
+    row = today_row.copy()
+    row["Code"] = stock_id
+    res = check_candidates(pd.DataFrame([row]))
+    return res[0] if res else None
+
+
+def is_signal_a(x: dict) -> bool:
+    """A: MA20 > MA60 > MA120 且 close > MA20 (any MA missing -> B)."""
+    close = x.get("close")
+    ma20 = x.get("ma20")
+    ma60 = x.get("ma60")
+    ma120 = x.get("ma120")
+    return (
+        close is not None
+        and ma20 is not None
+        and ma60 is not None
+        and ma120 is not None
+        and (ma20 > ma60 > ma120)
+        and (close > ma20)
+    )
+
+
+def hit_line(x: dict, main_sectors: set) -> str:
+    """One Telegram line per hit."""
+    sec = x.get("Sector", "Unknown")
+    tag = "🔥🔥" if sec in main_sectors else "•"
+    ma20 = x.get("ma20", None)
+    ma60 = x.get("ma60", None)
+    ma120 = x.get("ma120", None)
+
+    ma_txt = ""
+    if (ma20 is not None) and (ma60 is not None) and (ma120 is not None):
+        ma_txt = f"｜MA20 {ma20:.2f}｜MA60 {ma60:.2f}｜MA120 {ma120:.2f}"
+
+    return f"{tag}{x['Code']} {x['Name']}｜{x['chg']:.1f}%｜量倍 {x['vol_mult']:.2f}x｜突破 {x['break_pct']*100:.1f}%｜{sec}{ma_txt}"
+
+
+# =======================
+# Run checkpoints (a rerun for the same signal date resumes)
+# =======================
+CHECKPOINT_DIR = os.path.join(DATA_DIR, "checkpoints")   # <snapshot date>/<stage>.json(l)
+CHECKPOINT_KEEP = 5      # signal dates kept
+
+_ckpt_lock = threading.Lock()
+
+
+def _ckpt_path(key: str, stage: str, ext: str = "json") -> str:
+    return os.path.join(CHECKPOINT_DIR, key, f"{stage}.{ext}")
+
+
+def ckpt_open(latest: pd.DataFrame, force: bool = False) -> str | None:
+    """
+    Checkpoint key of a run = trade date of the latest snapshot (None when it has none:
+    nothing is checkpointed then). force drops what earlier runs saved for that date.
+    """
+    d = _snapshot_date(latest)
+    if d is None:
+        return None
+    key = d.isoformat()
+    folder = os.path.join(CHECKPOINT_DIR, key)
+    if force:
+        shutil.rmtree(folder, ignore_errors=True)
+        print(f"[CKPT] {key}: forced, recomputing every stage")
+    elif os.path.isdir(folder):
+        print(f"[CKPT] {key}: resuming from", ", ".join(sorted(os.listdir(folder))) or "(empty)")
+    if os.path.isdir(CHECKPOINT_DIR):     # this run's date + the newest CHECKPOINT_KEEP - 1 others
+        others = sorted(x for x in os.listdir(CHECKPOINT_DIR) if x != key)
+        for old in others[:max(len(others) - CHECKPOINT_KEEP + 1, 0)]:
+            shutil.rmtree(os.path.join(CHECKPOINT_DIR, old), ignore_errors=True)
+    return key
+
+
+def ckpt_load(key: str | None, stage: str):
+    if key is None:
+        return None
+    try:
+        with open(_ckpt_path(key, stage), "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def ckpt_append(key: str, stage: str, rec: dict):
+    """One line of a per-item checkpoint; written as each item finishes, so a crash keeps them."""
+    with _ckpt_lock:
+        try:
+            os.makedirs(os.path.join(CHECKPOINT_DIR, key), exist_ok=True)
+            with open(_ckpt_path(key, stage, "jsonl"), "a", encoding="utf-8") as f:
+                f.write(json.dumps(rec, ensure_ascii=False) + "\n")
+        except OSError as e:
+            print("[CKPT] write failed:", key, stage, repr(e))
+
+
+def ckpt_records(key: str | None, stage: str) -> list[dict]:
+    """Lines written by ckpt_append (a line torn by a crash is skipped)."""
+    if key is None:
+        return []
+    out = []
+    try:
+        with open(_ckpt_path(key, stage, "jsonl"), "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    out.append(json.loads(line))
+                except ValueError:
+                    pass
+    except OSError:
+        pass
+    return out
+
+
+def checkpointed(key: str | None, stage: str, compute, dump=None, load=None, keep=None):
+    """
+    compute() at most once per signal date: a result saved under (key, stage) is loaded
+    instead. dump / load convert to and from JSON; keep(result) False = don't save it
+    (e.g. missing data, so a rerun tries again).
+    """
+    saved = ckpt_load(key, stage)
+    if saved is not None:
+        print(f"[CKPT] {key} {stage}: resumed")
+        metric_count("checkpoint.resumed")
+        return load(saved) if load else saved
+    out = compute()
+    if key is not None and (keep is None or keep(out)):
+        os.makedirs(os.path.join(CHECKPOINT_DIR, key), exist_ok=True)
+        _save_json(_ckpt_path(key, stage), dump(out) if dump else out)
+    return out
+
+
+def _frame_dump(df: pd.DataFrame) -> dict:
+    return df.to_dict(orient="split", index=False)
+
+
+def _frame_load(j: dict) -> pd.DataFrame:
+    return pd.DataFrame(j["data"], columns=j["columns"])
+
+
+# =======================
+# Stage scheduler (run() as a dependency graph)
+# =======================
+class Stages:
+    """
+    Stages of one run as a small dependency graph. Every stage gets its own thread and
+    starts as soon as its dependencies have finished, so independent I/O overlaps.
+    stages: name -> (dependency names, fn(dict of dependency results)), dependencies first.
+    get() waits for one result (re-raising the stage's error). Leaving the with-block
+    cancels the rest: stages not yet started raise StageCancelled, running ones stop at
+    their next HTTP call; then records the critical path.
+    """
+
+    def __init__(self, stages: dict):
+        self.stages = stages
+        self.times: dict[str, tuple[float, float]] = {}
+        self._cancelled = threading.Event()
+        self._pool = ThreadPoolExecutor(max_workers=len(stages), thread_name_prefix="stage")
+        self._futs = {}
+        for name, (deps, _) in stages.items():
+            assert all(d in self._futs for d in deps), f"stage {name}: dependencies must come first"
+            self._futs[name] = self._pool.submit(self._run, name)
+
+    def _run(self, name: str):
+        deps, fn = self.stages[name]
+        res = {d: self._futs[d].result() for d in deps}
+        if self._cancelled.is_set():
+            raise StageCancelled(name)
+        _stage_ctx.cancelled = self._cancelled
+        t = time.perf_counter()
+        try:
+            with span(name):
+                return fn(res)
+        finally:
+            self.times[name] = (t, time.perf_counter())
+
+    def get(self, name: str):
+        return self._futs[name].result()
+
+    def cancel(self):
+        self._cancelled.set()
+
+    def critical_path(self) -> list[str]:
+        """Chain of stages that gated the last one to finish (latest-finishing dependency first)."""
+        done = dict(self.times)
+        if not done:
+            return []
+        path = [max(done, key=lambda n: done[n][1])]
+        while True:
+            deps = [d for d in self.stages[path[-1]][0] if d in done]
+            if not deps:
+                return path[::-1]
+            path.append(max(deps, key=lambda d: done[d][1]))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.cancel()
+        self._pool.shutdown(wait=True)
+        path = self.critical_path()
+        if path:
+            wall = max(e for _, e in self.times.values()) - min(t for t, _ in self.times.values())
+            busy = sum(e - t for t, e in self.times.values())
+            print("[RUN] critical path: " +
+                  " -> ".join(f"{n} {self.times[n][1] - self.times[n][0]:.2f}s" for n in path) +
+                  f" | stages {wall:.2f}s wall, {busy:.2f}s summed")
+            with _metrics_lock:
+                METRICS["critical_path"] = path
+        return False
+
+
+def run(force: bool = False):
+    """
+    Daily scan. Each stage's output is checkpointed under the snapshot's trade date, so
+    a rerun for the same date resumes after the last finished stage (and only redoes
+    the per-stock checks that hadn't finished); force recomputes everything.
+    """
+    print("Starting scanner")
+
+    # -------------------------
+    # Helper: always export json
+    # -------------------------
+    def export_scanner_result(stocks: list[str], signal_date: str, stocks_a: list[str] | None = None, stocks_b: list[str] | None = None):
+        import json
+        data = {
+            "signal_date": signal_date,
             "stocks": stocks,          # keep for tracker compatibility
             "stocks_a": stocks_a or [],
             "stocks_b": stocks_b or [],
@@ -473,129 +2429,1372 @@ def run():
     # Default signal date = today (will be updated if we have trade_days)
     signal_date = dt.date.today().strftime("%Y-%m-%d")
 
-    ok, msg = market_above_ma60(dt.date.today())
-    send_telegram(("✅ 大盤站上季線：" if ok else "❌ 大盤未站上季線：") + msg)
-    if not ok:
-        export_scanner_result([], signal_date, [], [])
-        return
+    # The latest snapshot goes first: it brings the local store (incl. 0050) and the calendar
+    # up to date, so the market check, the lookback and per-stock history read from disk.
+    # Its trade date keys the checkpoints (run_key) every later stage resumes from.
+    stages = Stages({
+        "sync_latest_snapshot": ([], lambda r: sync_latest_snapshot()),
+        "run_key": (["sync_latest_snapshot"], lambda r: ckpt_open(r["sync_latest_snapshot"], force)),
+        "sector_map": (["run_key"], lambda r: checkpointed(
+            r["run_key"], "sector_map", load_sector_map,
+            dump=lambda m: {"stamp": sector_map_stamp(m), "map": dict(m)},
+            load=lambda j: SectorMap(j["map"], j["stamp"]),
+            keep=len)),
+        # a verdict only; "not enough history" is retried on the next run
+        "market_check": (["run_key"], lambda r: checkpointed(
+            r["run_key"], "market_check", lambda: market_above_ma60(dt.date.today()),
+            load=tuple, keep=lambda res: res[1].startswith(MARKET_PROXY))),
+        "sector_lookback": (["run_key"], lambda r: None if ckpt_load(r["run_key"], "main_sectors") is not None
+                            else sector_lookback_days()),
+        "load_candidates": (["sync_latest_snapshot", "run_key"], lambda r: checkpointed(
+            r["run_key"], "candidates", lambda: load_today_candidates(r["sync_latest_snapshot"]),
+            dump=_frame_dump, load=_frame_load)),
+        "main_sectors": (["run_key", "sector_map", "sector_lookback"], lambda r: checkpointed(
+            r["run_key"], "main_sectors",
+            lambda: compute_5day_main_sectors(r["sector_map"], r["sector_lookback"]),
+            dump=lambda res: {"main": sorted(res[0]), "trade_days": res[1]},
+            load=lambda j: (set(j["main"]), j["trade_days"]),
+            keep=lambda res: bool(res[1]))),
+        # fetches history per candidate: only once the market check has passed
+        "validate": (["run_key", "load_candidates", "market_check"],
+                     lambda r: check_candidates(r["load_candidates"], r["run_key"])
+                     if r["market_check"][0] else []),
+    })
+    # results are consumed in message order; returning early cancels stages not yet started
+    with stages:
+        ok, msg = stages.get("market_check")
+        send_telegram(("✅ 大盤站上季線：" if ok else "❌ 大盤未站上季線：") + msg)
+        if not ok:
+            export_scanner_result([], signal_date, [], [])
+            return
+
+        sector_map = stages.get("sector_map")
+        main_sectors, trade_days = stages.get("main_sectors")
+
+        # Update signal_date from trade_days[0] if available (YYYYMMDD -> YYYY-MM-DD)
+        if trade_days and isinstance(trade_days[0], str) and len(trade_days[0]) == 8:
+            signal_date = f"{trade_days[0][0:4]}-{trade_days[0][4:6]}-{trade_days[0][6:8]}"
+
+        if main_sectors:
+            send_telegram("🔥🔥 5日主流族群（近5日Top5入榜≥3日）：\n" + "、".join(sorted(main_sectors)))
+        else:
+            send_telegram("ℹ️ 5日主流族群：資料不足或無法辨識（main_sectors 為空）")
+
+        cand = stages.get("load_candidates")
+        if cand.empty:
+            send_telegram("✅ 今日無符合『爆量長紅』初篩個股")
+            export_scanner_result([], signal_date, [], [])
+            return
+
+        hits = stages.get("validate")
+        metric_count("signals.hits", len(hits))
+        for res, sec in zip(hits, sector_lookup(sector_map, [res["Code"] for res in hits])):
+            res["Sector"] = sec
+
+        if not hits:
+            send_telegram("✅ 今日無符合『爆量長紅＋盤整突破（含2×5日均量）』個股")
+            export_scanner_result([], signal_date, [], [])
+            return
+        # =====================================================
+        # A / B 分類（嚴格版）
+        # A: MA20 > MA60 > MA120 且 close > MA20
+        # =====================================================
+
+        hitsA = []
+        hitsB = []
+
+        for x in hits:
+            if is_signal_a(x):
+                x["signal_type"] = "A"
+                hitsA.append(x)
+            else:
+                x["signal_type"] = "B"
+                hitsB.append(x)
+
+        # ---- helper for sorting
+        def is_main(sec: str) -> int:
+            return 1 if sec in main_sectors else 0
+
+        # ---- keep your original priority logic, but apply within A then B
+        def sort_key(x):
+            return (is_main(x.get("Sector", "")), x.get("chg", 0), x.get("vol_mult", 0))
+
+        hitsA = sorted(hitsA, key=sort_key, reverse=True)
+        hitsB = sorted(hitsB, key=sort_key, reverse=True)
+
+        # ---- Telegram output
+        def build_lines(xs, title):
+            if not xs:
+                return None
+            lines = [hit_line(x, main_sectors) for x in xs[:30]]
+            return f"{title}\n" + "\n".join(lines)
+
+        msgA = build_lines(hitsA, "🅰️ 訊號A（MA20>MA60>MA120 + close>MA20）")
+        msgB = build_lines(hitsB, "🅱️ 訊號B（符合原條件，但未達A）")
+
+        metric_count("signals.A", len(hitsA))
+        metric_count("signals.B", len(hitsB))
+        with span("notify"):
+            if msgA:
+                send_telegram(msgA)
+            if msgB:
+                send_telegram(msgB)
+
+        # ---- every field of every hit into the local signal history
+        signals_append(signal_date, hitsA + hitsB, main_sectors)
+
+        # ---- Export json for tracker dispatch (keep stocks = all)
+        export_scanner_result(
+            stocks=[str(x["Code"]) for x in (hitsA + hitsB)],
+            signal_date=signal_date,
+            stocks_a=[str(x["Code"]) for x in hitsA],
+            stocks_b=[str(x["Code"]) for x in hitsB],
+        )
+        print("=== EOF reached ===")
 
-    sector_map = load_sector_map()
-    main_sectors, trade_days = compute_5day_main_sectors(sector_map)
+# =======================
+# Intraday watch (poll a snapshot source during the session)
+# =======================
+# any STOCK_DAY_ALL-shaped JSON source updated during the session; no default, since
+# STOCK_DAY_ALL itself only publishes after the close (every poll would be yesterday's)
+WATCH_URL = os.getenv("WATCH_URL", "")
+WATCH_INTERVAL = int(os.getenv("WATCH_INTERVAL", "60"))   # sec between polls
+WATCH_UNTIL = os.getenv("WATCH_UNTIL", "13:35")           # Taipei time
+WATCH_DIR = os.path.join(DATA_DIR, "watch")               # codes already alerted, per day
+WATCH_KEY = ["OpeningPrice", "HighestPrice", "LowestPrice", "ClosingPrice", "TradeVolume"]
+TW_TZ = dt.timezone(dt.timedelta(hours=8))
+
+
+def watch_poll() -> pd.DataFrame:
+    """One uncached read of WATCH_URL, parsed like STOCK_DAY_ALL. Never raises; empty on failure."""
+    try:
+        r = http_request("twse", "GET", WATCH_URL, params={"response": "json"}, timeout=30)
+        if r.status_code != 200:
+            print("[WATCH] poll status:", r.status_code)
+            return pd.DataFrame()
+        return parse_stock_day_all(r.json())
+    except Exception as e:
+        print("[WATCH] poll failed:", repr(e))
+        return pd.DataFrame()
 
-    # Update signal_date from trade_days[0] if available (YYYYMMDD -> YYYY-MM-DD)
-    if trade_days and isinstance(trade_days[0], str) and len(trade_days[0]) == 8:
-        signal_date = f"{trade_days[0][0:4]}-{trade_days[0][4:6]}-{trade_days[0][6:8]}"
 
-    if main_sectors:
-        send_telegram("🔥🔥 5日主流族群（近5日Top5入榜≥3日）：\n" + "、".join(sorted(main_sectors)))
-    else:
-        send_telegram("ℹ️ 5日主流族群：資料不足或無法辨識（main_sectors 為空）")
+def changed_rows(df: pd.DataFrame, prev: pd.DataFrame | None) -> pd.DataFrame:
+    """Rows of df whose prices / volume differ from prev (codes missing from prev count as changed)."""
+    if prev is None or prev.empty:
+        return df
+    old = prev.drop_duplicates("Code").set_index("Code")[WATCH_KEY].reindex(df["Code"])
+    diff = (df[WATCH_KEY].to_numpy(dtype=float) != old.to_numpy(dtype=float)).any(axis=1)
+    return df[diff]
+
 
-    cand = load_today_candidates()
+def _watch_alerted(d: dt.date) -> set:
+    try:
+        with open(os.path.join(WATCH_DIR, f"{d.isoformat()}.json"), "r", encoding="utf-8") as f:
+            return set(json.load(f))
+    except (OSError, ValueError):
+        return set()
+
+
+def watch_cycle(df: pd.DataFrame, prev: pd.DataFrame | None, state: dict, alerted: set,
+                asof: dt.date) -> tuple[int, int, list[dict]]:
+    """
+    One poll: 爆量長紅 filter on the changed rows only, then breakout checks against the
+    prior-day indicators in state (filled once per code). Returns (changed, candidates, new hits).
+    """
+    changed = changed_rows(df, prev)
+    if changed.empty:
+        return 0, 0, []
+    cand = load_today_candidates(changed).reset_index(drop=True)
     if cand.empty:
-        send_telegram("✅ 今日無符合『爆量長紅』初篩個股")
-        export_scanner_result([], signal_date, [], [])
+        return len(changed), 0, []
+
+    codes = [str(x) for x in cand["Code"]]
+    missing = [c for c in dict.fromkeys(codes) if c not in state]
+    if missing:
+        start = asof - dt.timedelta(days=HISTORY_DAYS)
+        state.update(zip(missing, parallel_map(lambda c: indicator_state(c, start, asof), missing)))
+        _ind_save()
+
+    hits = breakout_hits(cand, indicator_arrays([state[c] for c in codes]))
+    new = [x for x in hits.values() if x["Code"] not in alerted]
+    return len(changed), len(cand), new
+
+
+def watch(interval: int = WATCH_INTERVAL, until: str = WATCH_UNTIL, max_polls: int | None = None,
+          allow_stale: bool = False):
+    """
+    Poll WATCH_URL every `interval` seconds until `until` (Taipei time) and send a Telegram
+    alert for each stock that newly passes the 爆量長紅 + breakout checks today.
+    Snapshots dated before today are skipped unless allow_stale (replaying a recorded feed).
+    """
+    if not WATCH_URL:
+        print("[WATCH] WATCH_URL is not set: no intraday feed to poll "
+              "(STOCK_DAY_ALL is end-of-day only), not watching")
         return
+    now = dt.datetime.now(TW_TZ)
+    today = now.date()
+    hh, mm = (int(x) for x in until.split(":"))
+    deadline = now.replace(hour=hh, minute=mm, second=0, microsecond=0)
 
-    hits = []
-    for _, r in cand.iterrows():
-        sid = str(r["Code"])
-        res = check_one_stock(sid, r)
-        if res:
-            res["Sector"] = sector_map.get(sid, "Unknown")
-            hits.append(res)
-
-    if not hits:
-        send_telegram("✅ 今日無符合『爆量長紅＋盤整突破（含2×5日均量）』個股")
-        export_scanner_result([], signal_date, [], [])
+    ok, msg = market_above_ma60(today)
+    print("[WATCH]", msg)
+    if not ok:
+        print("[WATCH] market below MA60, not watching")
         return
-    # =====================================================
-    # A / B 分類（嚴格版）
-    # A: MA20 > MA60 > MA120 且 close > MA20
-    # =====================================================
-
-    hitsA = []
-    hitsB = []
-
-    for x in hits:
-        close = x.get("close")
-        ma20 = x.get("ma20")
-        ma60 = x.get("ma60")
-        ma120 = x.get("ma120")
-
-        if (
-            close is not None
-            and ma20 is not None
-            and ma60 is not None
-            and ma120 is not None
-            and (ma20 > ma60 > ma120)
-            and (close > ma20)
-        ):
-            x["signal_type"] = "A"
-            hitsA.append(x)
-        else:
-            x["signal_type"] = "B"
-            hitsB.append(x)
 
-    # ---- helper for sorting
-    def is_main(sec: str) -> int:
-        return 1 if sec in main_sectors else 0
+    sector_map = load_sector_map()
+    main_sectors, _ = compute_5day_main_sectors(sector_map)
+
+    state: dict[str, dict] = {}
+    asof, alerted, prev = None, set(), None
+    polls = 0
+    while True:
+        t0 = time.perf_counter()
+        polls += 1
+        with span("watch.poll"):
+            df = watch_poll()
+            d = _snapshot_date(df) or today
+            n_changed = n_cand = 0
+            new = []
+            if not df.empty and d < today and not allow_stale:
+                print("[WATCH] snapshot still dated", d)
+            elif not df.empty:
+                if d != asof:
+                    asof, alerted, prev = d, _watch_alerted(d), None
+                    state.clear()
+                n_changed, n_cand, new = watch_cycle(df, prev, state, alerted, asof)
+                prev = df
+
+        if new:
+            for x, sec in zip(new, sector_lookup(sector_map, [x["Code"] for x in new])):
+                x["Sector"] = sec
+            new.sort(key=lambda x: (x["Sector"] in main_sectors, x["chg"], x["vol_mult"]), reverse=True)
+            lines = [("🅰️ " if is_signal_a(x) else "🅱️ ") + hit_line(x, main_sectors) for x in new]
+            send_telegram(f"⏱ 盤中新突破 {dt.datetime.now(TW_TZ):%H:%M}\n" + "\n".join(lines))
+            alerted.update(x["Code"] for x in new)
+            _save_json(os.path.join(WATCH_DIR, f"{asof.isoformat()}.json"), sorted(alerted))
+        metric_count("watch.alerts", len(new))
+
+        elapsed = time.perf_counter() - t0
+        print(f"[WATCH] poll {polls}: {len(df)} rows, {n_changed} changed, {n_cand} candidates, "
+              f"{len(new)} new in {elapsed:.2f}s")
+        if interval and elapsed > interval:
+            print(f"[WATCH] poll took longer than the {interval}s interval")
+        if (max_polls and polls >= max_polls) or dt.datetime.now(TW_TZ) >= deadline:
+            break
+        time.sleep(max(0.0, interval - elapsed))
 
-    # ---- keep your original priority logic, but apply within A then B
-    def sort_key(x):
-        return (is_main(x.get("Sector", "")), x.get("chg", 0), x.get("vol_mult", 0))
 
-    hitsA = sorted(hitsA, key=sort_key, reverse=True)
-    hitsB = sorted(hitsB, key=sort_key, reverse=True)
+# =======================
+# Universe pack (compact, memory-mapped copy of the store for replay / sweep)
+# =======================
+# One .npy per column over every stored bar, rows sorted by (code, date):
+#   code_id int32 (index into meta codes), date datetime64[D], prices float32, volume int64.
+# meta.json holds the lookup tables (codes, categorical names / sectors) and the store
+# fingerprint it was built from. Columns are opened with mmap_mode="r", so pages come from
+# the OS page cache on touch instead of private float64 / object copies per process.
+PACK_DIR = os.path.join(DATA_DIR, "pack")
+PACK_COLS = ["code_id", "date"] + PRICE_COLS
+PRICE_DECIMALS = 2     # TWSE / FinMind quotes; float32 -> float64 is exact after rounding to this
+
+
+def store_codes() -> list[str]:
+    """Codes held in the local store."""
+    if not os.path.isdir(STORE_DIR):
+        return []
+    return sorted(f[:-4] for f in os.listdir(STORE_DIR) if f.endswith(".npz"))
+
+
+def _pack_source() -> dict:
+    """mtime / size of every store file + names and sector map: the pack is stale once this changes."""
+    src = {}
+    if os.path.isdir(STORE_DIR):
+        for e in os.scandir(STORE_DIR):
+            if e.name.endswith(".npz"):
+                st = e.stat()
+                src[e.name[:-4]] = [st.st_mtime_ns, st.st_size]
+    for key, path in (("_names", NAMES_PATH), ("_sector_map", SECTOR_MAP_PATH)):
+        if os.path.exists(path):
+            src[key] = [os.stat(path).st_mtime_ns, os.stat(path).st_size]
+    return src
+
+
+def _categorical(values: list[str]) -> tuple[list[str], list[int]]:
+    cats = sorted(set(values))
+    pos = {x: i for i, x in enumerate(cats)}
+    return cats, [pos[x] for x in values]
+
+
+def pack_build() -> dict:
+    """Rewrite PACK_DIR from the per-stock store. Returns its meta."""
+    t0 = time.time()
+    source = _pack_source()
+    codes, lens = [], []
+    cols = {c: [] for c in ["date"] + PRICE_COLS}
+    for code in sorted(k for k in source if not k.startswith("_")):
+        z = _store_read(code)
+        if z is None or not len(z["date"]):
+            continue
+        codes.append(code)
+        lens.append(len(z["date"]))
+        cols["date"].append(z["date"].astype("datetime64[D]"))
+        for c in PRICE_COLS:
+            cols[c].append(z[c].astype(np.int64 if c == "Trading_Volume" else np.float32))
+
+    names = _load_names()
+    sector_map = load_sector_map_offline(quiet=True)
+    name_cats, name_id = _categorical([names.get(c, "") for c in codes])
+    sector_cats, sector_id = _categorical(list(sector_lookup(sector_map, codes)))
+    meta = {"codes": codes, "names": name_cats, "name_id": name_id,
+            "sectors": sector_cats, "sector_id": sector_id, "rows": int(sum(lens)), "source": source}
+
+    tmp = PACK_DIR + ".tmp"
+    shutil.rmtree(tmp, ignore_errors=True)
+    os.makedirs(tmp)
+    np.save(os.path.join(tmp, "code_id.npy"), np.repeat(np.arange(len(codes), dtype=np.int32), lens))
+    np.save(os.path.join(tmp, "offsets.npy"), np.concatenate([[0], np.cumsum(lens, dtype=np.int64)]))
+    for c, parts in cols.items():
+        np.save(os.path.join(tmp, f"{c}.npy"), np.concatenate(parts) if parts else _empty_bars()[c].to_numpy())
+    _save_json(os.path.join(tmp, "meta.json"), meta)
+    shutil.rmtree(PACK_DIR, ignore_errors=True)
+    os.replace(tmp, PACK_DIR)
+    print(f"[PACK] {len(codes)} stocks, {meta['rows']} bars in {time.time() - t0:.1f}s -> {PACK_DIR}")
+    return meta
+
+
+def pack_load(refresh: bool = True) -> dict | None:
+    """
+    The universe pack: PACK_COLS memory-mapped read-only, offsets (code i = rows
+    offsets[i]:offsets[i+1]) and meta. Rebuilt first if the store changed (refresh).
+    None if the store holds no bars.
+    """
+    try:
+        with open(os.path.join(PACK_DIR, "meta.json"), "r", encoding="utf-8") as f:
+            meta = json.load(f)
+    except (OSError, ValueError):
+        meta = None
+    if refresh and (meta is None or meta.get("source") != _pack_source()):
+        meta = pack_build()
+    if meta is None or not meta["rows"]:
+        return None
+    pack = {c: np.load(os.path.join(PACK_DIR, f"{c}.npy"), mmap_mode="r") for c in PACK_COLS}
+    pack["offsets"] = np.load(os.path.join(PACK_DIR, "offsets.npy"))
+    pack["meta"] = meta
+    return pack
 
-    # ---- Telegram output
-    def build_lines(xs, title):
-        if not xs:
-            return None
-        lines = []
-        for x in xs[:30]:
-            sec = x.get("Sector", "Unknown")
-            tag = "🔥🔥" if sec in main_sectors else "•"
-            ma20 = x.get("ma20", None)
-            ma60 = x.get("ma60", None)
-            ma120 = x.get("ma120", None)
-
-            ma_txt = ""
-            if (ma20 is not None) and (ma60 is not None) and (ma120 is not None):
-                ma_txt = f"｜MA20 {ma20:.2f}｜MA60 {ma60:.2f}｜MA120 {ma120:.2f}"
-
-            lines.append(
-                f"{tag}{x['Code']} {x['Name']}｜{x['chg']:.1f}%｜量倍 {x['vol_mult']:.2f}x｜突破 {x['break_pct']*100:.1f}%｜{sec}{ma_txt}"
-            )
-        return f"{title}\n" + "\n".join(lines)
-
-    msgA = build_lines(hitsA, "🅰️ 訊號A（MA20>MA60>MA120 + close>MA20）")
-    msgB = build_lines(hitsB, "🅱️ 訊號B（符合原條件，但未達A）")
-
-    if msgA:
-        send_telegram(msgA)
-    if msgB:
-        send_telegram(msgB)
-
-    # ---- Export json for tracker dispatch (keep stocks = all)
-    export_scanner_result(
-        stocks=[str(x["Code"]) for x in (hitsA + hitsB)],
-        signal_date=signal_date,
-        stocks_a=[str(x["Code"]) for x in hitsA],
-        stocks_b=[str(x["Code"]) for x in hitsB],
+
+def pack_frame(pack: dict, codes: list[str] | None = None) -> pd.DataFrame:
+    """
+    Long frame (code, date, PRICE_COLS) over the pack, optionally only `codes`.
+    code is categorical, prices stay float32 (read them through price_f64).
+    """
+    meta = pack["meta"]
+    rows = slice(None)
+    if codes is not None:
+        pos = {c: i for i, c in enumerate(meta["codes"])}
+        off = pack["offsets"]
+        ids = sorted(pos[c] for c in set(codes) if c in pos)
+        rows = np.concatenate([np.arange(off[i], off[i + 1]) for i in ids]) if ids else np.array([], dtype=np.int64)
+    return pd.DataFrame({
+        "code": pd.Categorical.from_codes(pack["code_id"][rows], categories=meta["codes"]),
+        "date": pack["date"][rows].astype("datetime64[ns]"),
+        **{c: pack[c][rows] for c in PRICE_COLS},
+    }, copy=False)
+
+
+def pack_table(pack: dict) -> pd.DataFrame:
+    """Code lookup table: code_id -> code, Name and Sector (categorical)."""
+    meta = pack["meta"]
+    return pd.DataFrame({
+        "code": meta["codes"],
+        "Name": pd.Categorical.from_codes(meta["name_id"], categories=meta["names"]),
+        "Sector": pd.Categorical.from_codes(meta["sector_id"], categories=meta["sectors"]),
+    })
+
+
+def price_f64(x) -> np.ndarray:
+    """float64 copy of a price column; float32 pack prices are rounded back to PRICE_DECIMALS (exact)."""
+    a = np.asarray(x)
+    if a.dtype == np.float32:
+        return np.round(a.astype(np.float64), PRICE_DECIMALS)
+    return a.astype(np.float64)
+
+
+# =======================
+# Historical replay (offline, whole stored universe)
+# =======================
+REPLAY_OUT = "replay_results.jsonl"
+
+
+def load_universe_bars(codes: list[str] | None = None) -> pd.DataFrame:
+    """
+    Every stored bar as one long frame (code, date, PRICE_COLS), sorted by code then date.
+    Read from the memory-mapped pack: code is categorical, prices float32 (use price_f64).
+    """
+    pack = pack_load()
+    if pack is None:
+        return pd.DataFrame(columns=["code", "date"] + PRICE_COLS)
+    return pack_frame(pack, codes)
+
+
+def window_bar_counts(bars: pd.DataFrame) -> np.ndarray:
+    """Per bar: the stock's previous bars inside HISTORY_DAYS (bars sorted by code, date)."""
+    code_id = pd.factorize(bars["code"])[0].astype(np.int64)
+    day = bars["date"].values.astype("datetime64[D]").astype(np.int64)
+    key = code_id * 1_000_000 + day
+    return np.arange(len(bars)) - np.searchsorted(key, key - HISTORY_DAYS, side="left")
+
+
+def lagged_rolling(col: pd.Series, n_bars: np.ndarray, k: int, how: str) -> np.ndarray:
+    """rolling(k).<how>() over the previous k bars of the same stock (NaN with fewer than k)."""
+    r = getattr(pd.Series(price_f64(col)).rolling(k), how)().to_numpy()
+    out = np.empty(len(r))
+    out[:1] = np.nan
+    out[1:] = r[:-1]
+    return np.where(n_bars >= k, out, np.nan)
+
+
+def bar_features(bars: pd.DataFrame) -> pd.DataFrame:
+    """
+    check_one_stock / load_today_candidates quantities for every stored bar, each bar taken as "today".
+    Windows cover the stock's own previous bars inside HISTORY_DAYS (不含今日) like the live path;
+    each rolling stat is one pass over the whole long frame, so cost grows with bars, not days x stocks.
+    bars must be sorted by (code, date), as load_universe_bars returns them.
+    """
+    n_bars = window_bar_counts(bars)
+
+    def lagged(col: str, k: int, how: str) -> np.ndarray:
+        return lagged_rolling(bars[col], n_bars, k, how)
+
+    o = price_f64(bars["open"])
+    h = price_f64(bars["max"])
+    lo = price_f64(bars["min"])
+    c = price_f64(bars["close"])
+    v = bars["Trading_Volume"].to_numpy(dtype=float)
+
+    out = bars[["code", "date"]].copy()
+    out["close"] = c
+    out["n_bars"] = n_bars
+    out["prev_close"] = lagged("close", 1, "mean")
+    out["ma5"] = lagged("Trading_Volume", 5, "mean")
+    out["high20"] = lagged("max", CONSOL_DAYS, "max")
+    out["low20"] = lagged("min", CONSOL_DAYS, "min")
+    for k in (20, 60, 120):
+        out[f"ma{k}"] = lagged("close", k, "mean")
+
+    f = breakout_tests(c, v, n_bars, out["prev_close"].to_numpy(), out["ma5"].to_numpy(),
+                       out["high20"].to_numpy(), out["low20"].to_numpy())
+    for k in ("vol_mult", "range20_pct", "break_pct"):
+        out[k] = f[k]
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        out["chg"] = (c - o) / o * 100.0            # load_today_candidates chg_pct
+        out["cand"] = candidate_mask(o, h, lo, c, v)
+    out["hit"] = out["cand"] & f["ok"]
+    return out
+
+
+def market_regime_series(proxy: pd.DataFrame) -> pd.Series:
+    """market_above_ma60 for every 0050 bar (index = date)."""
+    close = pd.Series(price_f64(proxy["close"]))
+    ma = close.rolling(MA60_WINDOW).mean()
+    day = proxy["date"].values.astype("datetime64[D]").astype(np.int64)
+    n = np.arange(1, len(day) + 1) - np.searchsorted(day, day - MARKET_HISTORY_DAYS, side="left")
+    ok = (n >= MA60_WINDOW + 1) & (close > ma).to_numpy()
+    return pd.Series(ok, index=pd.DatetimeIndex(proxy["date"]))
+
+
+def _sector_input(bars: pd.DataFrame) -> pd.DataFrame:
+    """Stored bars of 4-digit codes as the Day / Code / OpeningPrice / ClosingPrice frame sector scoring takes."""
+    uni = bars[bars["code"].str.match(r"^\d{4}$")]
+    return pd.DataFrame({"Day": uni["date"].values, "Code": uni["code"].values,
+                         "OpeningPrice": price_f64(uni["open"]), "ClosingPrice": price_f64(uni["close"])})
+
+
+def main_sector_matrix(stats: pd.DataFrame, days: list, params: dict | None = None) -> pd.DataFrame:
+    """
+    Day x Sector bool frame: in daily TopN on at least SECTOR_MAIN_MIN_APPEAR of the
+    last SECTOR_LOOKBACK_DAYS trade days (rolling count of TopN appearances).
+    """
+    scores = rank_sector_stats(stats, params)
+    top = scores.groupby("Day", sort=False).head(_param(params, "SECTOR_TOP_N"))
+    if top.empty:
+        return pd.DataFrame(index=pd.DatetimeIndex(days), dtype=bool)
+    ind = pd.crosstab(top["Day"], top["Sector"]).reindex(pd.DatetimeIndex(days), fill_value=0)
+    appear = ind.rolling(_param(params, "SECTOR_LOOKBACK_DAYS"), min_periods=1).sum()
+    return appear >= _param(params, "SECTOR_MAIN_MIN_APPEAR")
+
+
+def main_sectors_by_day(bars: pd.DataFrame, sector_map: dict, days: list) -> dict:
+    """5日主流族群 for every trade day, from one sector_day_stats pass over the stored bars."""
+    is_main = main_sector_matrix(sector_day_stats(_sector_input(bars), sector_map), days)
+    if is_main.empty:
+        return {}
+    cols = is_main.columns.to_numpy()
+    return {d: set(cols[row]) for d, row in zip(is_main.index, is_main.to_numpy())}
+
+
+def replay(start: dt.date, end: dt.date, out_path: str = REPLAY_OUT) -> list[dict]:
+    """
+    Run the scan pipeline for every trade day in [start, end] from stored data only:
+    market regime, main sectors, 爆量長紅 filters, breakout checks and A/B split.
+    Writes one scanner_result.json-style record per day to out_path (JSONL; with the
+    main-sector codes, so it can seed the tracker).
+    """
+    t0 = time.time()
+    bars = load_universe_bars()
+    if bars.empty:
+        print("[REPLAY] local store is empty")
+        return []
+    sector_map = load_sector_map_offline()
+
+    all_days = [pd.Timestamp(d) for d in trade_calendar_dates()]
+    if not all_days:
+        all_days = sorted(pd.DatetimeIndex(bars["date"]).unique())
+    days = [d for d in all_days if start <= d.date() <= end]
+
+    feats = bar_features(bars)
+    regime = market_regime_series(bars[bars["code"] == MARKET_PROXY])
+    main_by_day = main_sectors_by_day(bars, sector_map, all_days)
+
+    hits = feats[feats["hit"] & feats["code"].str.match(r"^\d{4}$")].copy()
+    hits["Sector"] = sector_lookup(sector_map, hits["code"].to_numpy())
+    # A: MA20 > MA60 > MA120 且 close > MA20 (NaN MA -> B)
+    hits["is_a"] = (hits["ma20"] > hits["ma60"]) & (hits["ma60"] > hits["ma120"]) & (hits["close"] > hits["ma20"])
+    hits_by_day = dict(tuple(hits.groupby("date")))
+
+    records = []
+    for d in days:
+        rec = {"signal_date": d.strftime("%Y-%m-%d"), "stocks": [], "stocks_a": [], "stocks_b": [], "main": []}
+        g = hits_by_day.get(d)
+        if bool(regime.get(d, False)) and g is not None:
+            g = g.assign(main=g["Sector"].isin(main_by_day.get(d, set())))
+            g = g.sort_values(["main", "chg", "vol_mult"], ascending=False, kind="mergesort")
+            a = g.loc[g["is_a"], "code"].tolist()
+            b = g.loc[~g["is_a"], "code"].tolist()
+            rec.update(stocks=a + b, stocks_a=a, stocks_b=b, main=g.loc[g["main"], "code"].tolist())
+        records.append(rec)
+
+    with open(out_path, "w", encoding="utf-8") as f:
+        for rec in records:
+            f.write(json.dumps(rec, ensure_ascii=False) + "\n")
+    n_sig = sum(len(r["stocks"]) for r in records)
+    print(f"[REPLAY] {len(records)} days, {n_sig} signals, {bars['code'].nunique()} stocks, "
+          f"{len(bars)} bars in {time.time() - t0:.1f}s -> {out_path}")
+    return records
+
+
+# =======================
+# Parameter sweep (offline, every combination of a threshold grid)
+# =======================
+SWEEP_OUT = "sweep_results.csv"
+SWEEP_PARAMS = [
+    "MIN_CHG_PCT", "MIN_BODY_RATIO", "MIN_LOTS", "VOL_MULT", "CONSOL_DAYS", "MAX_RANGE_PCT", "BREAKOUT_PCT",
+    "SECTOR_LOOKBACK_DAYS", "SECTOR_TOP_N", "SECTOR_MIN_COUNT", "SECTOR_UP_PCT",
+    "SECTOR_SCORE_UP_WEIGHT", "SECTOR_MAIN_MIN_APPEAR",
+]
+SECTOR_PARAMS = [x for x in SWEEP_PARAMS if x.startswith("SECTOR_")]
+FWD_HORIZONS = (1, 5, 10, 20)      # bars after the signal close
+SWEEP_CHUNK = 64                   # combinations per broadcast block / pool task
+SWEEP_WORKERS = int(os.getenv("SWEEP_WORKERS", str(os.cpu_count() or 1)))
+
+
+def sweep_combos(grid: dict) -> list[dict]:
+    """Cartesian product of grid values; parameters not in grid keep their current value."""
+    import itertools
+
+    unknown = set(grid) - set(SWEEP_PARAMS)
+    if unknown:
+        raise ValueError(f"not sweepable: {sorted(unknown)}")
+    axes = [[type(globals()[k])(x) for x in grid[k]] if k in grid else [globals()[k]] for k in SWEEP_PARAMS]
+    return [dict(zip(SWEEP_PARAMS, vals)) for vals in itertools.product(*axes)]
+
+
+def forward_returns(bars: pd.DataFrame, horizons=FWD_HORIZONS) -> dict:
+    """close[t+h] / close[t] - 1 per stored bar (same stock, NaN past its last bar)."""
+    c = pd.Series(price_f64(bars["close"]))
+    g = c.groupby(pd.factorize(bars["code"])[0], sort=False)
+    return {h: (g.shift(-h) / c - 1.0).to_numpy() for h in horizons}
+
+
+def sweep_features(bars: pd.DataFrame, sector_map: dict, combos: list[dict],
+                   start: dt.date, end: dt.date) -> dict:
+    """
+    Everything the grid shares, computed once: per-bar quantities of the bars that pass the
+    loosest value of every threshold (on in-range days with the market above MA60), their
+    forward returns, window high/low per distinct CONSOL_DAYS, and sector day stats per
+    distinct SECTOR_UP_PCT. Returned as plain arrays so pool workers get it in one pickle.
+    """
+    feats = bar_features(bars)
+    regime = market_regime_series(bars[bars["code"] == MARKET_PROXY])
+    fwd = forward_returns(bars)
+
+    o = price_f64(bars["open"])
+    h = price_f64(bars["max"])
+    lo = price_f64(bars["min"])
+    c = feats["close"].to_numpy()
+    v = bars["Trading_Volume"].to_numpy(dtype=float)
+    prev_close = feats["prev_close"].to_numpy()
+    ma5 = feats["ma5"].to_numpy()
+    n_bars = feats["n_bars"].to_numpy()
+
+    def loosest(name, how):
+        return how(cb[name] for cb in combos)
+
+    dates = pd.DatetimeIndex(bars["date"])
+    with np.errstate(invalid="ignore", divide="ignore"):
+        chg = (c - o) / o * 100.0
+        rng = h - lo
+        body = (c - o) / rng
+        lots = v / 1000.0
+        keep = (
+            (dates >= pd.Timestamp(start)) & (dates <= pd.Timestamp(end)) &
+            bars["code"].str.match(r"^\d{4}$").to_numpy() &
+            regime.reindex(dates, fill_value=False).to_numpy(dtype=bool) &
+            (c > o) & (rng > 0) & (prev_close > 0) & ~((c - prev_close) / prev_close < 0.03) &
+            (ma5 > 0) &
+            (chg >= loosest("MIN_CHG_PCT", min)) & (body >= loosest("MIN_BODY_RATIO", min)) &
+            (lots >= loosest("MIN_LOTS", min)) & (v > loosest("VOL_MULT", min) * ma5)
+        )
+        if BREAKOUT_VOL_GT_MA5:
+            keep &= v > ma5
+
+        windows = {}
+        any_window = np.zeros(len(bars), dtype=bool)
+        for k in sorted({cb["CONSOL_DAYS"] for cb in combos}):
+            high = feats["high20"].to_numpy() if k == CONSOL_DAYS else lagged_rolling(bars["max"], n_bars, k, "max")
+            low = feats["low20"].to_numpy() if k == CONSOL_DAYS else lagged_rolling(bars["min"], n_bars, k, "min")
+            width = np.where(low > 0, (high - low) / low, 999.0)
+            ok = (n_bars >= k + 6) & ~(width > loosest("MAX_RANGE_PCT", max)) & \
+                (c >= high * (1.0 + loosest("BREAKOUT_PCT", min)))
+            windows[k] = (ok, high, width)
+            any_window |= ok
+        keep &= any_window
+
+    idx = np.flatnonzero(keep)
+    idx = idx[np.argsort(dates.values[idx], kind="stable")]          # day-sorted for per-day reductions
+    rows = {
+        "day": dates.values[idx],
+        "code": np.asarray(bars["code"].iloc[idx]),
+        "chg": chg[idx], "body": body[idx], "lots": lots[idx], "v": v[idx], "ma5": ma5[idx], "close": c[idx],
+        "is_a": ((feats["ma20"] > feats["ma60"]) & (feats["ma60"] > feats["ma120"]) &
+                 (feats["close"] > feats["ma20"])).to_numpy()[idx],
+        "fwd": {hz: r[idx] for hz, r in fwd.items()},
+        "windows": {k: (ok[idx], high[idx], width[idx]) for k, (ok, high, width) in windows.items()},
+    }
+    rows["sector"] = sector_lookup(sector_map, rows["code"])
+
+    all_days = sorted(dates.unique())
+    sector_in = _sector_input(bars)
+    stats = {u: sector_day_stats(sector_in, sector_map, {"SECTOR_UP_PCT": u})
+             for u in sorted({cb["SECTOR_UP_PCT"] for cb in combos})}
+    n_days = int(((regime.index >= pd.Timestamp(start)) & (regime.index <= pd.Timestamp(end))).sum())
+    return {"rows": rows, "stats": stats, "all_days": all_days, "n_days": n_days}
+
+
+_sweep_shared: dict = {}
+
+
+def _sweep_init(shared: dict):
+    _sweep_shared.clear()
+    _sweep_shared.update(shared, main={})
+
+
+def _sweep_main_flags(params: dict) -> np.ndarray:
+    """Per shared row: is its sector a main sector that day, under params' sector settings (cached)."""
+    key = tuple(params[k] for k in SECTOR_PARAMS)
+    if key not in _sweep_shared["main"]:
+        rows = _sweep_shared["rows"]
+        is_main = main_sector_matrix(_sweep_shared["stats"][params["SECTOR_UP_PCT"]],
+                                     _sweep_shared["all_days"], params)
+        flags = np.zeros(len(rows["day"]), dtype=bool)
+        if not is_main.empty and len(flags):
+            di = is_main.index.get_indexer(pd.DatetimeIndex(rows["day"]))
+            si = is_main.columns.get_indexer(rows["sector"])
+            ok = (di >= 0) & (si >= 0)
+            flags[ok] = is_main.to_numpy()[di[ok], si[ok]]
+        _sweep_shared["main"][key] = flags
+    return _sweep_shared["main"][key]
+
+
+def _sweep_block(combos: list[dict]) -> list[dict]:
+    """
+    Evaluate combinations sharing CONSOL_DAYS and the sector settings: every threshold test is
+    one (combos x rows) broadcast comparison, then hits / forward returns are column reductions.
+    """
+    rows = _sweep_shared["rows"]
+    ok_k, high, width = rows["windows"][combos[0]["CONSOL_DAYS"]]
+    main = _sweep_main_flags(combos[0])
+
+    def col(name):
+        return np.array([cb[name] for cb in combos], dtype=float)[:, None]
+
+    m = (
+        ok_k[None, :] &
+        (rows["chg"][None, :] >= col("MIN_CHG_PCT")) &
+        (rows["body"][None, :] >= col("MIN_BODY_RATIO")) &
+        (rows["lots"][None, :] >= col("MIN_LOTS")) &
+        (rows["v"][None, :] > col("VOL_MULT") * rows["ma5"][None, :]) &
+        ~(width[None, :] > col("MAX_RANGE_PCT")) &
+        (rows["close"][None, :] >= high[None, :] * (1.0 + col("BREAKOUT_PCT")))
     )
-    print("=== EOF reached ===")
+
+    n_sig = m.sum(axis=1)
+    out = [dict(cb, days=_sweep_shared["n_days"], signals=int(n), signals_a=int(a), signals_main=int(mm))
+           for cb, n, a, mm in zip(combos, n_sig, (m & rows["is_a"]).sum(axis=1), (m & main).sum(axis=1))]
+
+    day = rows["day"]
+    if len(day):
+        starts = np.flatnonzero(np.r_[True, day[1:] != day[:-1]])
+        days_hit = np.logical_or.reduceat(m, starts, axis=1).sum(axis=1)
+    else:
+        days_hit = np.zeros(len(combos), dtype=int)
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        for hz, r in rows["fwd"].items():
+            valid = m & ~np.isnan(r)[None, :]
+            rz = np.where(np.isnan(r), 0.0, r)[None, :]
+            n = valid.sum(axis=1)
+            mean = (valid * rz).sum(axis=1) / n
+            win = (valid & (rz > 0)).sum(axis=1) / n
+            va = valid & rows["is_a"]
+            mean_a = (va * rz).sum(axis=1) / va.sum(axis=1)
+            vm = valid & main
+            mean_main = (vm * rz).sum(axis=1) / vm.sum(axis=1)
+            for i, rec in enumerate(out):
+                rec[f"fwd{hz}"] = float(mean[i])
+                rec[f"win{hz}"] = float(win[i])
+                rec[f"fwd{hz}_a"] = float(mean_a[i])
+                rec[f"fwd{hz}_main"] = float(mean_main[i])
+    for rec, d in zip(out, days_hit):
+        rec["days_with_signal"] = int(d)
+    return out
+
+
+def sweep(start: dt.date, end: dt.date, grid: dict, out_path: str = SWEEP_OUT,
+          workers: int = SWEEP_WORKERS) -> pd.DataFrame:
+    """
+    Evaluate every combination of grid against stored history for trade days in [start, end].
+    Shared features are built once; blocks of combinations are spread over a process pool.
+    Writes one row per combination (params, signal counts, mean / win rate of forward returns).
+    """
+    from concurrent.futures import ProcessPoolExecutor
+
+    t0 = time.time()
+    combos = sweep_combos(grid)
+    bars = load_universe_bars()
+    if bars.empty:
+        print("[SWEEP] local store is empty")
+        return pd.DataFrame()
+    shared = sweep_features(bars, load_sector_map_offline(), combos, start, end)
+    del bars
+
+    # blocks share CONSOL_DAYS + sector settings (one window / main-sector lookup per block)
+    groups: dict[tuple, list[dict]] = {}
+    for cb in combos:
+        groups.setdefault((cb["CONSOL_DAYS"],) + tuple(cb[k] for k in SECTOR_PARAMS), []).append(cb)
+    blocks = [g[i:i + SWEEP_CHUNK] for g in groups.values() for i in range(0, len(g), SWEEP_CHUNK)]
+
+    if workers <= 1 or len(blocks) <= 1:
+        _sweep_init(shared)
+        results = [_sweep_block(b) for b in blocks]
+    else:
+        with ProcessPoolExecutor(max_workers=min(workers, len(blocks)),
+                                 initializer=_sweep_init, initargs=(shared,)) as ex:
+            results = list(ex.map(_sweep_block, blocks))
+
+    order = {id(cb): i for i, cb in enumerate(combos)}
+    flat = sorted(((order[id(cb)], rec) for b, res in zip(blocks, results) for cb, rec in zip(b, res)),
+                  key=lambda x: x[0])
+    table = pd.DataFrame([rec for _, rec in flat])
+    table.to_csv(out_path, index=False)
+    print(f"[SWEEP] {len(combos)} combinations, {len(shared['rows']['day'])} shared rows, "
+          f"{shared['n_days']} days in {time.time() - t0:.1f}s -> {out_path}")
+    return table
+
+
+# =======================
+# Signal history (append-only SQLite: every hit of every run, indexed by date / code / sector)
+# =======================
+SIGNAL_DB = os.path.join(DATA_DIR, "signals.sqlite")
+# column -> SQLite type; hit records are stored with every computed field
+SIGNAL_FIELDS = {
+    "signal_date": "TEXT", "code": "TEXT", "name": "TEXT", "market": "TEXT", "signal_type": "TEXT",
+    "sector": "TEXT", "main": "INTEGER", "chg": "REAL", "vol_mult": "REAL", "lots": "REAL",
+    "range20_pct": "REAL", "break_pct": "REAL", "close": "REAL", "ma20": "REAL", "ma60": "REAL",
+    "ma120": "REAL", "run_at": "TEXT",
+}
+# signals rows are never updated: a rerun of a date appends a new run, and runs records
+# which run of each date counts (latest_signals)
+_SIGNAL_SCHEMA = [
+    f"CREATE TABLE IF NOT EXISTS signals ({', '.join(f'{k} {t}' for k, t in SIGNAL_FIELDS.items())})",
+    "CREATE INDEX IF NOT EXISTS signals_date ON signals (signal_date, run_at)",
+    "CREATE INDEX IF NOT EXISTS signals_code ON signals (code, signal_date)",
+    "CREATE INDEX IF NOT EXISTS signals_sector ON signals (sector, signal_date)",
+    "CREATE TABLE IF NOT EXISTS runs (signal_date TEXT PRIMARY KEY, run_at TEXT)",
+    "CREATE VIEW IF NOT EXISTS latest_signals AS SELECT s.* FROM signals s "
+    "JOIN runs r ON s.signal_date = r.signal_date AND s.run_at = r.run_at",
+]
+
+
+def signal_db(path: str = SIGNAL_DB) -> sqlite3.Connection:
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    con = sqlite3.connect(path)
+    for q in _SIGNAL_SCHEMA:
+        con.execute(q)
+    return con
+
+
+def signals_append(signal_date: str, hits: list[dict], main_sectors: set, path: str = SIGNAL_DB) -> int:
+    """Append one run's hit records (after A/B tagging) as the current run of signal_date."""
+    run_at = dt.datetime.now().isoformat()
+    rows = [{
+        "signal_date": signal_date, "code": str(x["Code"]), "name": x.get("Name"), "market": x.get("Market"),
+        "signal_type": x.get("signal_type"), "sector": x.get("Sector"), "main": int(x.get("Sector") in main_sectors),
+        **{k: x.get(k) for k in ("chg", "vol_mult", "lots", "range20_pct", "break_pct", "close", "ma20", "ma60", "ma120")},
+        "run_at": run_at,
+    } for x in hits]
+    try:
+        with contextlib.closing(signal_db(path)) as con, con:
+            con.executemany(f"INSERT INTO signals VALUES ({', '.join(':' + k for k in SIGNAL_FIELDS)})", rows)
+            con.execute("INSERT OR REPLACE INTO runs VALUES (?, ?)", (signal_date, run_at))
+    except sqlite3.Error as e:
+        print("[SIGNALS] write failed:", path, repr(e))
+        return 0
+    metric_count("signals.stored", len(rows))
+    return len(rows)
+
+
+def signals_query(start=None, end=None, code: str | None = None, signal_type: str | None = None,
+                  sector: str | None = None, main: bool | None = None, all_runs: bool = False,
+                  path: str = SIGNAL_DB) -> pd.DataFrame:
+    """
+    Stored signals matching every given filter (dates inclusive, date or YYYY-MM-DD),
+    ordered by date and code. Only the current run of each date unless all_runs.
+    """
+    where, args = [], []
+    for col, op, v in (("signal_date", ">=", start), ("signal_date", "<=", end), ("code", "=", code),
+                       ("signal_type", "=", signal_type), ("sector", "=", sector),
+                       ("main", "=", None if main is None else int(main))):
+        if v is not None:
+            where.append(f"s.{col} {op} ?")
+            args.append(str(v) if col == "signal_date" else v)
+    q = f"SELECT s.* FROM {'signals' if all_runs else 'latest_signals'} s" + \
+        (" WHERE " + " AND ".join(where) if where else "") + " ORDER BY s.signal_date, s.code"
+    if not os.path.exists(path):
+        return pd.DataFrame(columns=list(SIGNAL_FIELDS))
+    with contextlib.closing(signal_db(path)) as con:
+        return pd.read_sql_query(q, con, params=args)
+
+
+# =======================
+# Signal tracker (forward performance of every exported signal)
+# =======================
+TRACK_PATH = os.path.join(DATA_DIR, "tracker.json")    # per-signal stats; matured horizons are final
+TRACK_OUT = "tracker_summary.csv"
+TRACK_HORIZONS = FWD_HORIZONS
+
+
+def load_signals(path: str = SIGNAL_DB) -> pd.DataFrame:
+    """
+    Signal history (SIGNAL_DB) or scanner_result-style JSONL (replay output) -> one row
+    per signal: signal_date, code, type (A/B), main (code was in a main sector that day).
+    """
+    if path.endswith(".sqlite"):
+        df = signals_query(path=path)
+        return pd.DataFrame({"signal_date": df["signal_date"], "code": df["code"],
+                             "type": df["signal_type"], "main": df["main"].astype(bool)})
+    recs = {}
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    rec = json.loads(line)
+                except ValueError:
+                    continue
+                if rec.get("signal_date"):
+                    recs[rec["signal_date"]] = rec
+    except OSError:
+        pass
+    rows = [(d, str(c), t, str(c) in set(rec.get("main") or []))
+            for d, rec in recs.items() for t in ("A", "B") for c in rec.get(f"stocks_{t.lower()}") or []]
+    return pd.DataFrame(rows, columns=["signal_date", "code", "type", "main"])
+
+
+def _track_load() -> pd.DataFrame | None:
+    try:
+        with open(TRACK_PATH, "r", encoding="utf-8") as f:
+            return _frame_load(json.load(f))
+    except (OSError, ValueError, KeyError):
+        return None
+
+
+def track_fill(table: pd.DataFrame, bars: pd.DataFrame) -> int:
+    """
+    Fill the horizons of table rows that are still empty but have matured, in place:
+    ret_h = close h bars after the signal close / signal close - 1, mdd_h = worst
+    peak-to-trough of the closes over those bars. bars: load_universe_bars() of the codes.
+    Returns the number of cells filled.
+    """
+    if table.empty or bars.empty:
+        return 0
+    close = price_f64(bars["close"])
+    code_id = pd.factorize(bars["code"])[0]
+    keys = pd.MultiIndex.from_arrays([bars["code"].astype(str), pd.DatetimeIndex(bars["date"])])
+    pos = keys.get_indexer(pd.MultiIndex.from_arrays([table["code"], pd.to_datetime(table["signal_date"])]))
+    table["close"] = table["close"].fillna(pd.Series(np.where(pos >= 0, close[pos], np.nan), index=table.index))
+
+    filled = 0
+    for h in TRACK_HORIZONS:
+        rows = np.flatnonzero(table[f"ret_{h}"].isna().to_numpy() & (pos >= 0) & (pos + h < len(bars)))
+        rows = rows[code_id[pos[rows] + h] == code_id[pos[rows]]]      # h bars of the same stock exist
+        if not len(rows):
+            continue
+        path = close[pos[rows, None] + np.arange(h + 1)]
+        table.loc[table.index[rows], f"ret_{h}"] = path[:, -1] / path[:, 0] - 1.0
+        table.loc[table.index[rows], f"mdd_{h}"] = (path / np.maximum.accumulate(path, axis=1) - 1.0).min(axis=1)
+        filled += len(rows)
+    return filled
+
+
+def track_update(signals: pd.DataFrame) -> pd.DataFrame:
+    """
+    Saved tracker table brought up to date with signals: new signals are added, and only
+    horizons that matured since the last update are computed (one vectorized join against
+    the stored bars of the stocks still pending).
+    """
+    cols = [f"{k}_{h}" for h in TRACK_HORIZONS for k in ("ret", "mdd")]
+    saved = _track_load()
+    table = signals.copy()
+    if saved is not None and not saved.empty:
+        table = table.merge(saved.drop(columns=["type", "main"], errors="ignore"),
+                            on=["signal_date", "code"], how="left")
+    for c in ["close"] + cols:
+        if c not in table.columns:
+            table[c] = np.nan
+    table = table.reset_index(drop=True)
+
+    pending = table[f"ret_{max(TRACK_HORIZONS)}"].isna()
+    filled = 0
+    if pending.any():
+        sub = table.loc[pending].copy()
+        filled = track_fill(sub, load_universe_bars(sorted(set(sub["code"]))))
+        table.loc[pending] = sub
+    print(f"[TRACK] {len(table)} signals, {int(pending.sum())} pending, {filled} horizons newly matured")
+    _save_json(TRACK_PATH, _frame_dump(table))
+    return table
+
+
+def track_summary(table: pd.DataFrame) -> pd.DataFrame:
+    """Matured signals per horizon, by signal type (A/B) and by main vs. other sector."""
+    parts = []
+    groups = {"type": table["type"], "sector": np.where(table["main"].astype(bool), "main", "other")}
+    for by, key in groups.items():
+        for h in TRACK_HORIZONS:
+            d = pd.DataFrame({"group": key, "ret": table[f"ret_{h}"], "mdd": table[f"mdd_{h}"]}).dropna()
+            d["hit"] = (d["ret"] > 0).astype(float)
+            s = d.groupby("group").agg(n=("ret", "size"), avg_ret=("ret", "mean"), median_ret=("ret", "median"),
+                                       hit_rate=("hit", "mean"), avg_mdd=("mdd", "mean"), worst_mdd=("mdd", "min"))
+            parts.append(s.reset_index().assign(by=by, horizon=h))
+    if not parts:
+        return pd.DataFrame()
+    out = pd.concat(parts, ignore_index=True)
+    return out[["by", "group", "horizon", "n", "avg_ret", "median_ret", "hit_rate", "avg_mdd", "worst_mdd"]]
+
+
+def track(signals_path: str = SIGNAL_DB, out_path: str = TRACK_OUT) -> pd.DataFrame:
+    """Update the tracker from the signal history (or a replay) and write / print the summary tables."""
+    t0 = time.time()
+    signals = load_signals(signals_path)
+    if signals.empty:
+        print("[TRACK] no signals in", signals_path)
+        return pd.DataFrame()
+    with span("track_update"):
+        table = track_update(signals)
+    summary = track_summary(table)
+    summary.to_csv(out_path, index=False)
+    with pd.option_context("display.width", 160, "display.float_format", "{:.4f}".format):
+        for by, g in summary.groupby("by", sort=False):
+            print(f"[TRACK] by {by}:\n" + g.drop(columns="by").to_string(index=False))
+    print(f"[TRACK] {len(table)} signals from {signals['signal_date'].nunique()} days "
+          f"in {time.time() - t0:.1f}s -> {out_path}")
+    return summary
+
+
+# =======================
+# Breakout event index (every consolidation window / breakout over the stored history)
+# =======================
+EVENT_DB = os.path.join(DATA_DIR, "events.sqlite")
+EVENT_OUT = "events_summary.csv"
+# breakout: close >= high20 x (1 + BREAKOUT_PCT) out of a consolidated CONSOL_DAYS window (不含今日);
+# signal = every other check_one_stock test passes too (volume, change, history)
+BREAKOUT_FIELDS = {
+    "code": "TEXT", "date": "TEXT", "consol_start": "TEXT", "close": "REAL", "prev_close": "REAL",
+    "high20": "REAL", "low20": "REAL", "range20_pct": "REAL", "break_pct": "REAL", "vol_mult": "REAL",
+    "chg_pct": "REAL", "signal": "INTEGER",
+    **{f"{k}_{h}": "REAL" for h in TRACK_HORIZONS for k in ("ret", "mdd")},
+}
+# consolidation: a run of consecutive CONSOL_DAYS windows each within MAX_RANGE_PCT;
+# start = first bar of the first window, end = last bar of the last one
+CONSOL_FIELDS = {
+    "code": "TEXT", "start": "TEXT", "end": "TEXT", "windows": "INTEGER",
+    "high": "REAL", "low": "REAL", "min_width": "REAL",
+}
+_EVENT_SCHEMA = [
+    f"CREATE TABLE IF NOT EXISTS breakouts ({', '.join(f'{k} {t}' for k, t in BREAKOUT_FIELDS.items())})",
+    "CREATE INDEX IF NOT EXISTS breakouts_code ON breakouts (code, date)",
+    "CREATE INDEX IF NOT EXISTS breakouts_date ON breakouts (date)",
+    f"CREATE TABLE IF NOT EXISTS consolidations ({', '.join(f'{k} {t}' for k, t in CONSOL_FIELDS.items())})",
+    "CREATE INDEX IF NOT EXISTS consolidations_code ON consolidations (code, end)",
+    # per stock: first / last stored bar the index covers
+    "CREATE TABLE IF NOT EXISTS indexed (code TEXT PRIMARY KEY, first TEXT, through TEXT)",
+]
+
+
+def event_db(path: str = EVENT_DB) -> sqlite3.Connection:
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    con = sqlite3.connect(path)
+    for q in _EVENT_SCHEMA:
+        con.execute(q)
+    return con
+
+
+def sliding_extreme(x: np.ndarray, k: int, how: str) -> np.ndarray:
+    """
+    max / min of x[i-k+1 .. i] for every i >= k-1 (NaN before), O(n) whatever k:
+    van Herk / Gil-Werman, a prefix and a suffix scan per block of k, one combine per window.
+    """
+    f = np.maximum if how == "max" else np.minimum
+    n = len(x)
+    out = np.full(n, np.nan)
+    if n < k:
+        return out
+    b = np.full(-(-n // k) * k, -np.inf if how == "max" else np.inf)
+    b[:n] = x
+    b = b.reshape(-1, k)
+    pre = f.accumulate(b, axis=1).ravel()
+    suf = f.accumulate(b[:, ::-1], axis=1)[:, ::-1].ravel()
+    out[k - 1:] = f(suf[:n - k + 1], pre[k - 1:n])
+    return out
+
+
+def _run_reduce(f, x: np.ndarray, first: np.ndarray, last: np.ndarray) -> np.ndarray:
+    """f over x[first[j] .. last[j]] per run (runs disjoint, in row order)."""
+    if not len(first):
+        return np.empty(0)
+    return f.reduceat(np.append(x, x[-1]), np.column_stack([first, last + 1]).ravel())[::2]
+
+
+def event_scan(bars: pd.DataFrame, lo: np.ndarray, pos: np.ndarray) -> dict:
+    """
+    Per-row window stats of bars (sorted by code, date; per stock a contiguous slice whose first
+    row is lo): the CONSOL_DAYS high / low / width ending on the row (含當日), whether that window
+    is consolidated, and the breakout tests of the row against the window before it.
+    pos = bars before the row in the stock's full history (breakout_tests' n_bars).
+    """
+    k = CONSOL_DAYS
+    i = np.arange(len(bars))
+    local = i - lo
+    c = price_f64(bars["close"])
+    v = bars["Trading_Volume"].to_numpy(dtype=float)
+    hi20 = np.where(local >= k - 1, sliding_extreme(price_f64(bars["max"]), k, "max"), np.nan)
+    lo20 = np.where(local >= k - 1, sliding_extreme(price_f64(bars["min"]), k, "min"), np.nan)
+    width = np.where(local >= k - 1, _range_width(hi20, lo20), np.nan)
+    cons = (local >= k - 1) & ~(width > MAX_RANGE_PCT)
+
+    def prev(a, fill=np.nan):
+        out = np.full(len(a), fill, dtype=np.asarray(a).dtype)
+        out[1:] = a[:-1]
+        return np.where(local >= 1, out, fill)
+
+    cv = np.concatenate([[0.0], np.cumsum(v)])
+    ma5 = np.where(local >= 5, (cv[i] - cv[np.maximum(i - 5, 0)]) / 5.0, np.nan)
+    w = {"prev_close": prev(c), "ma5": ma5, "high20": prev(hi20), "low20": prev(lo20)}
+    with np.errstate(invalid="ignore"):
+        brk = prev(cons, False) & BREAKOUT_PREDICATES["breakout"][1](c, v, w)
+    f = breakout_tests(c, v, pos, w["prev_close"], ma5, w["high20"], w["low20"])
+
+    starts = cons & ~prev(cons, False)
+    last = cons & ~np.append(cons[1:] & (local[1:] > 0), False)
+    return {"c": c, "hi20": hi20, "lo20": lo20, "width": width, "w": w, "f": f, "brk": brk,
+            "run_first": np.maximum.accumulate(np.where(starts, i, 0)), "run_last": np.flatnonzero(last)}
+
+
+def _sql_rows(df: pd.DataFrame) -> list[dict]:
+    return df.astype(object).where(df.notna(), None).to_dict("records")
+
+
+def events_update(bars: pd.DataFrame | None = None, rebuild: bool = False, path: str = EVENT_DB) -> dict:
+    """
+    Bring the event index up to date with the stored bars (load_universe_bars()). A stock is
+    scanned from the bar after the one it was indexed through, plus the CONSOL_DAYS bars its
+    windows need, so a daily update reads only the new bars; one whose stored history no longer
+    starts / ends where the index saw it (backfilled further back, rewritten) is indexed again
+    in full. Breakout horizons that matured since are filled from the same bars (track_fill).
+    """
+    bars = load_universe_bars() if bars is None else bars
+    counts = {"stocks": 0, "reindexed": 0, "breakouts": 0, "consolidations": 0, "matured": 0}
+    if bars.empty:
+        print("[EVENTS] no stored bars")
+        return counts
+    k = CONSOL_DAYS
+    code_id = pd.factorize(bars["code"])[0]
+    first_row = np.flatnonzero(np.diff(code_id, prepend=-1))
+    n = np.diff(np.append(first_row, len(bars)))
+    codes = bars["code"].iloc[first_row].astype(str).to_numpy()
+    day = bars["date"].to_numpy().astype("datetime64[D]")
+    key = code_id.astype(np.int64) * 1_000_000 + day.astype(np.int64)
+    d = lambda rows: day[rows].astype(str)    # formatted only where stored
+
+    with contextlib.closing(event_db(path)) as con, con:
+        if rebuild:
+            for t in ("breakouts", "consolidations", "indexed"):
+                con.execute(f"DELETE FROM {t}")
+        st = pd.read_sql_query("SELECT * FROM indexed", con).set_index("code").reindex(codes)
+
+        # k0: each stock's first row not indexed yet
+        known = st["through"].notna().to_numpy()
+        thr = pd.to_datetime(st["through"].fillna("1970-01-01")).to_numpy().astype("datetime64[D]").astype(np.int64)
+        k0 = np.searchsorted(key, np.arange(len(codes)) * 1_000_000 + thr, side="right")
+        same = known & (st["first"].to_numpy() == d(first_row)) & (k0 > first_row) & \
+            (day[np.maximum(k0 - 1, 0)].astype(np.int64) == thr)
+        stale = known & ~same
+        k0 = np.where(same, k0, first_row)
+        todo = k0 < first_row + n
+        for t in ("breakouts", "consolidations", "indexed"):
+            con.executemany(f"DELETE FROM {t} WHERE code = ?", [(c,) for c in codes[stale]])
+        counts["stocks"], counts["reindexed"] = int(todo.sum()), int(stale.sum())
+
+        if todo.any():
+            lo_c = np.maximum(first_row, k0 - k)
+            sel = np.flatnonzero(todo[code_id] & (np.arange(len(bars)) >= lo_c[code_id]))
+            rc = code_id[sel]
+            s = event_scan(bars.iloc[sel], np.searchsorted(sel, lo_c[rc]), sel - first_row[rc])
+            sd, new = d(sel), sel >= k0[rc]
+
+            # a run whose first window ends on the last indexed bar continues the stock's
+            # open consolidation (stored with end = through)
+            open_ = pd.read_sql_query("SELECT c.rowid AS id, c.* FROM consolidations c JOIN indexed i "
+                                      "ON c.code = i.code AND c.end = i.through", con).set_index("code")
+            cont_of = same[rc] & (sel == k0[rc] - 1)
+
+            b = np.flatnonzero(s["brk"] & new)
+            rf = s["run_first"][b - 1]
+            start = np.where(cont_of[rf], open_["start"].reindex(codes[rc[rf]]).to_numpy(), sd[rf - (k - 1)])
+            f, w = s["f"], s["w"]
+            brk = pd.DataFrame({
+                "code": codes[rc[b]], "date": sd[b], "consol_start": start, "close": s["c"][b],
+                "prev_close": w["prev_close"][b], "high20": w["high20"][b], "low20": w["low20"][b],
+                **{x: f[x][b] for x in ("range20_pct", "break_pct", "vol_mult", "chg_pct")},
+                "signal": f["ok"][b].astype(int),
+            }).reindex(columns=list(BREAKOUT_FIELDS))
+
+            last = s["run_last"][new[s["run_last"]]]
+            first = s["run_first"][last]
+            runs = pd.DataFrame({
+                "code": codes[rc[first]], "start": sd[first - (k - 1)], "end": sd[last], "windows": last - first + 1,
+                "high": _run_reduce(np.maximum, s["hi20"], first, last),
+                "low": _run_reduce(np.minimum, s["lo20"], first, last),
+                "min_width": _run_reduce(np.minimum, s["width"], first, last),
+            })
+            cont = cont_of[first]
+            if cont.any():
+                o = open_.reindex(runs.loc[cont, "code"]).set_index(runs.index[cont])
+                runs.loc[cont, "start"] = o["start"]
+                runs.loc[cont, "windows"] += o["windows"] - 1
+                runs.loc[cont, "high"] = np.maximum(runs.loc[cont, "high"], o["high"])
+                runs.loc[cont, "low"] = np.minimum(runs.loc[cont, "low"], o["low"])
+                runs.loc[cont, "min_width"] = np.minimum(runs.loc[cont, "min_width"], o["min_width"])
+                con.executemany("DELETE FROM consolidations WHERE rowid = ?", [(int(x),) for x in o["id"]])
+
+            ph = ", ".join(":" + x for x in BREAKOUT_FIELDS)
+            con.executemany(f"INSERT INTO breakouts VALUES ({ph})", _sql_rows(brk))
+            con.executemany(f"INSERT INTO consolidations VALUES ({', '.join(':' + x for x in CONSOL_FIELDS)})",
+                            _sql_rows(runs))
+            con.executemany("INSERT OR REPLACE INTO indexed VALUES (?, ?, ?)",
+                            zip(codes[todo], d(first_row[todo]), d((first_row + n - 1)[todo])))
+            counts["breakouts"], counts["consolidations"] = len(brk), int((~cont).sum())
+
+        # outcomes: horizons that matured since the last update
+        rets = [x for x in BREAKOUT_FIELDS if x.startswith(("ret_", "mdd_"))]
+        pending = pd.read_sql_query(f"SELECT rowid AS id, code, date AS signal_date, close, {', '.join(rets)} "
+                                    f"FROM breakouts WHERE ret_{max(TRACK_HORIZONS)} IS NULL", con)
+        if not pending.empty:
+            pending[rets] = pending[rets].astype(float)
+            counts["matured"] = track_fill(pending, bars[bars["code"].isin(set(pending["code"]))])
+            con.executemany(f"UPDATE breakouts SET {', '.join(f'{x} = :{x}' for x in rets)} WHERE rowid = :id",
+                            _sql_rows(pending[["id"] + rets]))
+
+    print(f"[EVENTS] {counts['stocks']} stocks scanned ({counts['reindexed']} re-indexed): "
+          f"+{counts['breakouts']} breakouts, +{counts['consolidations']} consolidations, "
+          f"{counts['matured']} horizons newly matured")
+    metric_count("events.breakouts", counts["breakouts"])
+    return counts
+
+
+def events_query(table: str = "breakouts", code: str | None = None, start=None, end=None,
+                 signal: bool = False, path: str = EVENT_DB) -> pd.DataFrame:
+    """Indexed breakouts (by date) or consolidations (by end date) matching the filters, by code and date."""
+    col = "date" if table == "breakouts" else "end"
+    fields = BREAKOUT_FIELDS if table == "breakouts" else CONSOL_FIELDS
+    where, args = [], []
+    for q, v in (("code = ?", code), (f"{col} >= ?", start), (f"{col} <= ?", end)):
+        if v is not None:
+            where.append(q)
+            args.append(str(v))
+    if signal and table == "breakouts":
+        where.append("signal = 1")
+    if not os.path.exists(path):
+        return pd.DataFrame(columns=list(fields))
+    q = f"SELECT * FROM {table}" + (" WHERE " + " AND ".join(where) if where else "") + f" ORDER BY code, {col}"
+    with contextlib.closing(event_db(path)) as con:
+        return pd.read_sql_query(q, con, params=args)
+
+
+def events_summary(brk: pd.DataFrame, consol: pd.DataFrame, path: str = EVENT_DB) -> pd.DataFrame:
+    """
+    Per stock: consolidations, breakouts (and how many passed every check) per year of indexed
+    history, and each horizon's matured count / hit rate / average return, plus the average
+    drawdown over the longest horizon.
+    """
+    with contextlib.closing(event_db(path)) as con:
+        span_ = pd.read_sql_query("SELECT * FROM indexed", con).set_index("code")
+    years = (pd.to_datetime(span_["through"]) - pd.to_datetime(span_["first"])).dt.days / 365.25
+    g = brk.groupby("code")
+    out = pd.DataFrame({
+        "consolidations": consol.groupby("code").size(),
+        "avg_windows": consol.groupby("code")["windows"].mean(),
+        "breakouts": g.size(),
+        "signals": g["signal"].sum(),
+        "last_breakout": g["date"].max(),
+    })
+    counts = ["consolidations", "breakouts", "signals"]
+    out[counts] = out[counts].fillna(0).astype(int)
+    out["per_year"] = out["breakouts"] / years.reindex(out.index).where(lambda y: y > 0)
+    for h in TRACK_HORIZONS:
+        r = brk[f"ret_{h}"]
+        out[f"n_{h}"] = r.notna().groupby(brk["code"]).sum().reindex(out.index, fill_value=0)
+        out[f"hit_{h}"] = (r > 0).where(r.notna()).groupby(brk["code"]).mean()
+        out[f"ret_{h}"] = g[f"ret_{h}"].mean()
+    out[f"mdd_{max(TRACK_HORIZONS)}"] = g[f"mdd_{max(TRACK_HORIZONS)}"].mean()
+    return out.rename_axis("code").reset_index()
+
+
+def events(code: str | None = None, start=None, end=None, signal: bool = False, update: bool = True,
+           rebuild: bool = False, out_path: str = EVENT_OUT) -> pd.DataFrame:
+    """Update the index, then write / print the per-stock summary (and the stock's breakouts with --code)."""
+    t0 = time.time()
+    if update or rebuild:
+        with span("events_update"):
+            events_update(rebuild=rebuild)
+    brk = events_query("breakouts", code, start, end, signal)
+    consol = events_query("consolidations", code, start, end)
+    summary = events_summary(brk, consol)
+    summary.to_csv(out_path, index=False)
+    with pd.option_context("display.width", 200, "display.max_rows", 500, "display.float_format", "{:.4f}".format):
+        if code:
+            print(brk.drop(columns="code").to_string(index=False))
+        print(summary.sort_values("breakouts", ascending=False).head(50).to_string(index=False))
+    print(f"[EVENTS] {len(brk)} breakouts / {len(consol)} consolidations of {len(summary)} stocks "
+          f"in {time.time() - t0:.1f}s -> {out_path}")
+    return summary
+
 
     # =========================
 # Program entry point
 # =========================
 if __name__ == "__main__":
+    import argparse
+
+    ap = argparse.ArgumentParser(description="TWSE breakout scanner (no command = daily scan)")
+    ap.add_argument("--force", action="store_true",
+                    help="daily scan: ignore checkpoints of the signal date and recompute every stage")
+    sub = ap.add_subparsers(dest="cmd")
+    p_replay = sub.add_parser("replay", help="offline replay over stored history")
+    p_replay.add_argument("start", type=dt.date.fromisoformat, help="YYYY-MM-DD")
+    p_replay.add_argument("end", type=dt.date.fromisoformat, help="YYYY-MM-DD")
+    p_replay.add_argument("--out", default=REPLAY_OUT)
+    p_watch = sub.add_parser("watch", help="intraday polling; alert on newly qualifying stocks")
+    p_watch.add_argument("--interval", type=int, default=WATCH_INTERVAL, help="seconds between polls")
+    p_watch.add_argument("--until", default=WATCH_UNTIL, help="HH:MM Taipei time")
+    p_watch.add_argument("--polls", type=int, default=None, help="stop after N polls")
+    p_watch.add_argument("--allow-stale", action="store_true", help="evaluate snapshots dated before today")
+    p_sweep = sub.add_parser("sweep", help="evaluate a grid of strategy thresholds over stored history")
+    p_sweep.add_argument("start", type=dt.date.fromisoformat, help="YYYY-MM-DD")
+    p_sweep.add_argument("end", type=dt.date.fromisoformat, help="YYYY-MM-DD")
+    p_sweep.add_argument("--grid", help='JSON file: {"MIN_CHG_PCT": [3, 3.5, 4], ...}')
+    p_sweep.add_argument("-p", "--param", action="append", default=[], metavar="NAME=V1,V2",
+                         help="grid axis (repeatable; overrides --grid)")
+    p_sweep.add_argument("--workers", type=int, default=SWEEP_WORKERS)
+    p_sweep.add_argument("--out", default=SWEEP_OUT)
+    p_backfill = sub.add_parser("backfill", help="build store history from whole-market daily snapshots")
+    p_backfill.add_argument("--days", type=int, default=HISTORY_DAYS, help="calendar days back from --end")
+    p_backfill.add_argument("--end", type=dt.date.fromisoformat, default=None, help="YYYY-MM-DD (default: yesterday)")
+    p_backfill.add_argument("--workers", type=int, default=BACKFILL_WORKERS)
+    p_signals = sub.add_parser("signals", help="query the stored signal history")
+    p_signals.add_argument("--start", type=dt.date.fromisoformat, help="YYYY-MM-DD")
+    p_signals.add_argument("--end", type=dt.date.fromisoformat, help="YYYY-MM-DD")
+    p_signals.add_argument("--code")
+    p_signals.add_argument("--type", choices=["A", "B"])
+    p_signals.add_argument("--sector")
+    p_signals.add_argument("--main", action="store_true", help="main-sector signals only")
+    p_signals.add_argument("--all-runs", action="store_true", help="include superseded reruns of a date")
+    p_signals.add_argument("--out", help="write CSV instead of printing")
+    p_track = sub.add_parser("track", help="forward returns / drawdowns / hit rates of past signals")
+    p_track.add_argument("--signals", default=SIGNAL_DB,
+                         help="signal history (default) or scanner_result-style JSONL, e.g. replay output")
+    p_track.add_argument("--out", default=TRACK_OUT)
+    p_events = sub.add_parser("events", help="consolidation / breakout event index over stored history")
+    p_events.add_argument("--code", help="also list this stock's breakouts")
+    p_events.add_argument("--start", type=dt.date.fromisoformat, help="YYYY-MM-DD")
+    p_events.add_argument("--end", type=dt.date.fromisoformat, help="YYYY-MM-DD")
+    p_events.add_argument("--signals-only", action="store_true", help="breakouts that passed every check")
+    p_events.add_argument("--no-update", action="store_true", help="query the index as is")
+    p_events.add_argument("--rebuild", action="store_true", help="index every stock from scratch")
+    p_events.add_argument("--out", default=EVENT_OUT)
+    args = ap.parse_args()
+
     print("=== SCANNER ENTRY ===")
+    profile_start()
     try:
-        run()
+        if args.cmd == "replay":
+            replay(args.start, args.end, args.out)
+        elif args.cmd == "watch":
+            watch(args.interval, args.until, args.polls, args.allow_stale)
+        elif args.cmd == "backfill":
+            end = args.end or dt.date.today() - dt.timedelta(days=1)
+            backfill(end - dt.timedelta(days=args.days), end, args.workers)
+        elif args.cmd == "signals":
+            res = signals_query(args.start, args.end, args.code, args.type, args.sector,
+                                True if args.main else None, args.all_runs)
+            if args.out:
+                res.to_csv(args.out, index=False)
+            else:
+                with pd.option_context("display.width", 200, "display.max_rows", 500):
+                    print(res.drop(columns="run_at").to_string(index=False))
+            print(f"[SIGNALS] {len(res)} signals")
+        elif args.cmd == "track":
+            track(args.signals, args.out)
+        elif args.cmd == "events":
+            events(args.code, args.start, args.end, args.signals_only, not args.no_update, args.rebuild, args.out)
+        elif args.cmd == "sweep":
+            grid = {}
+            if args.grid:
+                with open(args.grid, "r", encoding="utf-8") as f:
+                    grid = json.load(f)
+            for item in args.param:
+                name, _, vals = item.partition("=")
+                grid[name.strip()] = [float(x) for x in vals.split(",") if x.strip()]
+            sweep(args.start, args.end, grid, args.out, args.workers)
+        else:
+            run(force=args.force)
         print("=== SCANNER EXIT (OK) ===")
     except Exception as e:
         print("=== SCANNER EXIT (ERROR) ===", repr(e))
         raise
+    finally:
+        telegram_flush()
+        print(twse_cache_report())
+        metrics_write(command=args.cmd or "scan", profile=profile_stop())
 
 
@@ -0,0 +1,630 @@
+"""
+Regression checks over a synthetic local store (no network): the batched / incremental
+paths must match a straightforward per-stock recompute.
+
+    python -m pytest -q test_scanner.py
+"""
+import os
+import tempfile
+import threading
+import datetime as dt
+
+os.environ["SCANNER_DATA_DIR"] = tempfile.mkdtemp(prefix="scanner-test-")
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import scanner as S
+
+ASOF = dt.date(2025, 6, 2)                 # a Monday; the store holds the bars before it
+N_BARS = 420
+
+
+def _bars(rng: np.random.Generator, n: int, quiet: bool) -> dict:
+    """Random walk; quiet stocks sit in a tight range (consolidations / breakouts happen)."""
+    close = 50 * np.exp(np.cumsum(rng.normal(0, 0.006 if quiet else 0.02, n)))
+    close[-40:] = close[-40] * (1 + rng.uniform(-0.02, 0.02, 40)) if quiet else close[-40:]
+    opn = close * (1 + rng.normal(0, 0.005, n))
+    r2 = lambda x: np.round(x, 2)
+    return {"open": r2(opn), "max": r2(np.maximum(opn, close) * (1 + rng.uniform(0, 0.01, n))),
+            "min": r2(np.minimum(opn, close) * (1 - rng.uniform(0, 0.01, n))), "close": r2(close),
+            "Trading_Volume": rng.integers(1_000, 5_000, n).astype(np.int64) * 1000}
+
+
+def _save(code: str, days: np.ndarray, cols: dict):
+    # synced far back: every read below is served by the store
+    S._store_save(code, {"date": days, **cols}, ASOF - dt.timedelta(days=2000), ASOF)
+
+
+@pytest.fixture(scope="module")
+def store():
+    rng = np.random.default_rng(11)
+    days = pd.bdate_range(end=ASOF - dt.timedelta(days=1), periods=N_BARS).values.astype("datetime64[D]")
+    codes = [str(1100 + i) for i in range(40)]
+    for i, code in enumerate(codes):
+        keep = np.ones(N_BARS, dtype=bool)
+        if i % 7 == 3:                       # suspensions: windows run over the stock's own bars
+            keep[rng.choice(N_BARS - 30, 15, replace=False)] = False
+        n = int(keep.sum()) if i % 11 else 60     # a few short histories
+        _save(code, days[keep][-n:], _bars(rng, n, quiet=i % 2 == 0))
+    return {"codes": codes, "days": days}
+
+
+@pytest.fixture(autouse=True)
+def no_network(monkeypatch):
+    def fail(*a, **k):
+        raise AssertionError("history fetch in an offline test")
+    monkeypatch.setattr(S, "get_price_history", fail)
+
+
+def _reset_indicators():
+    S._ind = None
+    if os.path.exists(S.INDICATOR_PATH):
+        os.remove(S.INDICATOR_PATH)
+
+
+def _reference(code: str, asof: dt.date) -> dict:
+    """check_one_stock's window stats, sliced per stock from the stored bars (不含今日)."""
+    z = S._store_read(code)
+    d = z["date"].astype("datetime64[D]")
+    m = (d >= np.datetime64(asof - dt.timedelta(days=S.HISTORY_DAYS), "D")) & (d < np.datetime64(asof, "D"))
+    base = {c: z[c][m].astype(float) for c in S.PRICE_COLS}
+    n = int(m.sum())
+    nan = float("nan")
+    out = {
+        "n_bars": min(n, S.IND_RING),
+        "last_close": base["close"][-1] if n else nan,
+        "ma5": base["Trading_Volume"][-5:].mean() if n >= 5 else nan,
+        "high20": base["max"][-S.CONSOL_DAYS:].max() if n >= S.CONSOL_DAYS else nan,
+        "low20": base["min"][-S.CONSOL_DAYS:].min() if n >= S.CONSOL_DAYS else nan,
+    }
+    for k in S.MA_WINDOWS:
+        out[f"ma{k}"] = pd.Series(base["close"]).rolling(k).mean().iloc[-1] if n >= k else nan
+    return out
+
+
+def _assert_matches_reference(codes: list[str], asof: dt.date):
+    got = S.indicators_asof(codes, asof)
+    for j, code in enumerate(codes):
+        ref = _reference(code, asof)
+        for k in ("n_bars", "last_close", "ma5", "high20", "low20"):
+            np.testing.assert_equal(got[k][j], ref[k], err_msg=f"{code} {k} @ {asof}")
+        for k in S.MA_WINDOWS:      # running sums vs windowed sums: last-ulp differences only
+            np.testing.assert_allclose(got[f"ma{k}"][j], ref[f"ma{k}"], rtol=1e-12,
+                                       err_msg=f"{code} ma{k} @ {asof}")
+
+
+def test_indicator_state_incremental_matches_full(store):
+    _reset_indicators()
+    codes, days = store["codes"], store["days"]
+    # day by day, then with gaps of several sessions between runs
+    asofs = [pd.Timestamp(x).date() for x in days[-60:-40]] + \
+            [pd.Timestamp(x).date() for x in days[-40::7]] + [ASOF]
+    for asof in asofs:
+        _assert_matches_reference(codes, asof)
+
+
+def test_indicator_state_rewind_and_rewritten_history(store):
+    _reset_indicators()
+    codes, days = store["codes"], store["days"]
+    _assert_matches_reference(codes, ASOF)
+
+    # rewind: states that already folded bars on / after asof are rebuilt
+    _assert_matches_reference(codes, pd.Timestamp(days[-30]).date())
+    _assert_matches_reference(codes, ASOF)
+
+    # the store gains older bars (backfill) / the last folded bar is revised
+    z = S._store_read(codes[0])
+    older = np.arange(z["date"][0].astype("datetime64[D]") - 40, z["date"][0].astype("datetime64[D]"))
+    older = older[np.is_busday(older)]
+    extra = _bars(np.random.default_rng(3), len(older), quiet=False)
+    _save(codes[0], np.concatenate([older, z["date"]]),
+          {c: np.concatenate([extra[c], z[c]]) for c in S.PRICE_COLS})
+    z = S._store_read(codes[1])
+    z["close"][-1] = np.round(z["close"][-1] * 1.01, 2)
+    _save(codes[1], z["date"], {c: z[c] for c in S.PRICE_COLS})
+    _assert_matches_reference(codes, ASOF)
+
+
+def _candidates(codes: list[str]) -> list[dict]:
+    """Candidate rows around each stock's 20-day high / volume average: some break out, some don't."""
+    rows = []
+    for i, code in enumerate(codes):
+        ref = _reference(code, ASOF)
+        hi = ref["high20"] if np.isfinite(ref["high20"]) else 50.0
+        c = round(hi * (1.03 if i % 3 else 0.99), 2)
+        v = float(ref["ma5"] * (3 if i % 4 else 1.5)) if np.isfinite(ref["ma5"]) else 1e6
+        rows.append({"Code": code, "Name": f"N{code}", "Date": ASOF.strftime("%Y%m%d"),
+                     "ClosingPrice": c, "OpeningPrice": c / 1.05, "TradeVolume": v, "chg_pct": 5.0})
+    return rows
+
+
+def test_check_candidates_matches_per_stock_check(store):
+    _reset_indicators()
+    rows = _candidates(store["codes"])
+    cand = pd.DataFrame(rows)
+
+    expect = {}
+    for r in rows:      # check_one_stock's tests one stock at a time
+        ref = _reference(r["Code"], ASOF)
+        c, v, pc, ma5 = r["ClosingPrice"], r["TradeVolume"], ref["last_close"], ref["ma5"]
+        width = (ref["high20"] - ref["low20"]) / ref["low20"] if ref["low20"] > 0 else 999.0
+        if ref["n_bars"] >= S.CONSOL_DAYS + 6 and pc > 0 and (c - pc) / pc >= 0.03 \
+                and ma5 > 0 and v > S.VOL_MULT * ma5 and width <= S.MAX_RANGE_PCT \
+                and c >= ref["high20"] * (1 + S.BREAKOUT_PCT) and (v > ma5 or not S.BREAKOUT_VOL_GT_MA5):
+            expect[r["Code"]] = {"range20_pct": width, "vol_mult": v / ma5, "break_pct": c / ref["high20"] - 1,
+                                 **{f"ma{k}": ref[f"ma{k}"] for k in S.MA_WINDOWS}}
+
+    hits = {h["Code"]: h for h in S.check_candidates(cand)}
+    assert expect, "fixture produced no breakout"
+    assert sorted(hits) == sorted(expect)
+    for code, e in expect.items():
+        for k, v in e.items():
+            if np.isnan(v):
+                assert hits[code][k] is None
+            else:
+                np.testing.assert_allclose(hits[code][k], v, rtol=1e-12, err_msg=f"{code} {k}")
+
+
+def _event_tables(path: str) -> tuple[pd.DataFrame, pd.DataFrame]:
+    b = S.events_query("breakouts", path=path).sort_values(["code", "date"]).reset_index(drop=True)
+    c = S.events_query("consolidations", path=path).sort_values(["code", "end"]).reset_index(drop=True)
+    return b, c
+
+
+def test_events_incremental_matches_rebuild(store, tmp_path):
+    bars = S.load_universe_bars()
+    full, inc = str(tmp_path / "full.sqlite"), str(tmp_path / "inc.sqlite")
+    S.events_update(bars, rebuild=True, path=full)
+
+    # one run over history up to 25 sessions ago, then one run per new session
+    days = np.sort(bars["date"].unique())
+    S.events_update(bars[bars["date"] <= days[-26]], path=inc)
+    for d in days[-25:]:
+        S.events_update(bars[bars["date"] <= d], path=inc)
+
+    (fb, fc), (ib, ic) = _event_tables(full), _event_tables(inc)
+    assert len(fb) and len(fc)
+    pd.testing.assert_frame_equal(ib, fb, check_dtype=False)
+    pd.testing.assert_frame_equal(ic, fc, check_dtype=False)
+
+
+def test_events_match_rolling_windows(store, tmp_path):
+    bars = S.load_universe_bars()
+    path = str(tmp_path / "ev.sqlite")
+    S.events_update(bars, path=path)
+    brk, consol = _event_tables(path)
+
+    # pandas rolling per stock: window of the CONSOL_DAYS bars before each bar
+    g = pd.factorize(bars["code"])[0]
+    hi = pd.Series(S.price_f64(bars["max"])).groupby(g).rolling(S.CONSOL_DAYS).max().to_numpy()
+    lo = pd.Series(S.price_f64(bars["min"])).groupby(g).rolling(S.CONSOL_DAYS).min().to_numpy()
+    cons = ~np.isnan(hi) & ~(S._range_width(hi, lo) > S.MAX_RANGE_PCT)
+    same = np.r_[False, g[1:] == g[:-1]]
+    v = bars["Trading_Volume"].to_numpy(dtype=float)
+    ma5 = pd.Series(v).groupby(g).rolling(5).mean().to_numpy()
+    prev = lambda a: np.where(same, np.r_[np.nan, a[:-1]], np.nan)
+    with np.errstate(invalid="ignore"):
+        hit = (same & np.r_[False, cons[:-1]] & (S.price_f64(bars["close"]) >= prev(hi) * (1 + S.BREAKOUT_PCT))
+               & ((v > prev(ma5)) if S.BREAKOUT_VOL_GT_MA5 else True))
+    key = bars["code"].astype(str) + " " + bars["date"].dt.strftime("%Y-%m-%d")
+    assert sorted(brk["code"] + " " + brk["date"]) == sorted(key[hit])
+    assert len(consol) == int((cons & ~(np.r_[False, cons[:-1]] & same)).sum())
+    assert consol["windows"].sum() == int(cons.sum())
+
+
+@pytest.fixture()
+def calendar(tmp_path, monkeypatch):
+    monkeypatch.setattr(S, "CALENDAR_PATH", str(tmp_path / "calendar.json"))
+    monkeypatch.setattr(S, "_cal", {"dates": [], "index": {}, "known_through": None, "loaded": True})
+
+
+def _sessions(start: dt.date, end: dt.date, holidays=()) -> list[dt.date]:
+    days = pd.bdate_range(start, end).date
+    return [d for d in days if d not in holidays]
+
+
+def _twse_answering(sessions: list[dt.date], probed: list):
+    """TWSE stand-in: a session's own snapshot; any other day gets the session before it."""
+    def fetch(date_yyyymmdd=None, max_retries=3):
+        d = dt.datetime.strptime(date_yyyymmdd, "%Y%m%d").date()
+        probed.append(d)
+        before = [x for x in sessions if x <= d]
+        if not before:
+            return pd.DataFrame()
+        return pd.DataFrame({"Date": [before[-1].strftime("%Y%m%d")], "Code": ["2330"]})
+    return fetch
+
+
+def test_calendar_probe_skips_days_answered_with_another_session(calendar, monkeypatch):
+    today = dt.date.today()
+    holiday = pd.bdate_range(end=today - dt.timedelta(days=1), periods=5).date[0]    # inside the probed range
+    sessions = _sessions(today - dt.timedelta(days=60), today, holidays={holiday})
+    probed = []
+    monkeypatch.setattr(S, "twse_fetch_day", _twse_answering(sessions, probed))
+
+    kt = today - dt.timedelta(days=12)
+    S.calendar_extend([d for d in sessions if d <= kt], known_through=kt)
+    got = S.find_recent_trade_days(5)
+
+    assert probed == [kt + dt.timedelta(days=i) for i in range(1, (today - kt).days + 1)]
+    assert S.trade_calendar_dates() == sessions
+    assert got == [d.strftime("%Y%m%d") for d in sessions[::-1][:5]]
+    assert S.calendar_known_through() == today - dt.timedelta(days=1)
+    assert S.prev_trade_day(sessions[-1]) == sessions[-2]
+
+
+def test_calendar_backwards_probe_without_calendar(calendar, monkeypatch):
+    today = dt.date.today()
+    holiday = pd.bdate_range(end=today - dt.timedelta(days=1), periods=3).date[0]
+    sessions = _sessions(today - dt.timedelta(days=60), today, holidays={holiday})
+    monkeypatch.setattr(S, "twse_fetch_day", _twse_answering(sessions, []))
+
+    got = S.find_recent_trade_days(4)
+    assert got == [d.strftime("%Y%m%d") for d in sessions[::-1][:4]]
+    assert S.trade_calendar_dates() == sorted(sessions[::-1][:4])
+
+
+TWSE_FIELDS = ["證券代號", "證券名稱", "成交股數", "成交金額", "開盤價",
+               "最高價", "最低價", "收盤價", "漲跌價差", "成交筆數"]
+
+
+def _day_all(d: dt.date) -> dict:
+    return {"stat": "OK", "date": d.strftime("%Y%m%d"), "fields": TWSE_FIELDS,
+            "data": [["2330", "台積電", "25,000,000", "25,000,000,000", "1,000.00",
+                      "1,010.00", "995.00", "1,005.00", "5.00", "30,000"]]}
+
+
+@pytest.fixture()
+def snapshot_cache(tmp_path, monkeypatch):
+    monkeypatch.setattr(S, "TWSE_CACHE_DIR", str(tmp_path / "twse"))
+    monkeypatch.setattr(S, "_twse_memo", {})
+    monkeypatch.setattr(S, "_twse_failed", set())
+
+
+def _cached(d: dt.date | None, answers: list):
+    """_snapshot_cached for d's STOCK_DAY_ALL; answers are served (and used up) in order."""
+    key = d.strftime("%Y%m%d") if d else None
+    return S._snapshot_cached(key or "latest", key, lambda: answers.pop(0),
+                              lambda j: S.parse_stock_day_all(j, key))
+
+
+def _noon(d: dt.date) -> float:
+    return dt.datetime.combine(d, dt.time(12)).timestamp()
+
+
+def test_snapshot_cache_own_session_is_final(snapshot_cache):
+    d = dt.date.today() - dt.timedelta(days=10)
+    answers = [_day_all(d)]
+    assert S._snapshot_date(_cached(d, answers)) == d
+    S._twse_memo.clear()
+    assert S._snapshot_date(_cached(d, answers)) == d      # from disk, no second fetch
+    assert answers == []
+
+
+def test_snapshot_cache_same_day_answer_for_another_session_expires(snapshot_cache):
+    d = dt.date.today() - dt.timedelta(days=10)
+    prev = d - dt.timedelta(days=1)
+    # cached on d itself, before TWSE published d: the previous session's snapshot
+    S._twse_disk_put(d.strftime("%Y%m%d"), _day_all(prev), _noon(d))
+    answers = [_day_all(d)]
+    assert S._snapshot_date(_cached(d, answers)) == d
+    assert answers == []
+
+    # the same answer fetched after d is final: d was not a session
+    h = d - dt.timedelta(days=20)
+    S._twse_disk_put(h.strftime("%Y%m%d"), _day_all(h - dt.timedelta(days=1)), _noon(h + dt.timedelta(days=1)))
+    assert S._snapshot_date(_cached(h, [])) == h - dt.timedelta(days=1)
+
+    # payloads cached without a fetch time count as fetched at their mtime
+    path = os.path.join(S.TWSE_CACHE_DIR, "legacy.json")
+    S._save_json(path, _day_all(prev))
+    os.utime(path, (_noon(d), _noon(d)))
+    answers = [_day_all(d)]
+    S._snapshot_cached("legacy", d.strftime("%Y%m%d"), lambda: answers.pop(0), S.parse_stock_day_all)
+    assert answers == []
+
+
+def test_snapshot_cache_keeps_no_data_and_failures_off_disk(snapshot_cache, monkeypatch):
+    d = dt.date.today() - dt.timedelta(days=3)
+    key = d.strftime("%Y%m%d")
+    answers = [None, {"stat": "很抱歉，沒有符合條件的資料!"}, _day_all(d)]
+    assert _cached(d, answers).empty
+    assert S._twse_failed == {key}
+    assert _cached(d, answers).empty                        # no data: not a failure, not stored
+    assert S._twse_failed == set()
+    assert not os.path.exists(os.path.join(S.TWSE_CACHE_DIR, f"{key}.json"))
+    monkeypatch.setattr(S, "TWSE_LATEST_TTL", 0)             # and not memoized past the TTL
+    assert S._snapshot_date(_cached(d, answers)) == d
+
+
+def test_snapshot_cache_latest_expires(snapshot_cache, monkeypatch):
+    today = dt.date.today()
+    answers = [_day_all(today - dt.timedelta(days=1)), _day_all(today)]
+    assert S._snapshot_date(_cached(None, answers)) == today - dt.timedelta(days=1)
+    assert S._snapshot_date(_cached(None, answers)) == today - dt.timedelta(days=1)   # within the TTL
+    monkeypatch.setattr(S, "TWSE_LATEST_TTL", 0)
+    assert S._snapshot_date(_cached(None, answers)) == today
+
+
+def _snapshot(d: dt.date) -> pd.DataFrame:
+    px = float(d.toordinal() % 1000)
+    return pd.DataFrame({"Date": [d.strftime("%Y%m%d")], "Code": ["2330"], "Name": ["台積電"],
+                         "OpeningPrice": [px], "HighestPrice": [px], "LowestPrice": [px],
+                         "ClosingPrice": [px], "TradeVolume": [1_000_000]})
+
+
+@pytest.fixture()
+def backfill_store(calendar, tmp_path, monkeypatch):
+    monkeypatch.setattr(S, "STORE_DIR", str(tmp_path / "ohlcv"))
+    monkeypatch.setattr(S, "NAMES_PATH", str(tmp_path / "ohlcv" / "_names.json"))
+    monkeypatch.setattr(S, "BACKFILL_PATH", str(tmp_path / "backfill.json"))
+    monkeypatch.setattr(S, "_twse_failed", set())
+
+
+def test_backfill_skips_sessions_answered_with_another_one(backfill_store, monkeypatch):
+    monkeypatch.setattr(S, "BACKFILL_CHUNK", 5)
+    start, end = dt.date(2025, 3, 3), dt.date(2025, 3, 31)
+    holiday, unanswered = dt.date(2025, 3, 12), dt.date(2025, 3, 20)
+    sessions = _sessions(start, end, holidays={holiday})
+    # the 0050 history behind the calendar
+    monkeypatch.setattr(S, "get_price_history",
+                        lambda code, a, b: S.calendar_extend(sessions, known_through=end))
+
+    def fetch_day(key, own=(unanswered,)):
+        d = dt.datetime.strptime(key, "%Y%m%d").date()
+        return _snapshot(d if d in sessions and d not in own else max(x for x in sessions if x < d))
+
+    monkeypatch.setattr(S, "fetch_day", fetch_day)
+    assert S.backfill(start, end) == len(sessions) - 1
+    z = S._store_read("2330")
+    assert z["date"].astype("datetime64[D]").tolist() == [d for d in sessions if d != unanswered]
+    # synced down to the unanswered session only: the store does not claim it
+    assert S._to_date(z["synced_from"]) == unanswered + dt.timedelta(days=1)
+    assert S._to_date(z["synced_through"]) == end
+    done = S._backfill_done()
+    assert holiday.isoformat() in done and unanswered.isoformat() not in done
+
+    # answered later: the rerun fetches that day only and closes the synced range
+    monkeypatch.setattr(S, "fetch_day", lambda key: fetch_day(key, own=()))
+    assert S.backfill(start, end) == 1
+    z = S._store_read("2330")
+    assert z["date"].astype("datetime64[D]").tolist() == sessions
+    assert (S._to_date(z["synced_from"]), S._to_date(z["synced_through"])) == (start, end)
+    assert len(S._backfill_done()) == len(_sessions(start, end))
+
+
+def test_backfill_without_calendar_leaves_other_session_answers_open(backfill_store, monkeypatch):
+    monkeypatch.setattr(S, "get_price_history", lambda code, a, b: pd.DataFrame())
+    start, end = dt.date(2025, 3, 3), dt.date(2025, 3, 31)
+    # an endpoint that answers every date with the same session
+    monkeypatch.setattr(S, "fetch_day", lambda key: _snapshot(end))
+
+    assert S.backfill(start, end) == 1
+    z = S._store_read("2330")
+    assert len(z["date"]) == 1
+    # synced back over the weekend only, not over the Friday answered with Monday's session
+    assert (S._to_date(z["synced_from"]), S._to_date(z["synced_through"])) == (end - dt.timedelta(days=2), end)
+    assert S._backfill_done() == {end.isoformat()}
+
+
+def test_tg_split_respects_the_utf16_limit():
+    lines = [f"{i:03d} 台積電 📈 " + "x" * (i % 17) for i in range(200)]
+    text = "\n".join(lines)
+    parts = S._tg_split(text, 300)
+    assert len(parts) > 1 and all(S._tg_len(p) <= 300 for p in parts)
+    assert "\n".join(parts) == text                     # cut on line breaks only
+
+    long = "📈台" * 400                                  # one line over the limit: cut hard
+    parts = S._tg_split(f"head\n{long}\ntail", 301)
+    assert all(S._tg_len(p) <= 301 for p in parts)
+    assert parts[0] == "head" and parts[-1] == "tail" and "".join(parts[1:-1]) == long
+
+
+def test_telegram_batches_pack_in_order():
+    texts = [f"msg {i}\n" + "y" * (i * 7 % 90) for i in range(60)]
+    out = S.telegram_batches(texts, 500)
+    assert all(S._tg_len(b) <= 500 for b in out)
+    assert "\n\n".join(out) == "\n\n".join(texts)
+    # greedy: no two neighbouring batches would have fit in one
+    assert all(S._tg_len(a + "\n\n" + b.split("\n\n")[0]) > 500 for a, b in zip(out, out[1:]))
+    assert S.telegram_batches([]) == []
+
+
+def test_telegram_dispatcher_batches_queued_messages(monkeypatch):
+    sent = []
+    monkeypatch.setattr(S, "BOT_TOKEN", "t")
+    monkeypatch.setattr(S, "CHAT_ID", "c")
+    monkeypatch.setattr(S, "_telegram_post", sent.append)
+    for i in range(5):
+        S.send_telegram(f"hit {i}")
+    S.telegram_flush()
+    assert sent == ["\n\n".join(f"hit {i}" for i in range(5))]
+    S.send_telegram("after flush")                       # the dispatcher restarts
+    S.telegram_flush()
+    assert sent[-1] == "after flush"
+
+
+TPEX_FIELDS = ["代號", "名稱", "收盤 ", "漲跌", "開盤 ", "最高 ", "最低", "均價 ",
+               "成交股數  ", "成交金額(元)", "成交筆數 "]
+
+
+def _tpex_daily(date: str, rows: list) -> dict:
+    return {"stat": "ok", "date": date, "tables": [
+        {"title": "指數", "fields": ["指數", "收市指數"], "data": [["櫃買指數", "250.12"]]},
+        {"title": "上櫃股票行情", "fields": TPEX_FIELDS, "data": rows}]}
+
+
+def test_parse_tpex_daily():
+    rows = [["6488", "環球晶 ", "480.50", "+5.50", "475.00", "482.00", "474.00", "479.1", "1,234,000", "592,000,000", "1,500"],
+            ["8069", "元太", "---", "0.00", "---", "---", "---", "---", "0", "0", "0"],        # no trade
+            ["00679B", "元大美債20年", "28.10", "0.05", "28.05", "28.20", "28.00", "28.1", "9,000", "252,900", "30"],
+            ["70001P", "權證", "1.20", "0.10", "1.10", "1.25", "1.05", "1.2", "5,000", "6,000", "3"]]
+    df = S.parse_tpex_daily(_tpex_daily("115/01/05", rows))
+    assert df["Code"].tolist() == ["6488"]
+    r = df.iloc[0]
+    assert (r["Date"], r["Name"].strip()) == ("20260105", "環球晶")
+    assert (r["OpeningPrice"], r["HighestPrice"], r["LowestPrice"], r["ClosingPrice"]) == (475.0, 482.0, 474.0, 480.5)
+    assert (r["TradeVolume"], r["TradeValue"]) == (1_234_000, 592_000_000)
+    assert df["TradeVolume"].dtype == np.int64
+    assert S._snapshot_date(df) == dt.date(2026, 1, 5)
+
+    # the Gregorian date forms, and no date in the payload: the requested one
+    assert S.parse_tpex_daily(_tpex_daily("2026/01/05", rows[:1]))["Date"].iloc[0] == "20260105"
+    assert S.parse_tpex_daily(_tpex_daily("", rows[:1]), "20260106")["Date"].iloc[0] == "20260106"
+    # no quotes: stat not ok, no 代號 table, an empty table
+    assert S.parse_tpex_daily({"stat": "error"}).empty
+    assert S.parse_tpex_daily({"stat": "ok", "tables": [{"fields": ["指數"], "data": [["x"]]}]}).empty
+    assert S.parse_tpex_daily(_tpex_daily("115/01/05", [])).empty
+
+
+def test_fetch_day_leaves_out_an_exchange_on_another_date(monkeypatch):
+    twse = S.parse_stock_day_all(_day_all(dt.date(2026, 1, 6)))
+    tpex_rows = [["6488", "環球晶", "480.50", "+5.50", "475.00", "482.00", "474.00", "479.1", "1,234,000", "592,000,000", "1,500"],
+                 ["2330", "dup", "1.00", "0", "1.00", "1.00", "1.00", "1.0", "1,000", "1,000", "1"]]
+    monkeypatch.setattr(S, "EXCHANGES", ["twse", "tpex"])
+    monkeypatch.setitem(S.EXCHANGE_SOURCES, "twse", (lambda d: twse.copy(), ""))
+    for date, want in (("115/01/06", ["2330", "6488"]), ("115/01/05", ["2330"])):
+        payload = _tpex_daily(date, tpex_rows)
+        monkeypatch.setitem(S.EXCHANGE_SOURCES, "tpex", (lambda d, p=payload: S.parse_tpex_daily(p), "tpex-"))
+        df = S.fetch_day("20260106")
+        assert df["Code"].tolist() == want
+        assert df.loc[df["Code"] == "2330", "Market"].tolist() == ["twse"]     # the first exchange wins
+
+
+def test_sector_map_ttl_delta_and_full_refresh(tmp_path, monkeypatch):
+    monkeypatch.setattr(S, "SECTOR_MAP_PATH", str(tmp_path / "sector_map.json"))
+    calls, info = [], {"status": 200, "data": [
+        {"stock_id": "2330", "industry_category": "半導體業", "date": "2025-01-02"},
+        {"stock_id": "2317", "industry_category": "其他電子業", "date": "2025-01-02"},
+        {"stock_id": "9999", "industry_category": "電子零組件業", "date": "2025-01-03"}]}
+
+    def finmind(dataset, data_id, start, end):
+        calls.append(start)
+        if isinstance(info, Exception):
+            raise info
+        return {"status": 200, "data": [r for r in info["data"] if r["date"] >= start]}
+
+    monkeypatch.setattr(S, "_finmind_json", finmind)
+    m = S.load_sector_map()
+    assert calls == ["2000-01-01"] and m.through == "2025-01-03" and len(m) == 3
+    assert S.load_sector_map().stamp == m.stamp and len(calls) == 1            # within the TTL
+
+    # past the TTL: only rows from the newest date held, merged over the saved map
+    monkeypatch.setattr(S, "SECTOR_MAP_TTL", 0)
+    assert S.load_sector_map().stamp == m.stamp and calls[-1] == "2025-01-03"
+    info["data"] = [r for r in info["data"] if r["stock_id"] != "9999"]         # delisted
+    info["data"].append({"stock_id": "2317", "industry_category": "電腦及週邊設備業", "date": "2025-02-01"})
+    d = S.load_sector_map()
+    assert calls[-1] == "2025-01-03" and d.stamp != m.stamp and d.through == "2025-02-01"
+    assert (d["2317"], d["9999"]) == ("電腦及週邊設備業", "電子零組件業")        # a delta keeps delistings
+    assert S.load_sector_map_offline().stamp == d.stamp
+
+    # FinMind down: the saved map, whatever its age
+    info = RuntimeError("Missing FINMIND_TOKEN")
+    assert S.load_sector_map().stamp == d.stamp
+
+    # every SECTOR_MAP_FULL_DAYS: a full download, which drops the delisting
+    info = {"status": 200, "data": [
+        {"stock_id": "2330", "industry_category": "半導體業", "date": "2025-01-02"},
+        {"stock_id": "2317", "industry_category": "電腦及週邊設備業", "date": "2025-02-01"}]}
+    monkeypatch.setattr(S, "SECTOR_MAP_FULL_DAYS", 0)
+    f = S.load_sector_map()
+    assert calls[-1] == "2000-01-01" and sorted(f) == ["2317", "2330"]
+
+
+def test_sector_map_plain_file_is_refreshed_in_full(tmp_path, monkeypatch):
+    monkeypatch.setattr(S, "SECTOR_MAP_PATH", str(tmp_path / "sector_map.json"))
+    S._save_json(S.SECTOR_MAP_PATH, {"2330": "半導體業"})
+    assert S.load_sector_map_offline() == {"2330": "半導體業"}
+    calls = []
+    monkeypatch.setattr(S, "_finmind_json", lambda ds, i, start, end: calls.append(start) or {
+        "status": 200, "data": [{"stock_id": "2330", "industry_category": "半導體業", "date": "2025-01-02"}]})
+    m = S.load_sector_map()
+    assert calls == ["2000-01-01"] and m.fetched_at is not None and m.through == "2025-01-02"
+
+
+def test_resumed_check_does_not_count_prescreen_twice(store, calendar, tmp_path, monkeypatch):
+    monkeypatch.setattr(S, "CHECKPOINT_DIR", str(tmp_path / "checkpoints"))
+    monkeypatch.setattr(S, "PRESCREEN_PATH", str(tmp_path / "prescreen.json"))
+    S.calendar_extend(store["days"].tolist(), known_through=ASOF - dt.timedelta(days=1))
+    _reset_indicators()
+    cand = pd.DataFrame(_candidates(store["codes"]))
+
+    hits = S.check_candidates(cand, "2025-06-02")
+    stats = S._prescreen_stats()
+    assert sum(st["seen"] for st in stats.values()) > 0
+    assert S.check_candidates(cand, "2025-06-02") == hits       # resumed: same hits, stats as they were
+    assert S._prescreen_stats() == stats
+    S.check_candidates(cand)                                     # a new run counts again
+    assert S._prescreen_stats() != stats
+
+
+@pytest.fixture()
+def checkpoints(tmp_path, monkeypatch):
+    monkeypatch.setattr(S, "CHECKPOINT_DIR", str(tmp_path / "checkpoints"))
+    monkeypatch.setattr(S, "PRESCREEN_PATH", str(tmp_path / "prescreen.json"))
+
+
+def test_checkpointed_stage_runs_once_per_date(checkpoints):
+    latest = pd.DataFrame({"Date": ["20250602"], "Code": ["2330"]})
+    key = S.ckpt_open(latest)
+    assert key == "2025-06-02"
+    calls = []
+
+    def compute():
+        calls.append(1)
+        return {"n": len(calls)}
+
+    assert S.checkpointed(key, "stage", compute) == {"n": 1}
+    assert S.checkpointed(key, "stage", compute) == {"n": 1} and len(calls) == 1
+    assert S.checkpointed(key, "kept_out", compute, keep=lambda r: False) == {"n": 2}
+    assert S.checkpointed(key, "kept_out", compute, keep=lambda r: False) == {"n": 3}   # not saved: redone
+    assert S.checkpointed(None, "stage", compute) == {"n": 4}                          # no key: nothing saved
+
+    # force drops the date's checkpoints; only the newest CHECKPOINT_KEEP dates are kept
+    assert S.checkpointed(S.ckpt_open(latest, force=True), "stage", compute) == {"n": 5}
+    for d in pd.bdate_range("2025-06-03", periods=S.CHECKPOINT_KEEP).strftime("%Y%m%d"):
+        S.checkpointed(S.ckpt_open(pd.DataFrame({"Date": [d]})), "stage", compute)
+    assert "2025-06-02" not in os.listdir(S.CHECKPOINT_DIR)
+    assert len(os.listdir(S.CHECKPOINT_DIR)) == S.CHECKPOINT_KEEP
+    assert S.ckpt_open(pd.DataFrame()) is None
+
+
+def test_ckpt_records_skip_a_torn_line(checkpoints):
+    S.ckpt_append("k", "checks", {"code": "2330"})
+    S.ckpt_append("k", "checks", {"code": "2317"})
+    with open(S._ckpt_path("k", "checks", "jsonl"), "a", encoding="utf-8") as f:
+        f.write('{"code": "64')                                  # crash mid-write
+    assert [r["code"] for r in S.ckpt_records("k", "checks")] == ["2330", "2317"]
+    assert S.ckpt_records("other", "checks") == [] and S.ckpt_records(None, "checks") == []
+
+
+def test_interrupted_check_resumes_the_unfinished_stocks(store, checkpoints, monkeypatch):
+    _reset_indicators()
+    cand = pd.DataFrame(_candidates(store["codes"]))
+    expect = S.check_candidates(cand)
+
+    _reset_indicators()
+    state, calls, lock = S.indicator_state, [], threading.Lock()
+
+    def crash_after(n):
+        def indicator_state(code, *a, **k):
+            with lock:
+                calls.append(code)
+                if len(calls) > n:
+                    raise KeyboardInterrupt
+            return state(code, *a, **k)
+        return indicator_state
+
+    monkeypatch.setattr(S, "indicator_state", crash_after(15))
+    with pytest.raises(KeyboardInterrupt):
+        S.check_candidates(cand, "2025-06-02")
+    finished = {r["code"] for r in S.ckpt_records("2025-06-02", "checks")}
+    assert 0 < len(finished) <= 15
+
+    calls.clear()
+    monkeypatch.setattr(S, "indicator_state", crash_after(10 ** 6))
+    assert S.check_candidates(cand, "2025-06-02") == expect
+    assert sorted(calls) == sorted(set(store["codes"]) - finished)      # only the unfinished ones